@@ -1,11 +1,22 @@
 import os
 import json
 import base64
+import hashlib
 import logging
+import signal
 import time
 import re
-from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple, List
+import threading
+import functools
+import heapq
+import itertools
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Mapping, NamedTuple, Optional, Tuple, List
+
+# Riferimento per il report dei tempi di avvio (include gli import delle librerie)
+_STARTUP_T0 = time.perf_counter()
 
 try:
     from zoneinfo import ZoneInfo  # Python 3.9+
@@ -14,10 +25,26 @@ except Exception:  # pragma: no cover
 
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from bs4 import BeautifulSoup
+from googleapiclient.errors import HttpError
+# Import pesanti (discovery, bs4, google_auth_oauthlib, SDK Gemini) caricati solo quando servono
+
+from calendar_agent import backfill
+from calendar_agent.accounts import BudgetManager, ErrorCounter, account_env, aggregate_reports, load_accounts_config
+from calendar_agent.calendar_index import CalendarEventIndex
+from calendar_agent.dates import REFERENCE, reference_now
+from calendar_agent.decisions import is_valid_decision, needs_escalation, normalize_date, optional_field, parse_event_decision
+from calendar_agent.gemini_client import MODEL_NOT_FOUND, QUOTA_EXHAUSTED, GeminiClient, error_status, estimate_tokens
+from calendar_agent.ics import MAX_ICS_EVENTS, calendar_parts, ics_timezone, is_calendar_part, parse_ics
+from calendar_agent.ledger import ProcessedLedger
+from calendar_agent.metrics import RunMetrics
+from calendar_agent.prefilter import EmailPrefilter
+from calendar_agent.rate_limit import GEMINI_MAX_WAIT_DEFAULT_SECS, CombinedRateLimiter, GeminiRateLimiter
+from calendar_agent.records import EmailRecord
+from calendar_agent.scheduler import RunScheduler
+from calendar_agent.sender_templates import SenderTemplates
+from calendar_agent.settings import env_bool, env_float, env_int, load_settings
+from calendar_agent.util import write_json_file, write_text_file
 
 
 # Ambiti richiesti: Gmail (modify) e Calendar (events)
@@ -31,6 +58,21 @@ MODEL = None
 TIMEZONE = None
 MAX_UNREAD_TO_PROCESS = None
 PER_EMAIL_SLEEP_SECS = None
+DEFAULT_STATE_DIR = os.path.join(os.path.dirname(__file__), ".state")
+# Configurazione delle funzionalità opzionali, riletta da configure()
+SETTINGS = load_settings({}, DEFAULT_STATE_DIR)
+RATE_LIMITER = None
+PREFILTER = None
+GEMINI_CLIENT = None
+EVENT_INDEX = None
+RUN_DEADLINE = None
+SCHEDULER = None
+SENDER_TEMPLATES = None
+# Budget Gemini globale condiviso tra i processi (modalità multi-account)
+SHARED_GEMINI_BUDGET = None
+_GEMINI_CLIENT_LOCK = threading.Lock()
+# Impostato alla ricezione di SIGTERM/SIGINT in modalità demone: nessuna nuova analisi
+_SHUTDOWN = threading.Event()
 
 
 class RateLimitExceeded(Exception):
@@ -40,11 +82,13 @@ class RateLimitExceeded(Exception):
         self.retry_after_seconds = retry_after_seconds
 
 
-def setup_logging() -> None:
+def setup_logging(account: Optional[str] = None) -> None:
     log_path = os.path.join(os.path.dirname(__file__), "automation.log")
+    # In modalità multi-account ogni riga riporta l'account del processo
+    account = account or os.getenv("ACCOUNT_NAME")
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
+        format=f"%(asctime)s [%(levelname)s] [{account}] %(message)s" if account else "%(asctime)s [%(levelname)s] %(message)s",
         handlers=[
             logging.FileHandler(log_path, encoding="utf-8"),
             logging.StreamHandler(),
@@ -87,41 +131,39 @@ def _decode_maybe_b64(s: str) -> str:
         return s
 
 
-def _write_json_file(path: str, content: str) -> None:
-    # Valida JSON minimo
-    json.loads(content)
-    tmp_path = path + ".tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        f.write(content)
-    try:
-        os.replace(tmp_path, path)
-    except Exception:
-        if os.path.exists(path):
-            os.remove(path)
-        os.rename(tmp_path, path)
+# Metriche dell'esecuzione in corso, sostituite da main(): le fasi le leggono a ogni chiamata
+METRICS = RunMetrics()
+
 
+def _token_path() -> str:
+    return SETTINGS.token_file or os.path.join(os.path.dirname(__file__), "token.json")
 
-def setup_credentials_from_ci_env() -> bool:
+
+def _client_secret_path() -> str:
+    return SETTINGS.client_secret_file or os.path.join(os.path.dirname(__file__), "client_secret.json")
+
+
+def setup_credentials_from_ci_env(env: Optional[Mapping[str, str]] = None) -> bool:
     """Scrive client_secret.json e token.json da variabili d'ambiente (es. GitHub Secrets).
     Restituisce True se ha scritto almeno un file.
     """
+    env = os.environ if env is None else env
     wrote_any = False
-    client_secret_raw = os.environ.get("CLIENT_SECRET_JSON") or os.environ.get("GOOGLE_CLIENT_SECRET_JSON")
-    token_raw = os.environ.get("TOKEN_JSON")
-    base_dir = os.path.dirname(__file__)
-    client_path = os.path.join(base_dir, "client_secret.json")
-    token_path = os.path.join(base_dir, "token.json")
+    client_secret_raw = env.get("CLIENT_SECRET_JSON") or env.get("GOOGLE_CLIENT_SECRET_JSON")
+    token_raw = env.get("TOKEN_JSON")
+    client_path = _client_secret_path()
+    token_path = _token_path()
     if client_secret_raw:
         try:
             content = _decode_maybe_b64(client_secret_raw)
-            _write_json_file(client_path, content)
+            write_json_file(client_path, content)
             wrote_any = True
         except Exception as e:
             logging.warning("Impossibile scrivere client_secret.json dai Secrets: %s", e)
     if token_raw:
         try:
             content = _decode_maybe_b64(token_raw)
-            _write_json_file(token_path, content)
+            write_json_file(token_path, content)
             wrote_any = True
         except Exception as e:
             logging.warning("Impossibile scrivere token.json dai Secrets: %s", e)
@@ -134,8 +176,7 @@ def _validate_token_file(required_scopes: List[str]) -> Optional[str]:
     """Controlla che token.json contenga un refresh_token e gli scope richiesti.
     Restituisce None se tutto ok, altrimenti una stringa con l'errore riscontrato."""
     try:
-        base_dir = os.path.dirname(__file__)
-        token_path = os.path.join(base_dir, "token.json")
+        token_path = _token_path()
         if not os.path.exists(token_path):
             return "token.json non presente"
         with open(token_path, "r", encoding="utf-8") as f:
@@ -158,8 +199,8 @@ def _validate_token_file(required_scopes: List[str]) -> Optional[str]:
 
 
 def get_credentials() -> Credentials:
-    token_path = os.path.join(os.path.dirname(__file__), "token.json")
-    client_secret_path = os.path.join(os.path.dirname(__file__), "client_secret.json")
+    token_path = _token_path()
+    client_secret_path = _client_secret_path()
 
     creds: Optional[Credentials] = None
     if os.path.exists(token_path):
@@ -186,6 +227,8 @@ def get_credentials() -> Credentials:
                     "Token OAuth non valido in ambiente CI. Fornire TOKEN_JSON con refresh_token nei Secrets."
                 )
             logging.info("Avvio flusso OAuth per ottenere un nuovo token (ambiente locale)…")
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(client_secret_path, SCOPES)
             creds = flow.run_local_server(port=0)
         # Salva token
@@ -195,40 +238,328 @@ def get_credentials() -> Credentials:
     return creds
 
 
+# Documenti discovery già letti, condivisi da tutti i build_services del processo
+_DISCOVERY_DOCS: Dict[Tuple[str, str], str] = {}
+
+
+# Sessioni aperte da build_services, chiuse a fine esecuzione
+_HTTP_SESSIONS: List = []
+_HTTP_SESSIONS_LOCK = threading.Lock()
+
+
+def _http_session(creds: Credentials):
+    """Sessione HTTP autorizzata per una coppia di servizi Gmail/Calendar, usata da un solo thread alla volta."""
+    from google.auth.transport.requests import AuthorizedSession
+
+    session = AuthorizedSession(creds)
+    with _HTTP_SESSIONS_LOCK:
+        _HTTP_SESSIONS.append(session)
+    return session
+
+
+def _close_http_session() -> None:
+    with _HTTP_SESSIONS_LOCK:
+        sessions = list(_HTTP_SESSIONS)
+        _HTTP_SESSIONS.clear()
+    with _SERVICE_POOL_LOCK:
+        # I servizi in attesa usano sessioni chiuse: non vanno più riusati
+        _SERVICE_POOL.clear()
+    for session in sessions:
+        session.close()
+
+
+class _SessionHttp:
+    """Interfaccia di httplib2.Http sopra una sessione requests condivisa da Gmail e Calendar."""
+
+    # Il corpo arriva già decompresso da requests: questi header non sono più validi
+    _DROPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+    def __init__(self, session, timeout: float = 60.0):
+        self.session = session
+        self.credentials = session.credentials
+        self.timeout = timeout
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+
+        resp = self.session.request(
+            method, uri, data=body, headers=headers, timeout=self.timeout, allow_redirects=redirections > 0
+        )
+        info = {k.lower(): v for k, v in resp.headers.items() if k.lower() not in self._DROPPED_HEADERS}
+        info["status"] = str(resp.status_code)
+        return httplib2.Response(info), resp.content
+
+    def close(self) -> None:
+        # La sessione è condivisa da Gmail e Calendar: la chiude _close_http_session() a fine esecuzione
+        pass
+
+
+def _build_service(name: str, version: str, creds: Credentials, session=None):
+    """Costruisce il servizio dal documento discovery locale (incluso nella libreria), senza rete."""
+    from googleapiclient.discovery import build, build_from_document
+    from googleapiclient import discovery_cache
+
+    auth = {"http": _SessionHttp(session)} if session is not None else {"credentials": creds}
+    doc = _DISCOVERY_DOCS.get((name, version))
+    if doc is None:
+        doc = discovery_cache.get_static_doc(name, version)
+        if doc is None:
+            return build(name, version, **auth)
+        _DISCOVERY_DOCS[(name, version)] = doc
+    return build_from_document(doc, **auth)
+
+
 def build_services(creds: Credentials):
-    gmail = build("gmail", "v1", credentials=creds)
-    calendar = build("calendar", "v3", credentials=creds)
+    """Servizi Gmail e Calendar per un thread; con HTTP_SHARED_SESSION condividono una sessione requests."""
+    session = _http_session(creds) if SETTINGS.http_shared_session else None
+    gmail = _build_service("gmail", "v1", creds, session)
+    calendar = _build_service("calendar", "v3", creds, session)
     return gmail, calendar
 
 
-def list_unread_messages(gmail, limit: Optional[int] = None) -> List[Dict]:
+# Servizi già costruiti, riusati dai thread dei cicli successivi (modalità demone)
+_SERVICE_POOL: List[Tuple] = []
+_SERVICE_POOL_LOCK = threading.Lock()
+
+
+def _acquire_services(creds: Credentials):
+    with _SERVICE_POOL_LOCK:
+        if _SERVICE_POOL:
+            return _SERVICE_POOL.pop()
+    return BACKENDS.services(creds)
+
+
+def _release_services(services) -> None:
+    with _SERVICE_POOL_LOCK:
+        _SERVICE_POOL.append(services)
+
+
+class Backends(NamedTuple):
+    """Sorgenti esterne dell'esecuzione: credenziali, servizi Google e SDK Gemini."""
+    credentials: Callable[[], Any] = get_credentials
+    services: Callable[[Any], Tuple] = build_services
+    # None = google.generativeai
+    gemini_sdk: Any = None
+
+
+BACKENDS = Backends()
+
+
+def _refresh_credentials(creds: Credentials, margin_secs: float = 300.0) -> None:
+    """Rinnova il token OAuth prima della scadenza e lo salva in token.json."""
+    expiry = getattr(creds, "expiry", None)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if creds.valid and (expiry is None or (expiry - now).total_seconds() > margin_secs):
+        return
+    if not creds.refresh_token:
+        return
+    logging.info("Token in scadenza: eseguo refresh…")
+    creds.refresh(Request())
+    try:
+        write_json_file(_token_path(), creds.to_json())
+    except Exception as e:
+        logging.warning("Salvataggio token aggiornato non riuscito: %s", e)
+
+
+# Maschere di risposta parziale (fields=): solo i campi che lo script legge davvero
+_LIST_FIELDS = "messages(id,threadId),nextPageToken"
+_MESSAGE_FIELDS = "id,threadId,labelIds,snippet,internalDate,payload"
+_METADATA_FIELDS = "id,threadId,labelIds,snippet,internalDate,payload/headers"
+_METADATA_HEADERS = ["Subject", "From", "Content-Type", "List-Unsubscribe", "List-Id", "Precedence"]
+_HISTORY_FIELDS = (
+    "history(messagesAdded/message(id,threadId,labelIds),labelsAdded/message(id,threadId,labelIds),"
+    "labelsRemoved/message(id,threadId,labelIds),messagesDeleted/message/id),historyId,nextPageToken"
+)
+
+
+def list_unread_messages(gmail, limit: Optional[int] = None, exclude=None) -> List[Dict]:
     """Restituisce fino a 'limit' messaggi non letti (i più recenti disponibili).
     Nota: l'API Gmail tipicamente restituisce i messaggi in ordine dal più recente,
     ma non è formalmente garantito. Usiamo maxResults limitato per ridurre chiamate.
+    Gli id in 'exclude' non contano nel limite; con il registro la lista si ferma
+    all'inizio della sua finestra (after:), invece di scorrere tutta la posta non letta.
     """
-    messages: List[Dict] = []
-    page_token: Optional[str] = None
-    page_size = 50
-    if limit is not None:
-        page_size = max(1, min(50, limit))
-    while True:
-        resp = (
-            gmail.users()
-            .messages()
-            .list(userId="me", q="is:unread", pageToken=page_token, maxResults=page_size)
-            .execute()
+    query = "is:unread"
+    after = exclude.window_start() if isinstance(exclude, ProcessedLedger) else None
+    if after is not None:
+        query += f" after:{int(after)}"
+    with METRICS.timer("gmail_list"):
+        messages: List[Dict] = []
+        page_token: Optional[str] = None
+        page_size = 500  # senza limite: pagine massime consentite dall'API
+        if limit is not None:
+            page_size = max(1, min(50, limit))
+            if exclude:
+                page_size = 100
+        while True:
+            resp = (
+                gmail.users()
+                .messages()
+                .list(userId="me", q=query, pageToken=page_token, maxResults=page_size, fields=_LIST_FIELDS)
+                .execute()
+            )
+            batch = resp.get("messages", [])
+            if not batch:
+                break
+            if exclude:
+                batch = [m for m in batch if m.get("id") not in exclude]
+            messages.extend(batch)
+            if limit is not None and len(messages) >= limit:
+                messages = messages[:limit]
+                break
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+        return messages
+
+
+def has_pending_work(gmail, ledger=None, sync=None) -> bool:
+    """Controllo rapido prima di caricare SDK Gemini e bs4; nel dubbio restituisce True."""
+    try:
+        if sync is not None and sync.history_id:
+            if any(ledger is None or i not in ledger for i in sync.pending):
+                return True
+            try:
+                resp = gmail.users().history().list(
+                    userId="me", startHistoryId=sync.history_id, historyTypes=["messageAdded", "labelAdded"],
+                    maxResults=1, fields="history/id",
+                ).execute()
+            except HttpError as e:
+                if getattr(e, "resp", None) is not None and e.resp.status == 404:
+                    return True
+                raise
+            return bool(resp.get("history"))
+        return bool(list_unread_messages(gmail, limit=1, exclude=ledger))
+    except Exception as e:
+        logging.info("Controllo rapido della posta non riuscito (%s): proseguo con la lettura completa", e)
+        return True
+
+
+_STARTUP_MARKS: List[Tuple[str, float]] = []
+
+
+def _startup_mark(stage: str) -> None:
+    _STARTUP_MARKS.append((stage, time.perf_counter()))
+
+
+def _log_startup_report() -> None:
+    if not _STARTUP_MARKS:
+        return
+    parts = []
+    prev = _STARTUP_T0
+    for stage, t in _STARTUP_MARKS:
+        parts.append(f"{stage} {(t - prev) * 1000:.0f} ms")
+        prev = t
+    logging.info("Tempi di avvio: %s (totale %.0f ms)", ", ".join(parts), (prev - _STARTUP_T0) * 1000)
+    _STARTUP_MARKS.clear()
+
+
+class GmailHistorySync:
+    """Posta non letta tramite users.history.list; checkpoint scaduto o assente: query completa."""
+
+    HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.history_id: Optional[str] = None
+        self.pending: List[str] = []
+        self.threads: Dict[str, str] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.history_id = data.get("historyId")
+                self.pending = [i for i in data.get("pending", []) if i]
+                self.threads = data.get("threads") or {}
+            except Exception as e:
+                logging.warning("Checkpoint Gmail illeggibile (%s): eseguo sincronizzazione completa", e)
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.threads = {i: self.threads[i] for i in self.pending if i in self.threads}
+        content = json.dumps(
+            {"historyId": self.history_id, "pending": self.pending, "threads": self.threads, "ts": int(time.time())},
+            ensure_ascii=False,
         )
-        batch = resp.get("messages", [])
-        if not batch:
-            break
-        messages.extend(batch)
-        if limit is not None and len(messages) >= limit:
-            messages = messages[:limit]
-            break
-        page_token = resp.get("nextPageToken")
-        if not page_token:
-            break
-    return messages
+        write_json_file(self.path, content)
+
+    @staticmethod
+    def _is_candidate(message: Dict) -> bool:
+        labels = message.get("labelIds") or []
+        return "UNREAD" in labels and "SPAM" not in labels and "TRASH" not in labels
+
+    def _full_resync(self, gmail, exclude=None) -> None:
+        # historyId letto PRIMA della lista: le modifiche concorrenti arriveranno col delta successivo
+        profile = gmail.users().getProfile(userId="me", fields="historyId").execute()
+        messages = list_unread_messages(gmail, limit=None, exclude=exclude)
+        self.pending = [m["id"] for m in messages if m.get("id")]
+        self.threads = {m["id"]: m["threadId"] for m in messages if m.get("id") and m.get("threadId")}
+        self.history_id = profile.get("historyId")
+        logging.info("Sincronizzazione completa: %d email non lette, historyId=%s", len(self.pending), self.history_id)
+
+    def _apply_history(self, gmail) -> bool:
+        """Applica il delta dal checkpoint. Restituisce False se il checkpoint è scaduto."""
+        # Ordine interno: dal più vecchio al più recente (i nuovi arrivi in coda)
+        state = dict.fromkeys(reversed(self.pending))
+        latest = self.history_id
+        changes = 0
+        page_token: Optional[str] = None
+        try:
+            while True:
+                resp = (
+                    gmail.users()
+                    .history()
+                    .list(
+                        userId="me",
+                        startHistoryId=self.history_id,
+                        historyTypes=self.HISTORY_TYPES,
+                        pageToken=page_token,
+                        maxResults=500,
+                        fields=_HISTORY_FIELDS,
+                    )
+                    .execute()
+                )
+                for record in resp.get("history", []):
+                    for key in ("messagesAdded", "labelsAdded", "labelsRemoved"):
+                        for item in record.get(key, []):
+                            message = item.get("message", {})
+                            msg_id = message.get("id")
+                            if not msg_id:
+                                continue
+                            changes += 1
+                            if message.get("threadId"):
+                                self.threads[msg_id] = message["threadId"]
+                            if self._is_candidate(message):
+                                state.setdefault(msg_id, None)
+                            else:
+                                state.pop(msg_id, None)
+                    for item in record.get("messagesDeleted", []):
+                        changes += 1
+                        state.pop(item.get("message", {}).get("id"), None)
+                latest = resp.get("historyId") or latest
+                page_token = resp.get("nextPageToken")
+                if not page_token:
+                    break
+        except HttpError as e:
+            if getattr(e, "resp", None) is not None and e.resp.status == 404:
+                logging.info("Checkpoint historyId %s scaduto: torno alla query completa", self.history_id)
+                return False
+            raise
+        self.pending = list(reversed(list(state)))
+        self.history_id = latest
+        logging.info("Sincronizzazione incrementale: %d modifiche, %d email non lette in coda", changes, len(self.pending))
+        return True
+
+    def list_candidates(self, gmail, limit: Optional[int] = None, exclude=None) -> List[Dict]:
+        """Restituisce fino a 'limit' messaggi non letti ancora da decidere, come list_unread_messages."""
+        with METRICS.timer("gmail_history"):
+            if not self.history_id or not self._apply_history(gmail):
+                self._full_resync(gmail, exclude)
+            if exclude:
+                self.pending = [i for i in self.pending if i not in exclude]
+            self._save()
+            ids = self.pending if limit is None else self.pending[:limit]
+            return [{"id": i, "threadId": self.threads.get(i)} for i in ids]
 
 
 def _decode_b64url(data: str) -> str:
@@ -238,40 +569,447 @@ def _decode_b64url(data: str) -> str:
         return ""
 
 
-def _extract_text_from_payload(payload: Dict) -> str:
-    # Prova a leggere direttamente il body
-    body = payload.get("body", {})
-    data = body.get("data")
-    mime = payload.get("mimeType", "")
+# Sotto questa lunghezza il testo nuovo non basta: la citazione viene mantenuta
+_MIN_OWN_TEXT = 40
+
+
+def _html_to_text(raw: str, max_chars: Optional[int] = None) -> str:
+    # Il markup è molto più lungo del testo: taglia l'HTML prima di analizzarlo
+    if max_chars:
+        raw = raw[:max_chars * 8]
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(raw, "html.parser")
+    for tag in soup(["script", "style", "head"]):
+        tag.decompose()
+    for tag in soup.select("div.gmail_signature"):
+        tag.decompose()
+    quotes = soup.select("blockquote, div.gmail_quote, div.moz-cite-prefix, #appendonsend, #divRplyFwdMsg")
+    if not quotes or SETTINGS.body_cleanup is False:
+        return soup.get_text("\n", strip=True)
+    full = soup.get_text("\n", strip=True)
+    for tag in quotes:
+        tag.decompose()
+    own = soup.get_text("\n", strip=True)
+    # Risposta troppo breve: la citazione contiene le informazioni utili
+    return own if len(own) >= _MIN_OWN_TEXT else full
+
+
+# Caratteri minimi perché la parte text/plain sia preferita all'HTML
+# (i segnaposto tipo "visualizza questa email nel browser" sono più corti)
+_MIN_PLAIN_ALTERNATIVE = 40
+
+
+def _best_alternative(parts: List[Dict]) -> Optional[Dict]:
+    """Sceglie una sola parte di un multipart/alternative (preferisce text/plain)."""
+    plain = next((p for p in parts if p.get("mimeType", "").lower() == "text/plain" and p.get("body", {}).get("data")), None)
+    rich = next(
+        (p for p in parts if p.get("mimeType", "").lower() == "text/html" or p.get("mimeType", "").lower().startswith("multipart/")),
+        None,
+    )
+    if plain is not None:
+        # Alcuni mittenti mettono in text/plain solo "visualizza in HTML": in quel caso usa l'HTML
+        if rich is None or len(_decode_b64url(plain["body"]["data"]).strip()) >= _MIN_PLAIN_ALTERNATIVE:
+            return plain
+    return rich or plain or (parts[0] if parts else None)
+
+
+def _collect_text(part: Dict, out: List[str], state: Dict) -> None:
+    remaining = state.get("remaining")
+    if remaining is not None and remaining <= 0:
+        return
+    mime = part.get("mimeType", "").lower()
+    # Gli allegati (con nome file) non fanno parte del testo dell'email
+    if part.get("filename") and not mime.startswith("multipart/"):
+        return
+    # Gli inviti iCalendar vengono letti a parte (percorso rapido senza Gemini)
+    if SETTINGS.ics_fast_path and is_calendar_part(part):
+        return
+    data = part.get("body", {}).get("data")
     if data:
         raw = _decode_b64url(data)
-        if "html" in mime:
-            soup = BeautifulSoup(raw, "html.parser")
-            return soup.get_text("\n", strip=True)
-        return raw
+        text = _html_to_text(raw, remaining) if "html" in mime else raw
+        if remaining is not None:
+            text = text[:remaining]
+            state["remaining"] = remaining - len(text)
+        out.append(text)
+        return
 
-    # Altrimenti naviga le parti
-    parts = payload.get("parts", [])
-    texts = []
-    for part in parts:
-        texts.append(_extract_text_from_payload(part))
-    return "\n".join([t for t in texts if t])
+    parts = part.get("parts", [])
+    if mime == "multipart/alternative" and parts:
+        best = _best_alternative(parts)
+        if best is not None:
+            _collect_text(best, out, state)
+        return
+    for sub in parts:
+        _collect_text(sub, out, state)
 
 
-def get_email_subject_and_body(gmail, msg_id: str) -> Tuple[str, str]:
-    msg = gmail.users().messages().get(userId="me", id=msg_id, format="full").execute()
+_REPLY_MARKERS = [
+    re.compile(r"^[ \t]*(?:Il giorno|On)\b[^\n]*(?:\n[^\n]*){0,2}?(?:ha scritto|wrote)\s*:[ \t]*$", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^[ \t]*-{2,}\s*(?:Original Message|Messaggio originale)\s*-{2,}", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^[ \t]*(?:Da|From)\s*:[^\n]*\n[ \t]*(?:Inviato|Sent|Data|Date)\s*:", re.MULTILINE | re.IGNORECASE),
+]
+_FORWARD_HEADER = re.compile(
+    r"^[ \t]*-{2,}\s*(?:Forwarded message|Messaggio inoltrato|Inizio messaggio inoltrato)\s*-{2,}[^\n]*\n"
+    r"(?:[ \t]*(?:Da|From|Data|Date|Oggetto|Subject|A|To|Cc|Inviato|Sent)\s*:[^\n]*\n)*",
+    re.MULTILINE | re.IGNORECASE,
+)
+_SIGNATURE_LINE = re.compile(
+    r"^[ \t]*(?:Inviato da(?:l mio)?|Sent from my|Get Outlook for|Scarica Outlook per)\b.*$",
+    re.MULTILINE | re.IGNORECASE,
+)
+_DISCLAIMER = re.compile(
+    r"(?:questo messaggio|questa e-?mail|la presente (?:e-?mail|comunicazione)|this (?:e-?mail|message)|the information contained)"
+    r"[\s\S]{0,300}?(?:riservat|confidential|destinatari|intended recipient|privileged)"
+    r"|D\.?\s?Lgs\.?\s*(?:n\.?\s*)?196|Regolamento\s*\(?UE\)?\s*2016/679|\bGDPR\b"
+    r"|annulla(?:re)? l'iscrizione|disiscriviti|\bunsubscribe\b",
+    re.IGNORECASE,
+)
+
+
+def _strip_quoted_and_boilerplate(text: str) -> str:
+    """Rimuove catene di risposte citate, intestazioni di inoltro, firme e disclaimer."""
+    if not text:
+        return text
+    text = text.replace("\r\n", "\n")
+    # Inoltro: il contenuto inoltrato è quello utile, si tolgono solo le intestazioni
+    text = _FORWARD_HEADER.sub("", text)
+
+    cut = len(text)
+    for marker in _REPLY_MARKERS:
+        m = marker.search(text)
+        if m and len(text[:m.start()].strip()) >= _MIN_OWN_TEXT:
+            cut = min(cut, m.start())
+    text = text[:cut]
+
+    unquoted = "\n".join(line for line in text.split("\n") if not line.lstrip().startswith(">"))
+    own = unquoted
+    for marker in _REPLY_MARKERS:
+        own = marker.sub("", own)
+    if len(own.strip()) >= _MIN_OWN_TEXT:
+        text = unquoted
+
+    sig = re.search(r"^--[ \t]?$", text, re.MULTILINE)
+    if sig and len(text[:sig.start()].strip()) >= _MIN_OWN_TEXT:
+        text = text[:sig.start()]
+    text = _SIGNATURE_LINE.sub("", text)
+
+    # Disclaimer e link di disiscrizione solo in coda (piè di pagina): nel corpo restano
+    paragraphs = re.split(r"\n[ \t]*\n", text.rstrip())
+    while len(paragraphs) > 1 and _DISCLAIMER.search(paragraphs[-1]):
+        paragraphs.pop()
+    text = "\n\n".join(paragraphs)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def _extract_text_from_payload(payload: Dict, max_chars: Optional[int] = None) -> str:
+    """Testo dell'email per Gemini: una sola alternativa, al più 'max_chars' caratteri, ripulito."""
+    with METRICS.timer("estrazione_testo"):
+        if max_chars is None:
+            max_chars = SETTINGS.body_max_chars
+        texts: List[str] = []
+        _collect_text(payload, texts, {"remaining": max_chars or None})
+        text = "\n".join([t for t in texts if t])
+        if SETTINGS.body_cleanup is not False:
+            text = _strip_quoted_and_boilerplate(text)
+        return text
+
+
+# ---------------------------------------------------------------------------
+# Inviti iCalendar (text/calendar, allegati .ics): eventi letti senza Gemini
+# ---------------------------------------------------------------------------
+
+
+def _load_calendar_events(gmail, msg: Dict) -> Optional[List[Dict]]:
+    """Eventi degli inviti iCalendar del messaggio; None se non ne contiene."""
+    parts = calendar_parts(msg.get("payload", {}))
+    if not parts:
+        return None
+    inline = [p for p in parts if p.get("body", {}).get("data")]
+    attached = [p for p in parts if not p.get("body", {}).get("data") and p.get("body", {}).get("attachmentId")]
+    methods: List[str] = []
+    events: List[Dict] = []
+    for group in (inline, attached):
+        for part in group:
+            data = part.get("body", {}).get("data")
+            if data is None and gmail is not None:
+                try:
+                    att = gmail.users().messages().attachments().get(
+                        userId="me", messageId=msg.get("id"), id=part["body"]["attachmentId"], fields="data"
+                    ).execute()
+                    data = att.get("data")
+                except Exception as e:
+                    logging.warning("Impossibile scaricare l'allegato .ics dell'email %s: %s", msg.get("id"), e)
+            if not data:
+                continue
+            method, found = parse_ics(_decode_b64url(data), _ensure_timezone())
+            if method:
+                methods.append(method)
+            events.extend(found)
+        if events or methods:
+            break
+    if not events and not methods:
+        return None
+    # Risposte (REPLY) e annullamenti (CANCEL) non creano eventi
+    if any(m in ("REPLY", "CANCEL", "COUNTER", "DECLINECOUNTER") for m in methods):
+        logging.info("Invito calendario %s nell'email %s: nessun evento da creare", "/".join(sorted(set(methods))), msg.get("id"))
+        return []
+    # Stesso UID in più parti (testo in linea e allegato .ics): un solo evento
+    unique: Dict[str, Dict] = {}
+    for event in events:
+        unique.setdefault(event.get("uid") or f"#{len(unique)}", event)
+    return list(unique.values())[:MAX_ICS_EVENTS]
 
+
+def _header(headers: List[Dict], name: str) -> Optional[str]:
+    lname = name.lower()
+    return next((h.get("value") for h in headers if str(h.get("name", "")).lower() == lname), None)
+
+
+def _record_from_message(msg: Dict, gmail=None) -> EmailRecord:
     headers = msg.get("payload", {}).get("headers", [])
     subject = next((h["value"] for h in headers if h.get("name") == "Subject"), "(senza oggetto)")
+    meta = {
+        "from": _header(headers, "From") or "",
+        "labels": list(msg.get("labelIds") or []),
+        "date": msg.get("internalDate"),
+    }
     
     # Log dell'oggetto per debug
     logging.info("Elaborazione email con oggetto: %s", subject)
 
+    events = _load_calendar_events(gmail, msg) if SETTINGS.ics_fast_path and msg.get("id") else None
+
     text = _extract_text_from_payload(msg.get("payload", {}))
     if not text:
         # fallback: prova snippet
         text = msg.get("snippet", "")
-    return subject, text
+    return EmailRecord(msg.get("id", ""), subject, text, meta, events)
+
+
+def get_email_record(gmail, msg_id: str) -> EmailRecord:
+    with METRICS.timer("gmail_get"):
+        msg = gmail.users().messages().get(userId="me", id=msg_id, format="full", fields=_MESSAGE_FIELDS).execute()
+        return _record_from_message(msg, gmail)
+
+
+def _calendar_decision(record: EmailRecord, ledger: Optional[ProcessedLedger] = None) -> Tuple[bool, Optional[Dict]]:
+    """Percorso rapido per gli inviti: (gestita, decisione) senza chiamare Gemini."""
+    msg_id, subject, body = record[:3]
+    if record.calendar_events is None:
+        return False, None
+    events = [dict(event) for event in record.calendar_events]
+    content_hash = ProcessedLedger.content_hash(subject, body) if ledger is not None else None
+    if not events:
+        METRICS.incr("inviti_calendario", esito="nessun_evento")
+        if ledger is not None:
+            _record_decision(ledger, msg_id, content_hash, "nessun_evento", record.sender, record.siblings)
+        return True, None
+    logging.info("Invito calendario nell'email %s: %d eventi letti dal file .ics, Gemini non necessario", msg_id, len(events))
+    METRICS.incr("inviti_calendario", esito="evento")
+    for event in events:
+        if not event.get("descrizione"):
+            event["descrizione"] = f"Generato automaticamente da invito con oggetto: {subject}"
+    return True, dict(events[0], eventi=events, hash=content_hash, mittente=record.sender, conversazione=list(record.siblings))
+
+
+_RETRYABLE_HTTP_STATUS = (429, 500, 502, 503, 504)
+
+
+def _execute_batch(service, requests: Dict[str, object], max_retries: int = 3, what: str = "richiesta") -> Dict[str, Dict]:
+    """Esegue le richieste in un'unica BatchHttpRequest, ritentando quelle fallite con 429/5xx.
+    Restituisce {id: risposta} per i soli elementi riusciti.
+    """
+    pending = list(requests)
+    results: Dict[str, Dict] = {}
+    attempt = 0
+    while pending:
+        retry: List[str] = []
+
+        def _callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+                return
+            status = getattr(getattr(exception, "resp", None), "status", None)
+            if status is not None and int(status) in _RETRYABLE_HTTP_STATUS and attempt < max_retries:
+                retry.append(request_id)
+            else:
+                logging.error("Errore %s %s: %s", what, request_id, exception)
+
+        batch = service.new_batch_http_request(callback=_callback)
+        for request_id in pending:
+            batch.add(requests[request_id](), request_id=request_id)
+        try:
+            with METRICS.timer("batch_http", what=what):
+                batch.execute()
+        except Exception as e:
+            if attempt >= max_retries:
+                logging.error("Richiesta batch fallita (%s, %d elementi saltati): %s", what, len(pending), e)
+                break
+            logging.warning("Richiesta batch fallita (%s), ritento: %s", what, e)
+            retry = [i for i in pending if i not in results]
+
+        pending = retry
+        if pending:
+            attempt += 1
+            delay = min(30.0, 2 ** attempt)
+            logging.warning("%d elementi da ritentare (%s, tentativo %d), attendo %.0fs", len(pending), what, attempt, delay)
+            time.sleep(delay)
+    return results
+
+
+def fetch_messages_batch(gmail, msg_ids: List[str], batch_size: int = 50, max_retries: int = 3):
+    """Scarica i messaggi a gruppi con BatchHttpRequest e produce un EmailRecord per messaggio."""
+    batch_size = max(1, min(100, batch_size))
+    for start in range(0, len(msg_ids), batch_size):
+        chunk = list(msg_ids[start:start + batch_size])
+        requests = {
+            msg_id: (lambda msg_id=msg_id: gmail.users().messages().get(
+                userId="me", id=msg_id, format="full", fields=_MESSAGE_FIELDS
+            ))
+            for msg_id in chunk
+        }
+        results = _execute_batch(gmail, requests, max_retries, what="scaricando email")
+        for msg_id in chunk:
+            if msg_id in results:
+                yield _record_from_message(results[msg_id], gmail)
+
+
+def fetch_metadata(gmail, msg_ids: List[str], batch_size: int = 50, max_retries: int = 3) -> Dict[str, Dict]:
+    """Scarica i metadati (intestazioni, etichette, snippet, data) a gruppi con BatchHttpRequest."""
+    batch_size = max(1, min(100, batch_size))
+    results: Dict[str, Dict] = {}
+    for start in range(0, len(msg_ids), batch_size):
+        chunk = list(msg_ids[start:start + batch_size])
+        requests = {
+            msg_id: (lambda msg_id=msg_id: gmail.users().messages().get(
+                userId="me", id=msg_id, format="metadata", metadataHeaders=_METADATA_HEADERS, fields=_METADATA_FIELDS
+            ))
+            for msg_id in chunk
+        }
+        with METRICS.timer("gmail_metadata"):
+            results.update(_execute_batch(gmail, requests, max_retries, what="leggendo intestazioni"))
+    return results
+
+
+def _bulk_reason(headers: List[Dict]) -> Optional[str]:
+    """Motivo per cui l'email è una newsletter o un invio di massa (intestazioni List-*/Precedence), o None."""
+    if _header(headers, "List-Unsubscribe"):
+        return "newsletter (List-Unsubscribe)"
+    if _header(headers, "List-Id"):
+        return "lista di distribuzione (List-Id)"
+    precedence = (_header(headers, "Precedence") or "").strip().lower()
+    if precedence in ("bulk", "list", "junk"):
+        return f"invio di massa (Precedence: {precedence})"
+    return None
+
+
+def prescreen_messages(
+    gmail, msg_ids: List[str], ledger: Optional[ProcessedLedger] = None, thread_of: Optional[Dict[str, str]] = None,
+    batch_size: int = 50, max_retries: int = 3, metadata: Optional[Dict[str, Dict]] = None,
+) -> List[str]:
+    """Pre-selezione sui metadati: restituisce gli id da scaricare per intero.
+    Scarta solo mittenti/etichette esclusi e newsletter; un thread solo se lo sono tutte le sue email.
+    'metadata' evita di riscaricare i metadati già letti per l'ordine di priorità.
+    """
+    if PREFILTER is None or not msg_ids:
+        return list(msg_ids)
+
+    if metadata is None:
+        metadata = fetch_metadata(gmail, msg_ids, batch_size, max_retries)
+    skipped: Dict[str, str] = {}
+    for msg_id in msg_ids:
+        msg = metadata.get(msg_id)
+        if msg is None:
+            continue
+        headers = msg.get("payload", {}).get("headers", [])
+        content_type = (_header(headers, "Content-Type") or "").lower()
+        if SETTINGS.ics_fast_path and content_type.startswith(("multipart/mixed", "text/calendar")):
+            continue
+        verdict, reason = PREFILTER.list_verdict({"from": _header(headers, "From") or "", "labels": msg.get("labelIds") or []})
+        if verdict is None:
+            reason = _bulk_reason(headers)
+        if verdict is False or (verdict is None and reason):
+            skipped[msg_id] = reason
+
+    threads: Dict[str, List[str]] = {}
+    for msg_id in msg_ids:
+        threads.setdefault((thread_of or {}).get(msg_id) or msg_id, []).append(msg_id)
+    dropped = set()
+    for ids in threads.values():
+        if all(i in skipped for i in ids):
+            dropped.update(ids)
+    for msg_id in msg_ids:
+        if msg_id not in dropped:
+            continue
+        logging.info("Pre-selezione: email %s non scaricata - %s", msg_id, skipped[msg_id])
+        METRICS.incr("email_preselezione_scartate")
+        if ledger is not None:
+            _record_decision(ledger, msg_id, None, "scartata_prefiltro")
+    if dropped:
+        logging.info("Pre-selezione: %d email su %d da scaricare per intero", len(msg_ids) - len(dropped), len(msg_ids))
+    return [i for i in msg_ids if i not in dropped]
+
+
+def rank_by_metadata(msg_ids: List[str], metadata: Dict[str, Dict],
+                     thread_of: Optional[Dict[str, str]] = None) -> List[Tuple[float, str]]:
+    """Coppie (punteggio, id) in ordine di priorità calcolato sui metadati, prima del download completo.
+    Una conversazione resta unita e prende il punteggio della sua email migliore.
+    """
+    records = []
+    for msg_id in msg_ids:
+        msg = metadata.get(msg_id) or {}
+        headers = msg.get("payload", {}).get("headers", [])
+        meta = {"from": _header(headers, "From") or "", "labels": list(msg.get("labelIds") or []), "date": msg.get("internalDate")}
+        records.append(EmailRecord(msg_id, _header(headers, "Subject") or "", msg.get("snippet", ""), meta if msg else None))
+    scores = {record.msg_id: score for score, record in SCHEDULER.rank(records)}
+    threads: Dict[str, List[str]] = {}
+    for msg_id in msg_ids:
+        if msg_id in scores:
+            threads.setdefault((thread_of or {}).get(msg_id) or msg_id, []).append(msg_id)
+    ranked = []
+    for ids in threads.values():
+        best = max(scores[i] for i in ids)
+        ranked.extend((best, i) for i in ids)
+    # Ordinamento stabile: a parità di punteggio resta l'ordine di Gmail
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
+
+
+def _fetch_messages_sequential(gmail, msg_ids: List[str]):
+    for msg_id in msg_ids:
+        try:
+            record = get_email_record(gmail, msg_id)
+        except Exception as e:
+            logging.exception("Errore scaricando email %s: %s", msg_id, e)
+            continue
+        yield record
+
+
+def _json_block(text: str, start: int) -> Optional[str]:
+    """Blocco JSON da 'start' alla parentesi che lo chiude (quelle dentro le stringhe non contano)."""
+    closers: List[str] = []
+    in_string = escaped = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers:
+            if ch != closers.pop():
+                return None
+            if not closers:
+                return text[start:pos + 1]
+    return None
 
 
 def _try_parse_json(text: str) -> Optional[Dict]:
@@ -282,143 +1020,301 @@ def _try_parse_json(text: str) -> Optional[Dict]:
     except Exception:
         pass
 
-    # Estrazione best-effort del primo blocco JSON
-    import re
+    # Estrazione best-effort del primo blocco JSON bilanciato
+    obj_start = text.find("{")
+    arr_start = text.find("[")
+    # Risposta multi-email: array JSON (eventualmente racchiuso in testo/backtick)
+    if arr_start != -1 and (obj_start == -1 or arr_start < obj_start):
+        block = _json_block(text, arr_start)
+        if block is not None:
+            try:
+                return json.loads(block)
+            except Exception:
+                pass
 
-    m = re.search(r"\{[\s\S]*\}", text)
-    if m:
-        candidate = m.group(0)
-        try:
-            return json.loads(candidate)
-        except Exception:
-            return None
+    if obj_start != -1:
+        block = _json_block(text, obj_start)
+        if block is not None:
+            try:
+                return json.loads(block)
+            except Exception:
+                return None
     return None
 
 
-def call_gemini_api(prompt: str, model: str = None) -> Optional[Dict]:
-    """Usa google-generativeai SDK per analizzare il prompt."""
-    if model is None:
-        model = MODEL or "gemini-2.5-pro"
-    # Prova prima con il modello pro, poi fallback a flash se fallisce
-    tried_models = [model]
-    if model == "gemini-2.5-pro":
-        tried_models.append("gemini-2.5-flash")
-    for m in tried_models:
-        try:
-            import google.generativeai as genai
-        except Exception as e:
-            logging.error("SDK Gemini non disponibile: %s", e)
-            return None
+# Eventi accettati al massimo da una singola email in modalità strutturata
+_MAX_EVENTS_PER_EMAIL = 5
 
-        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            logging.error("API key Gemini mancante.")
-            return None
+_EVENT_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "titolo": {"type": "string", "description": "Titolo breve e descrittivo"},
+        "descrizione": {"type": "string", "description": "Breve descrizione (max 200 caratteri)"},
+        "data": {"type": "string", "description": "Data GG-MM-AAAA", "nullable": True},
+        "ora_inizio": {"type": "string", "description": "Orario 24h HH:MM in ora italiana", "nullable": True},
+        "ora_fine": {"type": "string", "description": "Orario 24h HH:MM di fine", "nullable": True},
+        "luogo": {"type": "string", "description": "Luogo dell'evento", "nullable": True},
+    },
+    "required": ["titolo", "data"],
+}
 
-        try:
-            genai.configure(api_key=api_key)
-            mdl = genai.GenerativeModel(m)
-            resp = mdl.generate_content(prompt)
-            text = getattr(resp, "text", None) or ""
-            data = _try_parse_json(text)
-            if data is not None:
-                logging.info(f"Risposta Gemini ottenuta con modello: {m}")
-                return data
-        except Exception as e:
-            msg = str(e)
-            if "model not found" in msg.lower() or "not available" in msg.lower() or "404" in msg:
-                logging.warning(f"Modello Gemini non disponibile: {m}, provo fallback se possibile...")
-                continue
-            # Riconosciamo rate limiting (429) e stimiamo retry
-            if "429" in msg or "quota" in msg.lower() or "rate" in msg.lower():
-                retry = None
-                m_retry = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)\s*\}", msg)
-                if m_retry:
-                    try:
-                        retry = int(m_retry.group(1))
-                    except Exception:
-                        retry = None
-                logging.error("Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Interrompo il batch.", retry)
-                raise RateLimitExceeded("Quota Gemini esaurita o rate limit raggiunto", retry_after_seconds=retry)
-            logging.error("Errore chiamando Gemini API con modello %s: %s", m, msg)
-            return None
-    return None
-        
+
+def _response_schema(batch: bool = False) -> Optional[Dict]:
+    """Schema della risposta per l'output strutturato di Gemini (None se la modalità è disattiva)."""
+    if not SETTINGS.structured_output:
+        return None
+    properties = {
+        "creare_evento": {"type": "string", "description": "si oppure no"},
+        "eventi": {"type": "array", "items": _EVENT_ITEM_SCHEMA},
+    }
+    required = ["creare_evento", "eventi"]
+    if SETTINGS.cascade_mode:
+        properties["confidenza"] = {"type": "number", "description": "Sicurezza della decisione, da 0 a 1"}
+        required.append("confidenza")
+    if batch:
+        properties = dict(id={"type": "string", "description": "Identificativo dell'email, es. E1"}, **properties)
+        required = ["id"] + required
+        return {"type": "array", "items": {"type": "object", "properties": properties, "required": required}}
+    return {"type": "object", "properties": properties, "required": required}
+
+
+def _repair_json(text: str) -> Optional[object]:
+    """Riparazione minima di una risposta JSON: backtick, virgole finali, chiusure mancanti."""
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = re.sub(r"^```[a-zA-Z]*\s*", "", text)
+        text = re.sub(r"\s*```$", "", text)
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    # Risposta troncata: chiude stringhe e parentesi rimaste aperte
+    closers: List[str] = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers:
+            closers.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r",\s*$", "", text) + "".join(reversed(closers))
     try:
-        import google.generativeai as genai
-    except Exception as e:
-        logging.error("SDK Gemini non disponibile: %s", e)
+        return json.loads(text)
+    except Exception:
         return None
 
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        logging.error("API key Gemini mancante.")
-        return None
 
+_SCHEMA_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+}
+
+
+def _schema_errors(data, schema: Dict, path: str = "$") -> List[str]:
+    """Validazione in un solo passaggio (sottoinsieme OpenAPI usato da Gemini): elenco degli errori."""
+    if data is None:
+        return [] if schema.get("nullable") else [f"{path}: valore mancante"]
+    expected = _SCHEMA_TYPES.get(schema.get("type", ""))
+    if expected is not None and (not isinstance(data, expected) or (expected is not bool and isinstance(data, bool))):
+        return [f"{path}: atteso {schema.get('type')}"]
+    errors: List[str] = []
+    if isinstance(data, dict):
+        for name in schema.get("required", []):
+            if name not in data:
+                errors.append(f"{path}.{name}: campo obbligatorio mancante")
+        for name, sub in (schema.get("properties") or {}).items():
+            if name in data:
+                errors.extend(_schema_errors(data[name], sub, f"{path}.{name}"))
+    elif isinstance(data, list) and schema.get("items"):
+        for i, item in enumerate(data):
+            errors.extend(_schema_errors(item, schema["items"], f"{path}[{i}]"))
+    return errors
+
+
+def _parse_structured(text: str, schema: Dict):
+    """Interpreta e valida una risposta strutturata; None se non conforme allo schema."""
     try:
-        genai.configure(api_key=api_key)
-        mdl = genai.GenerativeModel(model)
-        resp = mdl.generate_content(prompt)
-        text = getattr(resp, "text", None) or ""
-        data = _try_parse_json(text)
-        return data
-    except Exception as e:
-        msg = str(e)
-        # Riconosciamo rate limiting (429) e stimiamo retry
-        if "429" in msg or "quota" in msg.lower() or "rate" in msg.lower():
-            retry = None
-            m = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)\s*\}", msg)
-            if m:
-                try:
-                    retry = int(m.group(1))
-                except Exception:
-                    retry = None
-            logging.error("Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Interrompo il batch.", retry)
-            raise RateLimitExceeded("Quota Gemini esaurita o rate limit raggiunto", retry_after_seconds=retry)
-        logging.error("Errore chiamando Gemini API: %s", msg)
+        data = json.loads(text)
+    except Exception:
+        data = _repair_json(text)
+        if data is None:
+            return None
+        logging.info("Risposta Gemini riparata (JSON non valido in origine)")
+    if schema.get("type") == "array" and isinstance(data, dict):
+        data = [data]
+    errors = _schema_errors(data, schema)
+    if errors:
+        logging.warning("Risposta Gemini non conforme allo schema: %s", "; ".join(errors[:5]))
         return None
+    return _flatten_structured(data)
+
+
+def _flatten_structured(data):
+    """Aggiunge i campi piatti del primo evento (titolo, data, ...) usati dal resto della pipeline."""
+    if isinstance(data, list):
+        return [_flatten_structured(item) for item in data]
+    events = [e for e in data.get("eventi") or [] if isinstance(e, dict)][:_MAX_EVENTS_PER_EMAIL]
+    flat = dict(data, eventi=events)
+    if events:
+        for field in ("titolo", "descrizione", "data", "ora_inizio"):
+            flat.setdefault(field, events[0].get(field))
+    return flat
+
+
+def _parse_retry_after(msg: str) -> Optional[int]:
+    """Estrae il ritardo suggerito da un errore 429 di Gemini (se presente)."""
+    for pattern in (r"retry_delay\s*\{\s*seconds:\s*(\d+)", r"retry in\s*([\d.]+)\s*s"):
+        m_retry = re.search(pattern, msg, re.IGNORECASE)
+        if m_retry:
+            try:
+                return int(float(m_retry.group(1)) + 0.999)
+            except Exception:
+                return None
+    return None
 
 
-def parse_event_decision(data: Dict) -> Tuple[bool, str, Optional[str], Optional[str], str]:
-    # Normalizza chiavi/valori
-    creare = str(data.get("creare_evento", "no")).strip().lower()
-    titolo = str(data.get("titolo", "")).strip() or "Evento"
-    data_str = data.get("data")
-    ora_inizio = data.get("ora_inizio")
-    descrizione = str(data.get("descrizione", "")).strip()
-
-    if data_str:
-        data_str = str(data_str).strip()
-    if ora_inizio:
-        ora_inizio = str(ora_inizio).strip()
-
-    return (
-        creare == "si",
-        titolo,
-        data_str if data_str and data_str.lower() != "null" else None,
-        ora_inizio if ora_inizio and ora_inizio.lower() != "null" else None,
-        descrizione,
-    )
+def _gemini_client_options(env: Optional[Mapping[str, str]] = None) -> Dict:
+    """Opzioni del client Gemini lette dall'ambiente: cache di contesto e conteggio dei token."""
+    return {
+        "context_cache": env_bool("GEMINI_CONTEXT_CACHE", False, env),
+        "cache_ttl_secs": max(60.0, env_float("GEMINI_CACHE_TTL_SECS", 900.0, env)),
+        "cache_min_tokens": env_int("GEMINI_CACHE_MIN_TOKENS", 1024, env),
+        "count_tokens": env_bool("GEMINI_COUNT_TOKENS", False, env),
+    }
 
 
-def _normalize_date(date_str: str) -> str:
-    """Accetta 'YYYY-MM-DD' o 'DD-MM-YYYY' (anche con '/') e restituisce 'YYYY-MM-DD'."""
-    date_str = date_str.strip()
-    # Sostituisci / con -
-    date_str = date_str.replace("/", "-")
-    # Prova ISO
-    try:
-        d = datetime.strptime(date_str, "%Y-%m-%d").date()
-        return d.isoformat()
-    except ValueError:
-        pass
-    # Prova DD-MM-YYYY
-    try:
-        d = datetime.strptime(date_str, "%d-%m-%Y").date()
-        return d.isoformat()
-    except ValueError:
-        pass
-    raise ValueError(f"Formato data non riconosciuto: {date_str}")
+def _get_gemini_client() -> Optional[GeminiClient]:
+    """Restituisce il client condiviso, creandolo alla prima chiamata."""
+    global GEMINI_CLIENT
+    if GEMINI_CLIENT is not None:
+        return GEMINI_CLIENT
+    with _GEMINI_CLIENT_LOCK:
+        if GEMINI_CLIENT is None:
+            api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+            if not api_key:
+                logging.error("API key Gemini mancante.")
+                return None
+            try:
+                GEMINI_CLIENT = GeminiClient(api_key, sdk=BACKENDS.gemini_sdk, metrics=METRICS, **_gemini_client_options())
+            except Exception as e:
+                logging.error("SDK Gemini non disponibile: %s", e)
+                return None
+    return GEMINI_CLIENT
+
+
+def call_gemini_api(
+    prompt: str,
+    model: str = None,
+    fallback: bool = True,
+    schema: Optional[Dict] = None,
+    system_instruction: Optional[str] = None,
+) -> Optional[Dict]:
+    """Usa google-generativeai SDK per analizzare il prompt (con 'schema': output strutturato)."""
+    if model is None:
+        model = MODEL or "gemini-2.5-pro"
+    # Prova prima con il modello pro, poi fallback a flash se fallisce
+    tried_models = [model]
+    if fallback and model == "gemini-2.5-pro":
+        tried_models.append("gemini-2.5-flash")
+    client = _get_gemini_client()
+    if client is None:
+        return None
+    limiter = RATE_LIMITER
+    est_tokens = estimate_tokens(prompt) + (estimate_tokens(system_instruction) if system_instruction else 0)
+    generation_config = None
+    if schema is not None:
+        generation_config = {"response_mime_type": "application/json", "response_schema": schema}
+    rate_limited: List[float] = []
+    for i, m in enumerate(tried_models):
+        if i:
+            METRICS.incr("gemini_fallback", model=m)
+        blocked = client.blocked(m)
+        if blocked is not None:
+            logging.info("Modello Gemini %s escluso dal circuit breaker (%s), uso il successivo", m, blocked.get("reason"))
+            if blocked.get("reason") == "quota esaurita":
+                rate_limited.append(max(0.0, float(blocked["until"]) - time.time()))
+            continue
+        attempts = 0
+        while True:
+            if limiter is not None and not limiter.acquire(m, est_tokens):
+                logging.warning("Budget Gemini esaurito per %s, provo il modello successivo se possibile...", m)
+                rate_limited.append(limiter.max_wait)
+                break
+            try:
+                t0 = time.perf_counter()
+                try:
+                    resp = client.generate(m, prompt, generation_config, system_instruction)
+                finally:
+                    METRICS.observe("gemini_request", time.perf_counter() - t0, model=m)
+                usage = getattr(resp, "usage_metadata", None)
+                if limiter is not None:
+                    limiter.record_usage(m, est_tokens, getattr(usage, "total_token_count", None))
+                METRICS.incr("gemini_tokens", getattr(usage, "prompt_token_count", None) or est_tokens, model=m, tipo="prompt")
+                METRICS.incr("gemini_tokens", getattr(usage, "candidates_token_count", None) or 0, model=m, tipo="risposta")
+                # Quota delle istruzioni statiche nel prompt e token letti dalla cache di contesto
+                if system_instruction:
+                    METRICS.incr("gemini_tokens", client.instruction_tokens(m, system_instruction), model=m, tipo="istruzioni")
+                cached_tokens = getattr(usage, "cached_content_token_count", None)
+                if cached_tokens:
+                    METRICS.incr("gemini_tokens", cached_tokens, model=m, tipo="cache")
+                text = getattr(resp, "text", None) or ""
+                data = _parse_structured(text, schema) if schema is not None else _try_parse_json(text)
+                if data is not None:
+                    METRICS.incr("gemini_requests", model=m, esito="ok")
+                    logging.info(f"Risposta Gemini ottenuta con modello: {m}")
+                    return data
+                METRICS.incr("gemini_requests", model=m, esito="json_non_valido")
+                break
+            except Exception as e:
+                msg = str(e)
+                status = error_status(e)
+                # Solo il 429 consuma il budget: gli altri errori lo restituiscono
+                if limiter is not None and status != QUOTA_EXHAUSTED:
+                    limiter.refund(m, est_tokens)
+                if status == MODEL_NOT_FOUND:
+                    METRICS.incr("gemini_requests", model=m, esito="modello_non_disponibile")
+                    logging.warning(f"Modello Gemini non disponibile: {m}, provo fallback se possibile...")
+                    client.trip(m, "modello non disponibile")
+                    break
+                # Riconosciamo rate limiting (429) e stimiamo retry
+                if status == QUOTA_EXHAUSTED:
+                    METRICS.incr("gemini_requests", model=m, esito="quota")
+                    retry = _parse_retry_after(msg)
+                    if limiter is None:
+                        logging.error("Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Interrompo il batch.", retry)
+                        client.trip(m, "quota esaurita", float(retry) if retry else 60.0)
+                        raise RateLimitExceeded("Quota Gemini esaurita o rate limit raggiunto", retry_after_seconds=retry)
+                    attempts += 1
+                    delay = limiter.penalize(m, retry)
+                    if attempts > SETTINGS.gemini_max_retries or delay > limiter.max_wait:
+                        logging.warning("Quota Gemini esaurita per %s (retry tra %.0fs), provo il modello successivo se possibile...", m, delay)
+                        client.trip(m, "quota esaurita", delay)
+                        rate_limited.append(delay)
+                        break
+                    logging.warning("Gemini 429 su %s: nuovo tentativo tra %.1fs (%d/%d)", m, delay, attempts, SETTINGS.gemini_max_retries)
+                    METRICS.incr("gemini_retries", model=m)
+                    continue
+                METRICS.incr("gemini_requests", model=m, esito="errore")
+                logging.error("Errore chiamando Gemini API con modello %s: %s", m, msg)
+                return None
+    if rate_limited:
+        retry_after = int(min(rate_limited) + 0.999)
+        logging.error("Quota Gemini esaurita su tutti i modelli. Suggerito retry dopo %s secondi. Interrompo il batch.", retry_after)
+        raise RateLimitExceeded("Quota Gemini esaurita o rate limit raggiunto", retry_after_seconds=retry_after)
+    if not any(client.is_available(m) for m in tried_models):
+        logging.error("Nessun modello Gemini disponibile (%s).", ", ".join(tried_models))
+    return None
 
 
 def _ensure_timezone() -> str:
@@ -433,11 +1329,53 @@ def _ensure_timezone() -> str:
         return "Europe/Rome"
 
 
-def create_calendar_event(calendar, title: str, date_str: str, time_str: Optional[str], description: str = "") -> Dict:
-    tz = _ensure_timezone()
+def create_calendar_event(
+    calendar,
+    title: str,
+    date_str: str,
+    time_str: Optional[str],
+    description: str = "",
+    source_id: Optional[str] = None,
+    **details,
+) -> Dict:
+    with METRICS.timer("calendar_insert"):
+        event_body = build_event_body(title, date_str, time_str, description, source_id, **details)
+        created = calendar.events().insert(calendarId=SETTINGS.calendar_id, body=event_body).execute()
+        return created
+
+
+def _event_details(event: Dict) -> Dict:
+    """Campi facoltativi di un evento della decisione, come argomenti di build_event_body."""
+    return {
+        "end_time": event.get("ora_fine"),
+        "location": event.get("luogo"),
+        "end_date": event.get("data_fine"),
+        "recurrence": event.get("ricorrenza"),
+        "tz_name": event.get("fuso"),
+        "ical_uid": event.get("uid"),
+    }
+
+
+def build_event_body(
+    title: str,
+    date_str: str,
+    time_str: Optional[str],
+    description: str = "",
+    source_id: Optional[str] = None,
+    end_time: Optional[str] = None,
+    location: Optional[str] = None,
+    end_date: Optional[str] = None,
+    recurrence: Optional[List[str]] = None,
+    tz_name: Optional[str] = None,
+    ical_uid: Optional[str] = None,
+) -> Dict:
+    # Fuso dell'evento (inviti iCalendar) se valido, altrimenti quello configurato
+    tz = ics_timezone(tz_name) if tz_name else None
+    tz = tz or _ensure_timezone()
 
     # Normalizza data in formato YYYY-MM-DD
-    date_str = _normalize_date(date_str)
+    date_str = normalize_date(date_str)
+    end_date = normalize_date(end_date) if end_date else None
 
     if time_str:
         # Evento con orario: durata default 1h
@@ -454,6 +1392,15 @@ def create_calendar_event(calendar, title: str, date_str: str, time_str: Optiona
         else:
             start_dt = start_dt_naive  # Senza tzinfo: Calendar userà tz passato
         end_dt = start_dt + timedelta(hours=1)
+        if end_time:
+            # Orario di fine indicato: usato se successivo all'inizio, altrimenti durata default
+            try:
+                end_naive = datetime.strptime(f"{end_date or date_str} {end_time}", "%Y-%m-%d %H:%M")
+                candidate = end_naive.replace(tzinfo=start_dt.tzinfo)
+                if candidate > start_dt:
+                    end_dt = candidate
+            except ValueError:
+                logging.debug("Orario di fine non valido ignorato: %s", end_time)
 
         event_body = {
             "summary": title,
@@ -462,9 +1409,11 @@ def create_calendar_event(calendar, title: str, date_str: str, time_str: Optiona
             "end": {"dateTime": end_dt.isoformat(), "timeZone": tz},
         }
     else:
-        # Evento giornata intera: end esclusivo (giorno successivo)
+        # Evento giornata intera: end esclusivo (giorno successivo, o fine indicata per più giorni)
         d = datetime.strptime(date_str, "%Y-%m-%d").date()
         next_day = d + timedelta(days=1)
+        if end_date and end_date > next_day.isoformat():
+            next_day = datetime.strptime(end_date, "%Y-%m-%d").date()
 
         event_body = {
             "summary": title,
@@ -472,58 +1421,223 @@ def create_calendar_event(calendar, title: str, date_str: str, time_str: Optiona
             "start": {"date": d.isoformat(), "timeZone": tz},
             "end": {"date": next_day.isoformat(), "timeZone": tz},
         }
-
-    created = calendar.events().insert(calendarId="primary", body=event_body).execute()
-    return created
+    if location:
+        event_body["location"] = location
+    if recurrence:
+        event_body["recurrence"] = list(recurrence)
+    private = {}
+    if source_id:
+        # Id dell'email di origine: permette di riconoscere i duplicati senza ricerche sull'API
+        private["sourceMessageId"] = source_id
+    if ical_uid:
+        # UID dell'invito: lo stesso invito (o un suo aggiornamento) non crea un secondo evento
+        private["icalUID"] = ical_uid
+    if private:
+        event_body["extendedProperties"] = {"private": private}
+    return event_body
+
+
+def _event_key_for_decision(decision: Dict) -> Optional[str]:
+    try:
+        return CalendarEventIndex.make_key(decision["titolo"], normalize_date(decision["data"]), decision.get("ora_inizio"))
+    except Exception:
+        return None
 
 
 def mark_email_as_read(gmail, msg_id: str) -> None:
-    gmail.users().messages().modify(
-        userId="me", id=msg_id, body={"removeLabelIds": ["UNREAD"]}
-    ).execute()
+    with METRICS.timer("gmail_mark_read"):
+        gmail.users().messages().modify(
+            userId="me", id=msg_id, body={"removeLabelIds": ["UNREAD"]}
+        ).execute()
+
+
+def mark_emails_as_read(gmail, msg_ids: List[str]) -> List[str]:
+    """Marca come lette più email con batchModify; se fallisce ripiega su modify singoli."""
+    with METRICS.timer("gmail_batch_modify"):
+        done: List[str] = []
+        for start in range(0, len(msg_ids), 1000):
+            chunk = msg_ids[start:start + 1000]
+            try:
+                gmail.users().messages().batchModify(
+                    userId="me", body={"ids": chunk, "removeLabelIds": ["UNREAD"]}
+                ).execute()
+                done.extend(chunk)
+            except Exception as e:
+                logging.warning("batchModify fallito (%s): marco le %d email una alla volta", e, len(chunk))
+                for msg_id in chunk:
+                    try:
+                        mark_email_as_read(gmail, msg_id)
+                        done.append(msg_id)
+                    except Exception as e2:
+                        logging.error("Impossibile marcare come letta l'email %s: %s", msg_id, e2)
+        return done
+
+
+class BulkWriter:
+    """Raccoglie le decisioni: eventi in un batch di Calendar, poi email lette con batchModify."""
+
+    def __init__(self, gmail, calendar, ledger: Optional[ProcessedLedger] = None, batch_size: int = 50):
+        self.gmail = gmail
+        self.calendar = calendar
+        self.ledger = ledger
+        self.batch_size = max(1, min(50, batch_size))
+        # Per email: (id, decisione, inserimenti propri, inserimenti di altre email da cui dipende)
+        self._messages: List[Tuple[str, Dict, List[str], List[str]]] = []
+        self._bodies: Dict[str, Dict] = {}
+        self._keys: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, msg_id: str, decision: Dict, auto_flush: bool = True) -> None:
+        events = _decision_events(msg_id, decision)
+        try:
+            bodies = [
+                build_event_body(
+                    event["titolo"], event["data"], event.get("ora_inizio"), event.get("descrizione", ""),
+                    source_id=source_id, **_event_details(event),
+                )
+                for source_id, event in events
+            ]
+        except Exception as e:
+            logging.error("Evento non valido per email %s: %s", msg_id, e)
+            return
+        req_ids: List[str] = []
+        deps: List[str] = []
+        with self._lock:
+            for (source_id, event), body in zip(events, bodies):
+                key = _event_key_for_decision(event) if EVENT_INDEX is not None else None
+                existing = EVENT_INDEX.claim(key, source_id, event.get("uid")) if key is not None else None
+                if existing is not None and existing.startswith("pending:"):
+                    # Stesso evento di un'altra email in attesa: segue il suo esito
+                    deps.append(existing[len("pending:"):])
+                elif existing is not None:
+                    logging.info("Evento già presente in calendario (%s): non creo duplicati per email %s", existing, msg_id)
+                else:
+                    req_ids.append(source_id)
+                    self._bodies[source_id] = body
+                    self._keys[source_id] = (key, event.get("uid"))
+            self._messages.append((msg_id, decision, req_ids, deps))
+            full = len(self._bodies) >= self.batch_size
+        if auto_flush and full:
+            self.flush()
+
+    def flush(self) -> None:
+        with METRICS.timer("scrittura_blocco"):
+            with self._lock:
+                messages, self._messages = self._messages, []
+                bodies, self._bodies = self._bodies, {}
+                keys, self._keys = self._keys, {}
+            if not messages:
+                return
+            requests = {
+                req_id: (lambda body=body: self.calendar.events().insert(calendarId=SETTINGS.calendar_id, body=body))
+                for req_id, body in bodies.items()
+            }
+            created = _execute_batch(self.calendar, requests, what="creando evento per email") if requests else {}
+            for req_id, (key, uid) in keys.items():
+                if req_id not in created:
+                    if key is not None:
+                        EVENT_INDEX.release(key, req_id, uid)
+                    continue
+                logging.info("Evento creato: %s (%s)", bodies[req_id].get("summary"), created[req_id].get("id"))
+                METRICS.incr("eventi", esito="creato")
+                if EVENT_INDEX is not None:
+                    EVENT_INDEX.add_event(created[req_id])
+            to_mark: List[str] = []
+            for msg_id, decision, req_ids, deps in messages:
+                if not all(r in created for r in req_ids + deps):
+                    continue  # Non marcata come letta in caso di errore
+                if not req_ids:
+                    METRICS.incr("eventi", esito="esistente")
+                if self.ledger is not None:
+                    _record_decision(
+                        self.ledger, msg_id, decision.get("hash"), "evento_creato" if req_ids else "evento_esistente",
+                        decision.get("mittente"), decision.get("conversazione", ()),
+                    )
+                to_mark.append(msg_id)
+                to_mark.extend(decision.get("conversazione", ()))
+            if to_mark:
+                marked = mark_emails_as_read(self.gmail, to_mark)
+                logging.info("%d email marcate come lette (%d eventi creati su %d)", len(marked), len(created), len(bodies))
+
+
+_DAY_NAMES_IT = ("lunedì", "martedì", "mercoledì", "giovedì", "venerdì", "sabato", "domenica")
+
+
+@functools.lru_cache(maxsize=64)
+def _date_context(day) -> str:
+    """Blocco con la data di riferimento: calcolato una volta per giorno, non per email."""
+    today_str = day.strftime("%d-%m-%Y")
+    return f"""
+INFORMAZIONI TEMPORALI CORRENTI:
+- Data di oggi: {today_str} ({_DAY_NAMES_IT[day.weekday()]})
+- Anno corrente: {day.year}
+- IMPORTANTE: Se una data come "25 dicembre" non ha anno, usa {day.year}. Se la data è già passata quest'anno, usa {day.year + 1}.
+""".strip()
 
 
-def build_prompt(email_text: str, email_subject: Optional[str] = None) -> str:
-    from datetime import datetime
-    import pytz
-    
-    # Ottieni la data corrente in Italia
-    italy_tz = pytz.timezone("Europe/Rome")
-    today = datetime.now(italy_tz)
-    today_str = today.strftime("%d-%m-%Y")
-    day_name = today.strftime("%A")
-    
-    # Traduci il nome del giorno in italiano
-    day_translation = {
-        "Monday": "lunedì", "Tuesday": "martedì", "Wednesday": "mercoledì",
-        "Thursday": "giovedì", "Friday": "venerdì", "Saturday": "sabato", "Sunday": "domenica"
-    }
-    day_italian = day_translation.get(day_name, day_name)
-    
-    subject_block = f"Oggetto: {email_subject}\n" if email_subject else ""
-    return f"""
-Sei un assistente che analizza email in italiano per capire se contengono un evento, appuntamento o scadenza da aggiungere al calendario.
+def _current_date_context() -> str:
+    # Data corrente in Italia (o la data di invio dell'email nel recupero storico)
+    return _date_context(reference_now().date())
 
-INFORMAZIONI TEMPORALI CORRENTI:
-- Data di oggi: {today_str} ({day_italian})
-- Anno corrente: {today.year}
-- Quando una email non specifica l'anno, ASSUMI SEMPRE l'anno corrente ({today.year}) o l'anno successivo se la data è già passata quest'anno.
+
+def _system_instruction(batch: bool = False) -> str:
+    """Istruzioni statiche (senza data): inviate come system instruction e riutilizzabili in cache."""
+    return _build_system_instruction(batch, bool(SETTINGS.structured_output), bool(SETTINGS.cascade_mode))
+
+
+@functools.lru_cache(maxsize=8)
+def _build_system_instruction(batch: bool, structured: bool, cascade: bool) -> str:
+    confidence_field = ""
+    if cascade:
+        confidence_field = '\n- "confidenza": numero da 0 a 1 che indica quanto sei sicuro della decisione e della data/ora.'
+
+    if batch:
+        intro = "Sei un assistente che analizza più email in italiano per capire, per ciascuna, se contiene un evento, appuntamento o scadenza da aggiungere al calendario."
+        output_rule = "- Restituisci SOLO un array JSON con un oggetto per ogni email, nello stesso ordine, nessun testo aggiuntivo, nessun commento, nessun backtick."
+        format_header = 'Formato di ogni oggetto dell\'array JSON (campi obbligatori):\n- "id": identificativo dell\'email (es. "E1"), copiato esattamente.'
+    else:
+        intro = "Sei un assistente che analizza email in italiano per capire se contengono un evento, appuntamento o scadenza da aggiungere al calendario."
+        output_rule = "- Restituisci SOLO un oggetto JSON, nessun testo aggiuntivo, nessun commento, nessun backtick."
+        format_header = "Formato della risposta JSON (campi obbligatori):"
+    if structured:
+        dates_rule = f"Se ci sono più eventi distinti, restituiscili tutti (massimo {_MAX_EVENTS_PER_EMAIL}); date alternative dello stesso evento non sono eventi distinti."
+        fields = """- "eventi": lista degli eventi (vuota se non ce ne sono); per ognuno:
+  - "titolo": titolo breve e descrittivo.
+  - "descrizione": breve descrizione dell'evento (max 200 caratteri); stringa vuota se non disponibile.
+  - "data": data in formato GG-MM-AAAA; null se non determinabile.
+  - "ora_inizio": orario 24h HH:MM in ora italiana; null se evento di giornata intera.
+  - "ora_fine": orario 24h HH:MM di fine, se indicato; altrimenti null.
+  - "luogo": luogo dell'evento, se indicato; altrimenti null."""
+    else:
+        dates_rule = "Se ci sono più date, scegli quella più plausibile per l'azione richiesta."
+        fields = """- "titolo": titolo breve e descrittivo.
+- "descrizione": breve descrizione dell'evento (max 200 caratteri); stringa vuota se non disponibile.
+- "data": data in formato GG-MM-AAAA; "null" se non determinabile.
+- "ora_inizio": orario 24h HH:MM in ora italiana; "null" se evento di giornata intera."""
+    return f"""
+{intro}
 
 Istruzioni e vincoli:
+- La data di oggi e l'anno corrente sono indicati all'inizio di ogni richiesta (INFORMAZIONI TEMPORALI CORRENTI).
+- Quando una email non specifica l'anno, ASSUMI SEMPRE l'anno corrente o l'anno successivo se la data è già passata quest'anno.
 - Luogo/Fuso orario: Italia. Usa sempre il fuso Europe/Rome (CET/CEST) e considera l'ora legale alla data indicata.
 - Se la mail contiene solo una data (senza orario), crea un evento di GIORNATA INTERA per quella data.
 - Se è presente anche un orario, crea un evento con orario (l'inizio coincide con l'orario indicato). Se l'orario non specifica fuso, interpretalo come orario italiano. Se è indicato un fuso diverso, converti all'ora italiana per la data specifica.
-- Riconosci anche espressioni relative: "oggi", "domani", "dopodomani", "questo venerdì", "la prossima settimana", ecc. Calcola la data assoluta rispetto a oggi ({today_str}) in Italia.
-- IMPORTANTE: Se una data come "25 dicembre" non ha anno, usa {today.year}. Se la data è già passata quest'anno, usa {today.year + 1}.
-- Ignora firme, disclaimer e contenuti non rilevanti. Se ci sono più date, scegli quella più plausibile per l'azione richiesta.
-- Restituisci SOLO un oggetto JSON, nessun testo aggiuntivo, nessun commento, nessun backtick.
+- Riconosci anche espressioni relative: "oggi", "domani", "dopodomani", "questo venerdì", "la prossima settimana", ecc. Calcola la data assoluta rispetto alla data di oggi indicata, in Italia.
+- Ignora firme, disclaimer e contenuti non rilevanti. {dates_rule}
+{output_rule}
 
-Formato della risposta JSON (campi obbligatori):
+{format_header}
 - "creare_evento": "si" o "no".
-- "titolo": titolo breve e descrittivo.
-- "descrizione": breve descrizione dell'evento (max 200 caratteri); stringa vuota se non disponibile.
-- "data": data in formato GG-MM-AAAA; "null" se non determinabile.
-- "ora_inizio": orario 24h HH:MM in ora italiana; "null" se evento di giornata intera.
+{fields}{confidence_field}
+""".strip()
+
+
+def build_prompt(email_text: str, email_subject: Optional[str] = None) -> str:
+    """Parte variabile della richiesta: contesto temporale ed email (le istruzioni vanno in _system_instruction)."""
+    subject_block = f"Oggetto: {email_subject}\n" if email_subject else ""
+    return f"""
+{_current_date_context()}
 
 Contenuto da analizzare:
 {subject_block}
@@ -534,69 +1648,795 @@ Testo:
 """.strip()
 
 
-def process_email(gmail, calendar, msg_id: str) -> None:
-    subject, body = get_email_subject_and_body(gmail, msg_id)
-    if not body:
-        logging.info("Email %s senza corpo: salto", msg_id)
-        return
+def build_batch_prompt(items: List[Tuple[str, str, str]]) -> str:
+    """Prompt per più email: 'items' è una lista di (etichetta, oggetto, testo)."""
+    blocks = []
+    for tag, subject, text in items:
+        subject_block = f"Oggetto: {subject}\n" if subject else ""
+        blocks.append(f"=== EMAIL {tag} ===\n{subject_block}Testo:\n---\n{text}\n---")
+    joined = "\n\n".join(blocks)
+    return f"""
+{_current_date_context()}
+
+Email da analizzare ({len(items)}):
+
+{joined}
+""".strip()
+
+
+def _record_decision(
+    ledger: ProcessedLedger, msg_id: str, content_hash: Optional[str], decision: str,
+    sender: Optional[str] = None, siblings=(),
+) -> None:
+    """Registra la decisione per l'email e per le altre email della sua conversazione."""
+    ledger.record(msg_id, content_hash, decision, sender)
+    for sibling in siblings:
+        ledger.record(sibling, None, decision)
+
+
+def group_by_thread(messages: List[Dict]) -> List[List[Dict]]:
+    """Raggruppa i messaggi per threadId mantenendo l'ordine (il primo è il più recente)."""
+    groups: Dict[str, List[Dict]] = {}
+    for m in messages:
+        if not m.get("id"):
+            continue
+        groups.setdefault(m.get("threadId") or m["id"], []).append(m)
+    return list(groups.values())
+
+
+def _merge_calendar_events(group: List[EmailRecord]) -> Optional[List[Dict]]:
+    """Eventi degli inviti di tutta la conversazione (stesso UID: vale il messaggio più recente)."""
+    invites = [r.calendar_events for r in group if r.calendar_events is not None]
+    if not invites:
+        return None
+    unique: Dict[str, Dict] = {}
+    for events in invites:
+        for event in events:
+            unique.setdefault(event.get("uid") or f"#{len(unique)}", event)
+    return list(unique.values())[:MAX_ICS_EVENTS]
+
+
+def coalesce_thread_records(records, thread_of: Dict[str, str]):
+    """Unisce i record consecutivi della stessa conversazione in uno solo.
+    Gli id degli altri messaggi finiscono in 'siblings', così la decisione vale per tutti.
+    """
+    for _, grouped in itertools.groupby(records, key=lambda r: thread_of.get(r.msg_id) or r.msg_id):
+        group = list(grouped)
+        if len(group) == 1:
+            yield group[0]
+            continue
+        rep_id, body = group[0].msg_id, group[0].body
+        previous = [r.body for r in group[1:] if r.body]
+        merged = body or ""
+        if previous:
+            merged += "\n\nMessaggi precedenti della stessa conversazione:\n" + "\n---\n".join(previous)
+        if SETTINGS.body_max_chars:
+            merged = merged[:SETTINGS.body_max_chars]
+        logging.info("Conversazione con %d email non lette: analizzo solo %s (testo unito)", len(group), rep_id)
+        yield group[0]._replace(
+            body=merged, calendar_events=_merge_calendar_events(group), siblings=tuple(r.msg_id for r in group[1:])
+        )
+
+
+def process_email(gmail, calendar, msg_id: str, ledger: Optional[ProcessedLedger] = None) -> None:
+    process_fetched_email(gmail, calendar, get_email_record(gmail, msg_id), ledger)
+
+
+def process_fetched_email(gmail, calendar, record: EmailRecord, ledger: Optional[ProcessedLedger] = None) -> None:
+    decision = analyze_email(record, ledger)
+    if decision is not None:
+        apply_event_decision(gmail, calendar, record.msg_id, decision, ledger)
+
+
+def analyze_email(
+    record: EmailRecord,
+    ledger: Optional[ProcessedLedger] = None,
+    sender_template: bool = True,
+) -> Optional[Dict]:
+    """Fase di analisi (nessuna scrittura): evento da creare oppure None."""
+    msg_id, subject, body = record[:3]
+    handled, decision = _calendar_decision(record, ledger)
+    if handled:
+        return decision
+    skip, content_hash = _precheck_email(record, ledger)
+    if skip:
+        return None
+    local = None
+    if SENDER_TEMPLATES is not None and sender_template:
+        local = SENDER_TEMPLATES.lookup(record)
+    if local is not None:
+        logging.info("Email %s estratta con il modello del mittente, senza Gemini", msg_id)
+        return _decision_from_result(record, local, content_hash, ledger)
+    scheduler = SCHEDULER
+    if scheduler is not None and not scheduler.can_dispatch():
+        scheduler.defer([msg_id])
+        return None
 
     prompt = build_prompt(body, subject)
 
     logging.info("Invio email %s a Gemini per analisi…", msg_id)
-    result = call_gemini_api(prompt, MODEL)
+    schema = _response_schema()
+    system = _system_instruction()
+    t0 = time.perf_counter()
+    if SETTINGS.cascade_mode:
+        result = call_gemini_cascade(prompt, schema, system)
+    else:
+        result = call_gemini_api(prompt, MODEL, schema=schema, system_instruction=system)
+    if scheduler is not None:
+        scheduler.observe(time.perf_counter() - t0)
     if result is None:
         logging.error("Impossibile ottenere risposta da Gemini per email %s", msg_id)
-        return
-        
-    creare, titolo, data_str, ora_inizio, descrizione = parse_event_decision(result)
+        return None
+    if SENDER_TEMPLATES is not None:
+        SENDER_TEMPLATES.observe(record, result)
+    return _decision_from_result(record, result, content_hash, ledger)
+
+
+def _precheck_email(record: EmailRecord, ledger: Optional[ProcessedLedger] = None) -> Tuple[bool, Optional[str]]:
+    """Controlli locali prima di Gemini. Restituisce (salta, hash_contenuto)."""
+    msg_id, subject, body = record[:3]
+    if not body:
+        logging.info("Email %s senza corpo: salto", msg_id)
+        return True, None
+
+    content_hash = None
+    if ledger is not None:
+        content_hash = ProcessedLedger.content_hash(subject, body)
+        previous = ledger.decision_for_hash(content_hash)
+        if previous in ("nessun_evento", "senza_data"):
+            logging.info("Email %s: contenuto già valutato (%s), salto Gemini", msg_id, previous)
+            _record_decision(ledger, msg_id, content_hash, previous, record.sender, record.siblings)
+            return True, content_hash
+
+    if PREFILTER is not None:
+        send, score, reason = PREFILTER.evaluate(subject, body, record.meta)
+        if not send:
+            logging.info("Prefiltro: email %s (%s) non inviata a Gemini - %s (confidenza %.2f)", msg_id, subject, reason, score)
+            if ledger is not None:
+                _record_decision(ledger, msg_id, content_hash, "scartata_prefiltro", record.sender, record.siblings)
+            return True, content_hash
+        logging.debug("Prefiltro: email %s inviata a Gemini - %s (confidenza %.2f)", msg_id, reason, score)
+    return False, content_hash
+
+
+def _decision_from_result(
+    record: EmailRecord,
+    result: Dict,
+    content_hash: Optional[str] = None,
+    ledger: Optional[ProcessedLedger] = None,
+) -> Optional[Dict]:
+    msg_id, subject = record.msg_id, record.subject
+    creare = parse_event_decision(result)[0]
 
     if not creare:
         logging.info("Gemini: nessun evento da creare per email %s", msg_id)
-        return
-    if not data_str:
+        if ledger is not None:
+            _record_decision(ledger, msg_id, content_hash, "nessun_evento", record.sender, record.siblings)
+        return None
+
+    # Output strutturato: lista "eventi"; formato classico: un solo evento coi campi piatti
+    raw_events = result.get("eventi") if isinstance(result.get("eventi"), list) else [result]
+    events = []
+    for raw in raw_events[:_MAX_EVENTS_PER_EMAIL]:
+        _, titolo, data_str, ora_inizio, descrizione = parse_event_decision(dict(raw, creare_evento="si"))
+        if not data_str:
+            continue
+        # Descrizione: usa quella generata da Gemini, altrimenti fallback con oggetto
+        events.append({
+            "titolo": titolo,
+            "data": data_str,
+            "ora_inizio": ora_inizio,
+            "ora_fine": optional_field(raw.get("ora_fine")) if ora_inizio else None,
+            "luogo": optional_field(raw.get("luogo")),
+            "descrizione": descrizione or f"Generato automaticamente da email con oggetto: {subject}",
+        })
+    if not events:
         logging.info("Gemini ha deciso di creare evento ma senza data: salto email %s", msg_id)
+        if ledger is not None:
+            _record_decision(ledger, msg_id, content_hash, "senza_data", record.sender, record.siblings)
+        return None
+    if len(events) > 1:
+        logging.info("Gemini: %d eventi nell'email %s", len(events), msg_id)
+    # I campi piatti restano quelli del primo evento
+    return dict(events[0], eventi=events, hash=content_hash, mittente=record.sender, conversazione=list(record.siblings))
+
+
+def _decision_events(msg_id: str, decision: Dict) -> List[Tuple[str, Dict]]:
+    """Coppie (id sorgente, evento): il primo evento usa l'id dell'email, gli altri "<id>#<n>"."""
+    events = decision.get("eventi") or [decision]
+    return [(msg_id if n == 1 else f"{msg_id}#{n}", event) for n, event in enumerate(events, 1)]
+
+
+def call_gemini_cascade(prompt: str, schema: Optional[Dict] = None, system_instruction: Optional[str] = None) -> Optional[Dict]:
+    """Prima il modello veloce; il pro solo se la risposta non è valida o poco sicura."""
+    fast_model = SETTINGS.cascade_fast_model
+    strong_model = SETTINGS.cascade_strong_model
+    try:
+        fast = call_gemini_api(prompt, fast_model, fallback=False, schema=schema, system_instruction=system_instruction)
+    except RateLimitExceeded:
+        logging.warning("Quota esaurita per %s: uso direttamente %s", fast_model, strong_model)
+        return call_gemini_api(prompt, strong_model, fallback=False, schema=schema, system_instruction=system_instruction)
+    reason = "nessuna risposta" if fast is None else needs_escalation(fast, SETTINGS.cascade_min_confidence)
+    if reason is None:
+        return fast
+    logging.info("Cascata: %s da %s, passo a %s", reason, fast_model, strong_model)
+    METRICS.incr("gemini_escalation", model=strong_model)
+    try:
+        strong = call_gemini_api(prompt, strong_model, fallback=False, schema=schema, system_instruction=system_instruction)
+    except RateLimitExceeded:
+        if fast is not None and is_valid_decision(fast):
+            logging.warning("Quota esaurita per %s: uso la risposta di %s", strong_model, fast_model)
+            return fast
+        raise
+    if strong is None and fast is not None and is_valid_decision(fast):
+        return fast
+    return strong
+
+
+def _pack_batches(items: List[Tuple], token_budget: int, max_items: int) -> List[List[Tuple]]:
+    """Raggruppa (id, oggetto, testo, ...) in blocchi entro il budget di token stimato."""
+    overhead = estimate_tokens(_system_instruction(batch=True)) + estimate_tokens(_current_date_context())
+    groups: List[List[Tuple]] = []
+    current: List[Tuple] = []
+    used = overhead
+    for item in items:
+        cost = (len(item[1] or "") + len(item[2] or "")) // 4 + 20
+        if current and (used + cost > token_budget or len(current) >= max_items):
+            groups.append(current)
+            current, used = [], overhead
+        current.append(item)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
+
+
+def analyze_emails_batch(records, ledger: Optional[ProcessedLedger] = None):
+    """Analizza più email con una sola chiamata Gemini per blocco, producendo (id, decisione).
+    Le voci mancanti o non valide vengono rianalizzate singolarmente.
+    """
+    candidates: List[EmailRecord] = []
+    hashes: Dict[str, Optional[str]] = {}
+    for record in records:
+        msg_id = record.msg_id
+        handled, decision = _calendar_decision(record, ledger)
+        if handled:
+            yield msg_id, decision
+            continue
+        skip, content_hash = _precheck_email(record, ledger)
+        if skip:
+            yield msg_id, None
+            continue
+        local = SENDER_TEMPLATES.lookup(record) if SENDER_TEMPLATES is not None else None
+        if local is not None:
+            logging.info("Email %s estratta con il modello del mittente, senza Gemini", msg_id)
+            yield msg_id, _decision_from_result(record, local, content_hash, ledger)
+        else:
+            candidates.append(record)
+            hashes[msg_id] = content_hash
+
+    scheduler = SCHEDULER
+    groups = _pack_batches(candidates, SETTINGS.gemini_batch_tokens, SETTINGS.gemini_batch_size)
+    for n, group in enumerate(groups):
+        if len(group) == 1:
+            yield group[0].msg_id, analyze_email(group[0], ledger, sender_template=False)
+            continue
+        if scheduler is not None and not scheduler.can_dispatch():
+            scheduler.defer([item[0] for pending in groups[n:] for item in pending])
+            return
+
+        tags = {f"E{i}": item for i, item in enumerate(group, 1)}
+        prompt = build_batch_prompt([(tag, item[1], item[2]) for tag, item in tags.items()])
+        logging.info("Invio %d email a Gemini in un'unica richiesta…", len(group))
+        schema = _response_schema(batch=True)
+        system = _system_instruction(batch=True)
+        t0 = time.perf_counter()
+        if SETTINGS.cascade_mode:
+            result = call_gemini_api(
+                prompt, SETTINGS.cascade_fast_model, fallback=False, schema=schema, system_instruction=system
+            )
+        else:
+            result = call_gemini_api(prompt, MODEL, schema=schema, system_instruction=system)
+        if scheduler is not None:
+            scheduler.observe(time.perf_counter() - t0)
+        if isinstance(result, dict):
+            result = [result]
+        by_tag: Dict[str, Dict] = {}
+        for entry in result or []:
+            if isinstance(entry, dict):
+                by_tag[str(entry.get("id", "")).strip()] = entry
+
+        fallback = []
+        for tag, record in tags.items():
+            entry = by_tag.get(tag)
+            # In cascata le risposte incerte passano dall'analisi singola (che può salire al pro)
+            valid = entry is not None and is_valid_decision(entry)
+            if not valid or (SETTINGS.cascade_mode and needs_escalation(entry, SETTINGS.cascade_min_confidence)):
+                fallback.append(record)
+                continue
+            if SENDER_TEMPLATES is not None:
+                SENDER_TEMPLATES.observe(record, entry)
+            yield record.msg_id, _decision_from_result(record, entry, hashes[record.msg_id], ledger)
+        if fallback:
+            logging.warning("Risposta multi-email incompleta: %d email rianalizzate singolarmente", len(fallback))
+        for record in fallback:
+            yield record.msg_id, analyze_email(record, ledger, sender_template=False)
+
+
+def apply_event_decision(
+    gmail,
+    calendar,
+    msg_id: str,
+    decision: Dict,
+    ledger: Optional[ProcessedLedger] = None,
+) -> None:
+    """Fase di scrittura: crea gli eventi e SOLO dopo marca l'email come letta."""
+    outcomes = _create_decision_events(calendar, msg_id, decision)
+    if outcomes is None:
         return
+    if ledger is not None:
+        outcome = "evento_creato" if "evento_creato" in outcomes else "evento_esistente"
+        _record_decision(
+            ledger, msg_id, decision.get("hash"), outcome, decision.get("mittente"), decision.get("conversazione", ())
+        )
 
-    # Descrizione: usa quella generata da Gemini, altrimenti fallback con oggetto
-    description = descrizione or f"Generato automaticamente da email con oggetto: {subject}"
+    # Solo dopo la creazione, marca come letta (insieme alle altre email della conversazione)
+    siblings = list(decision.get("conversazione", ()))
+    if not siblings:
+        mark_email_as_read(gmail, msg_id)
+        logging.info("Email %s marcata come letta", msg_id)
+        return
+    marked = mark_emails_as_read(gmail, [msg_id] + siblings)
+    logging.info("Email %s e %d della stessa conversazione marcate come lette", msg_id, len(marked) - 1)
+
+
+def _create_decision_events(calendar, msg_id: str, decision: Dict) -> Optional[List[str]]:
+    """Crea gli eventi della decisione saltando quelli già presenti; None se da riprovare."""
+    index = EVENT_INDEX
+    outcomes = []
+    for source_id, event in _decision_events(msg_id, decision):
+        titolo = event["titolo"]
+        key = _event_key_for_decision(event) if index is not None else None
+        existing = index.claim(key, source_id, event.get("uid")) if key is not None else None
+        if existing is not None and existing.startswith("pending:"):
+            logging.info("Evento %s in creazione da un'altra email: rimando l'email %s", titolo, msg_id)
+            return None
+        if existing is not None:
+            logging.info("Evento già presente in calendario (%s): non creo duplicati per email %s", existing, msg_id)
+            METRICS.incr("eventi", esito="esistente")
+            outcomes.append("evento_esistente")
+            continue
+        try:
+            created = create_calendar_event(
+                calendar, titolo, event["data"], event.get("ora_inizio"), event.get("descrizione", ""),
+                source_id=source_id, **_event_details(event),
+            )
+        except Exception:
+            if key is not None:
+                index.release(key, source_id, event.get("uid"))
+            raise
+        logging.info("Evento creato: %s (%s)", titolo, created.get("id"))
+        METRICS.incr("eventi", esito="creato")
+        if index is not None:
+            index.add_event(created)
+        outcomes.append("evento_creato")
+    return outcomes
 
-    created = create_calendar_event(calendar, titolo, data_str, ora_inizio, description)
-    event_id = created.get("id")
-    logging.info("Evento creato: %s (%s)", titolo, event_id)
 
-    # Solo dopo la creazione, marca come letta
-    mark_email_as_read(gmail, msg_id)
-    logging.info("Email %s marcata come letta", msg_id)
+# ---------------------------------------------------------------------------
+# Modalità multi-account: un processo per casella, budget Gemini condiviso
+# ---------------------------------------------------------------------------
 
 
-def main() -> None:
-    global MODEL, TIMEZONE, MAX_UNREAD_TO_PROCESS, PER_EMAIL_SLEEP_SECS
-    
-    setup_logging()
+def _run_account(account: Dict, root_state_dir: str, budget, deadline: Optional[float] = None) -> Dict:
+    """Esegue main() per un account in un processo dedicato e ne restituisce il riepilogo."""
+    global SHARED_GEMINI_BUDGET
     load_env()
-    
-    # Inizializza variabili globali DOPO aver caricato il .env
-    MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-pro")
-    TIMEZONE = os.getenv("TIMEZONE", "Europe/Rome")
+    env = account_env(account, root_state_dir, os.environ, deadline)
+    SHARED_GEMINI_BUDGET = budget
+
+    setup_logging(account["name"])
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    started = time.time()
+    ok = True
     try:
-        MAX_UNREAD_TO_PROCESS = int(os.getenv("MAX_UNREAD_TO_PROCESS", "10"))
-    except Exception:
-        MAX_UNREAD_TO_PROCESS = 10
+        main(env)
+    except BaseException as e:  # anche SystemExit: il riepilogo va comunque restituito
+        ok = False
+        logging.exception("Esecuzione dell'account %s interrotta: %s", account["name"], e)
+    return {
+        "account": account["name"],
+        "ok": ok and errors.count == 0,
+        "errors": errors.count,
+        "duration_secs": round(time.time() - started, 3),
+        "report": METRICS.summary(),
+    }
+
+
+def run_accounts(config_path: str) -> None:
+    """Modalità multi-account: un processo per account, budget Gemini condiviso."""
+    import multiprocessing
+
+    setup_logging()
     try:
-        PER_EMAIL_SLEEP_SECS = float(os.getenv("PER_EMAIL_SLEEP_SECS", "0"))
-    except Exception:
-        PER_EMAIL_SLEEP_SECS = 0.0
-    
+        config = load_accounts_config(config_path)
+    except Exception as e:
+        logging.error("File account %s non valido: %s", config_path, e)
+        return
+    accounts = config["accounts"]
+    root_state_dir = os.getenv("STATE_DIR") or os.path.join(os.path.dirname(__file__), ".state")
+    workers = env_int("ACCOUNTS_WORKERS", int(config.get("workers") or 0)) or (os.cpu_count() or 1)
+    workers = max(1, min(workers, len(accounts)))
+    if env_bool("DAEMON_MODE", False):
+        logging.warning("DAEMON_MODE non supportata con ACCOUNTS_FILE: eseguo un solo passaggio per account")
+    logging.info("Modalità multi-account: %d account, %d processi", len(accounts), workers)
+    deadline = _run_deadline()
+
+    ctx = multiprocessing.get_context("spawn")
+    started = time.time()
+    results: List[Dict] = []
+    with BudgetManager(ctx=ctx) as manager:
+        budget = manager.GeminiRateLimiter(
+            os.path.join(root_state_dir, "gemini_budget.json"),
+            GeminiRateLimiter.parse_limits(config.get("gemini_limits") or os.getenv("GEMINI_RATE_LIMITS", "")),
+            env_float("GEMINI_MAX_WAIT_SECS", GEMINI_MAX_WAIT_DEFAULT_SECS),
+        )
+        # Un processo nuovo per ogni account: stato globale e variabili d'ambiente non passano da un account all'altro
+        with ctx.Pool(processes=workers, maxtasksperchild=1) as pool:
+            run_one = functools.partial(_run_account, root_state_dir=root_state_dir, budget=budget, deadline=deadline)
+            for result in pool.imap_unordered(run_one, accounts):
+                results.append(result)
+                created = ((result.get("report") or {}).get("counters") or {}).get("eventi", {}).get("esito=creato", 0)
+                logging.info(
+                    "Account %s: %s, %d eventi creati, %d errori (%ss)",
+                    result["account"], "ok" if result["ok"] else "con errori", created, result["errors"], result["duration_secs"],
+                )
+        try:
+            budget.save()
+        except Exception as e:
+            logging.warning("Salvataggio budget Gemini globale non riuscito: %s", e)
+
+    results.sort(key=lambda r: r["account"])
+    summary = {
+        "started_at": datetime.fromtimestamp(started).isoformat(timespec="seconds"),
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "duration_secs": round(time.time() - started, 3),
+        "workers": workers,
+        "accounts_ok": sum(1 for r in results if r["ok"]),
+        "accounts_failed": [r["account"] for r in results if not r["ok"]],
+        "totals": aggregate_reports(results),
+        "accounts": results,
+    }
+    report_path = os.getenv("ACCOUNTS_REPORT_FILE", os.path.join(root_state_dir, "accounts_report.json"))
+    if report_path:
+        try:
+            os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+            write_json_file(report_path, json.dumps(summary, ensure_ascii=False, indent=2))
+        except Exception as e:
+            logging.warning("Scrittura report multi-account non riuscita: %s", e)
+    logging.info(
+        "Multi-account completato in %.1fs: %d/%d account senza errori",
+        summary["duration_secs"], summary["accounts_ok"], len(results),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Recupero storico: archivio mbox o cartella di file .eml
+# ---------------------------------------------------------------------------
+
+
+def _backfill_analyze(raw: bytes) -> Tuple[str, str, Optional[datetime], Optional[Dict]]:
+    """Analizza un messaggio dell'archivio; le date relative partono dalla data di invio."""
+    from email import message_from_bytes, policy
+
+    msg = message_from_bytes(raw, policy=policy.default)
+    msg_id = str(msg.get("Message-ID") or "").strip().strip("<>") or "sha1:" + hashlib.sha1(raw).hexdigest()[:16]
+    sent_at = backfill.email_sent_at(msg)
+    with METRICS.timer("backfill_parse"):
+        record = _record_from_message({"id": msg_id, "payload": backfill.payload_from_email(msg), "snippet": ""})
+    REFERENCE.today = sent_at
+    try:
+        decision = analyze_email(record, None)
+    finally:
+        REFERENCE.today = None
+    return msg_id, record.subject, sent_at, decision
+
+
+def run_backfill(source: str, env: Optional[Mapping[str, str]] = None) -> None:
+    """Recupero storico da un archivio mbox o da una cartella di file .eml, con checkpoint."""
+    global GEMINI_CLIENT, EVENT_INDEX
+
+    _startup_mark("import")
+    setup_logging()
+    if env is None:
+        load_env()
+        env = os.environ
+    configure(env)
+
+    source = os.path.abspath(source)
+    if not os.path.exists(source):
+        logging.error("Archivio da recuperare non trovato: %s", source)
+        return
+    if not env.get("GEMINI_API_KEY"):
+        logging.error("Variabile GEMINI_API_KEY mancante. Inserirla in .env o nell'ambiente.")
+        return
+    dry_run = env_bool("BACKFILL_DRY_RUN", True, env)
+    output_path = env.get("BACKFILL_OUTPUT", os.path.join(SETTINGS.state_dir, "backfill_events.jsonl"))
+    checkpoint_path = env.get("BACKFILL_CHECKPOINT", os.path.join(SETTINGS.state_dir, "backfill_checkpoint.json"))
+    checkpoint_every = max(1, env_int("BACKFILL_CHECKPOINT_EVERY", 50, env))
+    limit = env_int("BACKFILL_LIMIT", 0, env)
+
+    calendar = None
+    if not dry_run:
+        setup_credentials_from_ci_env(env)
+        try:
+            creds = BACKENDS.credentials()
+        except Exception as e:
+            logging.exception("Errore durante autenticazione Google: %s", e)
+            return
+        calendar = _build_service("calendar", "v3", creds)
+        if env_bool("EVENT_INDEX_ENABLED", False, env):
+            index = CalendarEventIndex(
+                os.path.join(SETTINGS.state_dir, "calendar_index.json"),
+                past_days=env_int("EVENT_INDEX_PAST_DAYS", 30, env),
+                future_days=env_int("EVENT_INDEX_FUTURE_DAYS", 400, env),
+            )
+            try:
+                index.sync(calendar, SETTINGS.calendar_id)
+                EVENT_INDEX = index
+            except Exception as e:
+                logging.warning("Indice eventi non disponibile, nessun controllo duplicati: %s", e)
+    try:
+        GEMINI_CLIENT = GeminiClient(
+            env["GEMINI_API_KEY"],
+            breaker_path=os.path.join(SETTINGS.state_dir, "gemini_breaker.json"),
+            cooldown_secs=env_float("GEMINI_BREAKER_COOLDOWN_SECS", 6 * 3600, env),
+            sdk=BACKENDS.gemini_sdk,
+            metrics=METRICS,
+            **_gemini_client_options(env),
+        )
+    except Exception as e:
+        logging.error("SDK Gemini non disponibile: %s", e)
+        return
+    _log_startup_report()
+
+    state = backfill.load_checkpoint(checkpoint_path, source)
+    if state["position"] is not None:
+        logging.info("Riprendo il recupero di %s: %d email già elaborate", source, state["processed"])
+    state.setdefault("failed", {})
+    if state["failed"]:
+        logging.info("Ritento %d email non elaborate nelle esecuzioni precedenti", len(state["failed"]))
+    reader = backfill.pending_messages(source, state)
+
+    output = None
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        # Le righe scritte dopo l'ultimo checkpoint verranno riprodotte: le scarto
+        output = open(output_path, "r+b" if os.path.exists(output_path) else "wb")
+        output.truncate(state.get("output_bytes", 0) if state["position"] is not None else 0)
+        output.seek(0, os.SEEK_END)
+
+    def _on_signal(signum, frame):
+        logging.info("Segnale %s ricevuto: salvo il punto raggiunto e termino il recupero", signum)
+        _SHUTDOWN.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _on_signal)
+
+    def _consume(position, key, future) -> None:
+        try:
+            msg_id, subject, sent_at, decision = future.result()
+        except RateLimitExceeded:
+            raise
+        except Exception as e:
+            METRICS.incr("backfill_email", esito="errore")
+            attempts = state["failed"].get(key, 0) + 1
+            if attempts < backfill.MAX_ATTEMPTS:
+                # Il checkpoint va avanti: l'email viene ritentata all'inizio della prossima esecuzione
+                logging.exception("Email %s dell'archivio non elaborata (tentativo %d): %s", key, attempts, e)
+                state["failed"][key] = attempts
+            else:
+                logging.exception("Email %s dell'archivio non elaborata dopo %d tentativi, la abbandono: %s", key, attempts, e)
+                state["failed"].pop(key, None)
+            if position is not None:
+                state["position"] = position
+            return
+        state["failed"].pop(key, None)
+        events = _decision_events(msg_id, decision) if decision else []
+        outcomes: List[str] = ["proposto"] * len(events)
+        if events and calendar is not None:
+            outcomes = _create_decision_events(calendar, msg_id, decision) or []
+            if not outcomes:
+                logging.warning("Email %s: evento in creazione da un'altra esecuzione, non creato", msg_id)
+        if output is not None:
+            for (source_id, event), outcome in zip(events, outcomes):
+                record = {
+                    "message_id": msg_id,
+                    "source_id": source_id,
+                    "subject": subject,
+                    "sent_at": sent_at.isoformat() if sent_at else None,
+                    "esito": outcome,
+                    "evento": {k: v for k, v in event.items() if v is not None},
+                }
+                output.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        METRICS.incr("backfill_email", esito="evento" if events else "nessun_evento")
+        if position is not None:
+            state["position"] = position
+        state["processed"] += 1
+        state["events"] += len(events)
+        # In modalità reale il checkpoint segue ogni creazione: una ripresa non duplica eventi
+        if state["processed"] % checkpoint_every == 0 or (calendar is not None and "evento_creato" in outcomes):
+            _checkpoint()
+
+    def _checkpoint() -> None:
+        if output is not None:
+            output.flush()
+            state["output_bytes"] = output.tell()
+        backfill.save_checkpoint(checkpoint_path, state)
+
+    workers = SETTINGS.gemini_workers
+    window: deque = deque()
+    submitted = 0
+    stopped = False
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+            try:
+                for position, key, raw in reader:
+                    if _SHUTDOWN.is_set() or (limit and submitted >= limit):
+                        break
+                    window.append((position, key, pool.submit(_backfill_analyze, raw)))
+                    submitted += 1
+                    # Risultati consumati in ordine: il checkpoint non supera mai un messaggio in sospeso
+                    while len(window) >= 2 * workers or (window and window[0][2].done()):
+                        _consume(*window.popleft())
+                while window and not (_SHUTDOWN.is_set() and window[0][2].cancel()):
+                    _consume(*window.popleft())
+            finally:
+                # Arresto o errore: le analisi non ancora avviate vengono annullate
+                for _, _, future in window:
+                    future.cancel()
+    except RateLimitExceeded as e:
+        _log_rate_limit(e)
+        stopped = True
+    except Exception as e:
+        logging.exception("Recupero interrotto da un errore: %s", e)
+        stopped = True
+    finally:
+        _checkpoint()
+        if output is not None:
+            output.close()
+        save_state(None)
+    stopped = stopped or _SHUTDOWN.is_set()
+    logging.info(
+        "Recupero %s: %d email elaborate in totale, %d eventi %s%s",
+        "interrotto" if stopped else "completato", state["processed"], state["events"],
+        "proposti" if dry_run else "trattati",
+        f" (dettaglio in {output_path})" if output_path else "",
+    )
+
+
+def main(env: Optional[Mapping[str, str]] = None, metrics: Optional[RunMetrics] = None,
+         backends: Optional[Backends] = None) -> None:
+    """Punto di ingresso: esecuzione e report finale.
+    'env', 'metrics' e 'backends' sostituiscono ambiente, metriche e servizi reali (test e benchmark).
+    """
+    global METRICS, BACKENDS, GEMINI_CLIENT, EVENT_INDEX
+    METRICS = metrics if metrics is not None else RunMetrics()
+    BACKENDS = backends if backends is not None else Backends()
+    _SHUTDOWN.clear()
+    if env is None:
+        load_env()
+        env = os.environ
+    accounts_file = env.get("ACCOUNTS_FILE")
+    if accounts_file:
+        run_accounts(accounts_file)
+        return
+    backfill_source = env.get("BACKFILL_SOURCE")
+    profile_path = env.get("PROFILE_OUTPUT")
+    profiler = None
+    if profile_path:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if backfill_source:
+            run_backfill(backfill_source, env)
+        else:
+            run(env)
+    finally:
+        if GEMINI_CLIENT is not None:
+            GEMINI_CLIENT.close()
+        GEMINI_CLIENT = None
+        EVENT_INDEX = None
+        _close_http_session()
+        if profiler is not None:
+            profiler.disable()
+            try:
+                profiler.dump_stats(profile_path)
+                logging.info("Profilo cProfile salvato in %s (leggibile con: python -m pstats %s)", profile_path, profile_path)
+            except Exception as e:
+                logging.warning("Salvataggio profilo cProfile non riuscito: %s", e)
+        write_run_report()
+
+
+def _run_deadline(env: Optional[Mapping[str, str]] = None) -> Optional[float]:
+    """Scadenza dell'esecuzione (epoch) da RUN_DEADLINE_AT, o da RUN_DEADLINE_SECS contati dall'avvio del processo."""
+    at = env_float("RUN_DEADLINE_AT", 0.0, env)
+    if at > 0:
+        return at
+    secs = env_float("RUN_DEADLINE_SECS", 0.0, env)
+    if secs > 0:
+        return time.time() - (time.perf_counter() - _STARTUP_T0) + secs
+    return None
+
+
+def configure(env: Optional[Mapping[str, str]] = None) -> None:
+    """Legge la configurazione dalle variabili d'ambiente (o da 'env') nei globali del modulo."""
+    global MODEL, TIMEZONE, MAX_UNREAD_TO_PROCESS, PER_EMAIL_SLEEP_SECS
+    global SETTINGS, RATE_LIMITER, PREFILTER, RUN_DEADLINE, SENDER_TEMPLATES
+    env = os.environ if env is None else env
+
+    # Inizializza variabili globali DOPO aver caricato il .env
+    MODEL = env.get("GEMINI_MODEL", "gemini-2.5-pro")
+    TIMEZONE = env.get("TIMEZONE", "Europe/Rome")
+    MAX_UNREAD_TO_PROCESS = env_int("MAX_UNREAD_TO_PROCESS", 10, env)
+    PER_EMAIL_SLEEP_SECS = env_float("PER_EMAIL_SLEEP_SECS", 0.0, env)
+    SETTINGS = load_settings(env, DEFAULT_STATE_DIR)
+    # Oggetti di un'esecuzione precedente nello stesso processo: ricreati solo se abilitati
+    PREFILTER = SENDER_TEMPLATES = RATE_LIMITER = None
+    # Il demone non ha una fine prefissata: la scadenza vale solo per le esecuzioni singole
+    RUN_DEADLINE = None if SETTINGS.daemon_mode else _run_deadline(env)
+    if SETTINGS.prefilter_enabled:
+        PREFILTER = EmailPrefilter(
+            threshold=env_float("PREFILTER_THRESHOLD", 0.3, env),
+            allow_senders=EmailPrefilter.split_list(env.get("PREFILTER_ALLOW_SENDERS")),
+            deny_senders=EmailPrefilter.split_list(env.get("PREFILTER_DENY_SENDERS")),
+            allow_labels=EmailPrefilter.split_list(env.get("PREFILTER_ALLOW_LABELS")),
+            deny_labels=EmailPrefilter.split_list(env.get("PREFILTER_DENY_LABELS")),
+        )
+    if env_bool("SENDER_TEMPLATES_ENABLED", False, env):
+        SENDER_TEMPLATES = SenderTemplates(
+            os.path.join(SETTINGS.state_dir, "sender_templates.json"),
+            min_examples=env_int("SENDER_TEMPLATE_MIN_EXAMPLES", 3, env),
+            verify_rate=env_float("SENDER_TEMPLATE_VERIFY_RATE", 0.1, env),
+            metrics=METRICS,
+        )
+    if env_bool("GEMINI_RATE_LIMITER", True, env):
+        RATE_LIMITER = GeminiRateLimiter(
+            os.path.join(SETTINGS.state_dir, "gemini_budget.json"),
+            GeminiRateLimiter.parse_limits(env.get("GEMINI_RATE_LIMITS", "")),
+            max_wait=env_float("GEMINI_MAX_WAIT_SECS", GEMINI_MAX_WAIT_DEFAULT_SECS, env),
+        )
+    if SHARED_GEMINI_BUDGET is not None:
+        # Multi-account: budget dell'account (se configurato) più il budget globale condiviso
+        RATE_LIMITER = CombinedRateLimiter(
+            [limiter for limiter in (RATE_LIMITER, SHARED_GEMINI_BUDGET) if limiter is not None],
+            max_wait=env_float("GEMINI_MAX_WAIT_SECS", GEMINI_MAX_WAIT_DEFAULT_SECS, env),
+        )
+
+
+def run(env: Optional[Mapping[str, str]] = None) -> None:
+    global GEMINI_CLIENT, EVENT_INDEX, SCHEDULER
+
+    _startup_mark("import")
+    setup_logging()
+    if env is None:
+        load_env()
+        env = os.environ
+    configure(env)
+
     # Scrive i file credenziali da Secrets (se presenti, tipicamente in CI)
-    setup_credentials_from_ci_env()
+    setup_credentials_from_ci_env(env)
 
     # Pre-check chiave Gemini
-    if not os.getenv("GEMINI_API_KEY"):
+    if not env.get("GEMINI_API_KEY"):
         logging.error("Variabile GEMINI_API_KEY mancante. Inserirla in .env o nell'ambiente.")
         return
 
     # In CI, verifica preliminare del token e degli scope per messaggi più chiari
-    if os.environ.get("GITHUB_ACTIONS") or os.environ.get("CI"):
+    if env.get("GITHUB_ACTIONS") or env.get("CI"):
         token_issue = _validate_token_file(SCOPES)
         if token_issue:
             logging.error(
@@ -608,7 +2448,7 @@ def main() -> None:
             return
 
     try:
-        creds = get_credentials()
+        creds = BACKENDS.credentials()
     except Exception as e:
         logging.exception(
             "Errore durante autenticazione Google: %s. "
@@ -618,11 +2458,65 @@ def main() -> None:
         )
         return
 
-    gmail, calendar = build_services(creds)
+    ledger: Optional[ProcessedLedger] = None
+    if SETTINGS.ledger_enabled:
+        try:
+            ledger = ProcessedLedger(os.path.join(SETTINGS.state_dir, "processed_ledger.jsonl"), SETTINGS.ledger_ttl_days)
+        except Exception as e:
+            logging.warning("Registro email elaborate non disponibile: %s", e)
+    # Priorità e rinvii servono solo con una scadenza (RUN_DEADLINE_AT o RUN_DEADLINE_SECS)
+    SCHEDULER = None
+    if RUN_DEADLINE is not None:
+        SCHEDULER = RunScheduler(os.path.join(SETTINGS.state_dir, "scheduler.json"), RUN_DEADLINE, ledger, SETTINGS.priority_order, METRICS)
+        logging.info("Scadenza dell'esecuzione tra %.0f secondi", SCHEDULER.remaining())
+
+    logging.info("Limiterò l'elaborazione a massimo %d email non lette (configurabile con MAX_UNREAD_TO_PROCESS)", MAX_UNREAD_TO_PROCESS)
+    sync = GmailHistorySync(os.path.join(SETTINGS.state_dir, "gmail_history.json")) if SETTINGS.incremental_sync else None
+    _startup_mark("credenziali e stato")
+
+    gmail, calendar = BACKENDS.services(creds)
+    _startup_mark("servizi Google")
+
+    # Uscita anticipata: senza posta da valutare non servono SDK Gemini e bs4
+    if not SETTINGS.daemon_mode and env_bool("FAST_START", True, env) and not has_pending_work(gmail, ledger, sync):
+        _startup_mark("controllo rapido")
+        logging.info("Nessuna email non letta: nulla da fare.")
+        _log_startup_report()
+        return
+
+    try:
+        GEMINI_CLIENT = GeminiClient(
+            env["GEMINI_API_KEY"],
+            breaker_path=os.path.join(SETTINGS.state_dir, "gemini_breaker.json"),
+            cooldown_secs=env_float("GEMINI_BREAKER_COOLDOWN_SECS", 6 * 3600, env),
+            sdk=BACKENDS.gemini_sdk,
+            metrics=METRICS,
+            **_gemini_client_options(env),
+        )
+    except Exception as e:
+        logging.error("SDK Gemini non disponibile: %s", e)
+        return
+    _startup_mark("SDK Gemini")
+
+    if env_bool("EVENT_INDEX_ENABLED", False, env):
+        index = CalendarEventIndex(
+            os.path.join(SETTINGS.state_dir, "calendar_index.json"),
+            past_days=env_int("EVENT_INDEX_PAST_DAYS", 30, env),
+            future_days=env_int("EVENT_INDEX_FUTURE_DAYS", 400, env),
+        )
+        try:
+            index.sync(calendar, SETTINGS.calendar_id)
+            EVENT_INDEX = index
+        except Exception as e:
+            logging.warning("Indice eventi non disponibile, nessun controllo duplicati: %s", e)
+    _log_startup_report()
+
+    if SETTINGS.daemon_mode:
+        run_daemon(creds, gmail, calendar, ledger, sync)
+        return
 
     try:
-        logging.info("Limiterò l'elaborazione a massimo %d email non lette (configurabile con MAX_UNREAD_TO_PROCESS)", MAX_UNREAD_TO_PROCESS)
-        messages = list_unread_messages(gmail, limit=MAX_UNREAD_TO_PROCESS)
+        messages = list_candidate_messages(gmail, ledger, sync)
     except Exception as e:
         logging.exception("Errore leggendo le email: %s", e)
         return
@@ -631,28 +2525,479 @@ def main() -> None:
         logging.info("Nessuna email non letta: nulla da fare.")
         return
 
+    try:
+        process_messages(creds, gmail, calendar, messages, ledger)
+    finally:
+        save_state(ledger)
+
+
+def list_candidate_messages(gmail, ledger: Optional[ProcessedLedger] = None,
+                            sync: Optional[GmailHistorySync] = None) -> List[Dict]:
+    if sync is not None:
+        messages = sync.list_candidates(gmail, limit=MAX_UNREAD_TO_PROCESS, exclude=ledger)
+    else:
+        messages = list_unread_messages(gmail, limit=MAX_UNREAD_TO_PROCESS, exclude=ledger)
+    if SCHEDULER is not None and SCHEDULER.carried:
+        messages = SCHEDULER.with_carried(messages, MAX_UNREAD_TO_PROCESS, exclude=ledger)
+    return messages
+
+
+def process_messages(creds: Credentials, gmail, calendar, messages: List[Dict],
+                     ledger: Optional[ProcessedLedger] = None) -> None:
     logging.info("%d email non lette da elaborare (cap impostato a %d)", len(messages), MAX_UNREAD_TO_PROCESS)
-    for m in messages:
-        msg_id = m.get("id")
-        if not msg_id:
+    if SETTINGS.pipeline_mode:
+        run_pipeline(creds, messages, ledger)
+    else:
+        _process_messages(gmail, calendar, messages, ledger)
+
+
+def save_state(ledger: Optional[ProcessedLedger] = None) -> None:
+    """Salva su disco lo stato condiviso tra le esecuzioni (registro, budget, breaker, indice, modelli)."""
+    if ledger is not None:
+        try:
+            ledger.compact()
+        except Exception as e:
+            logging.warning("Compattazione registro non riuscita: %s", e)
+    if RATE_LIMITER is not None:
+        try:
+            RATE_LIMITER.save()
+        except Exception as e:
+            logging.warning("Salvataggio budget Gemini non riuscito: %s", e)
+    if GEMINI_CLIENT is not None:
+        try:
+            GEMINI_CLIENT.save()
+        except Exception as e:
+            logging.warning("Salvataggio circuit breaker Gemini non riuscito: %s", e)
+    if EVENT_INDEX is not None:
+        try:
+            EVENT_INDEX.save()
+        except Exception as e:
+            logging.warning("Salvataggio indice eventi non riuscito: %s", e)
+    if SCHEDULER is not None:
+        try:
+            SCHEDULER.save()
+        except Exception as e:
+            logging.warning("Salvataggio stato dello scheduler non riuscito: %s", e)
+    if SENDER_TEMPLATES is not None:
+        try:
+            SENDER_TEMPLATES.save()
+        except Exception as e:
+            logging.warning("Salvataggio modelli per mittente non riuscito: %s", e)
+
+
+def write_run_report() -> None:
+    """Scrive il riepilogo JSON dell'esecuzione e l'export Prometheus, e registra le fasi più lente."""
+    summary = METRICS.summary()
+    summary["mode"] = {
+        "model": MODEL,
+        "pipeline": SETTINGS.pipeline_mode,
+        "gemini_batch": SETTINGS.gemini_batch_mode,
+        "cascade": SETTINGS.cascade_mode,
+        "bulk_writes": SETTINGS.bulk_writes,
+        "structured_output": SETTINGS.structured_output,
+        "ics_fast_path": SETTINGS.ics_fast_path,
+        "incremental_sync": SETTINGS.incremental_sync,
+        "daemon": SETTINGS.daemon_mode,
+        "backfill": bool(SETTINGS.backfill_source),
+        "priority_order": SETTINGS.priority_order,
+        "sender_templates": SENDER_TEMPLATES is not None,
+        "gmail_prescreen": SETTINGS.gmail_prescreen,
+        "http_shared_session": SETTINGS.http_shared_session,
+        "deadline": datetime.fromtimestamp(RUN_DEADLINE).isoformat(timespec="seconds") if RUN_DEADLINE else None,
+    }
+    totals = sorted(
+        ((name, sum(v["total_secs"] for v in by_label.values())) for name, by_label in summary["stages"].items()),
+        key=lambda item: item[1], reverse=True,
+    )
+    if totals:
+        logging.info(
+            "Riepilogo esecuzione: %.1fs; fasi più lente: %s",
+            summary["duration_secs"], ", ".join(f"{name} {secs:.2f}s" for name, secs in totals[:3]),
+        )
+    tokens: Dict[str, float] = {}
+    for labels, value in summary["counters"].get("gemini_tokens", {}).items():
+        kind = dict(item.split("=", 1) for item in labels.split(",") if "=" in item).get("tipo", "")
+        tokens[kind] = tokens.get(kind, 0) + value
+    requests = sum(summary["counters"].get("gemini_requests", {}).values())
+    if requests:
+        logging.info(
+            "Token Gemini per richiesta: %.0f in ingresso (istruzioni %.0f, da cache %.0f), %.0f in risposta",
+            tokens.get("prompt", 0) / requests, tokens.get("istruzioni", 0) / requests,
+            tokens.get("cache", 0) / requests, tokens.get("risposta", 0) / requests,
+        )
+    outputs = [
+        (SETTINGS.run_report_file, lambda path: write_json_file(path, json.dumps(summary, ensure_ascii=False, indent=2))),
+        (SETTINGS.metrics_textfile, lambda path: write_text_file(path, METRICS.to_prometheus())),
+    ]
+    for path, write in outputs:
+        if not path:
             continue
         try:
-            process_email(gmail, calendar, msg_id)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            write(path)
+        except Exception as e:
+            logging.warning("Scrittura report di esecuzione %s non riuscita: %s", path, e)
+
+
+def _gemini_models_in_use() -> List[str]:
+    models = [MODEL or "gemini-2.5-pro"]
+    if models[0] == "gemini-2.5-pro":
+        models.append("gemini-2.5-flash")
+    if SETTINGS.cascade_mode:
+        models += [SETTINGS.cascade_fast_model, SETTINGS.cascade_strong_model]
+    return [m for m in dict.fromkeys(models) if m]
+
+
+def _next_poll_interval(current: float, found: int, failed: bool) -> float:
+    """Intervallo adattivo: minimo se c'è posta, cresce del 50% a vuoto e raddoppia sugli errori."""
+    if failed:
+        return min(SETTINGS.daemon_poll_max_secs, max(SETTINGS.daemon_poll_min_secs, current * 2))
+    if found:
+        return SETTINGS.daemon_poll_min_secs
+    return min(SETTINGS.daemon_poll_max_secs, max(SETTINGS.daemon_poll_min_secs, current * 1.5))
+
+
+def _write_health(health: Dict) -> None:
+    if not SETTINGS.daemon_health_file:
+        return
+    try:
+        os.makedirs(os.path.dirname(SETTINGS.daemon_health_file) or ".", exist_ok=True)
+        write_json_file(SETTINGS.daemon_health_file, json.dumps(health, ensure_ascii=False))
+    except Exception as e:
+        logging.warning("Scrittura file di stato del demone non riuscita: %s", e)
+
+
+def run_daemon(creds: Credentials, gmail, calendar, ledger: Optional[ProcessedLedger] = None,
+               sync: Optional[GmailHistorySync] = None) -> None:
+    """Modalità demone: polling adattivo con credenziali e servizi in memoria."""
+    def _on_signal(signum, frame):
+        logging.info("Segnale %s ricevuto: arresto del demone dopo le scritture in corso", signum)
+        _SHUTDOWN.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, _on_signal)
+
+    health: Dict = {
+        "pid": os.getpid(),
+        "status": "starting",
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "cycles": 0,
+        "processed": 0,
+        "errors": 0,
+        "consecutive_errors": 0,
+        "last_cycle_at": None,
+        "last_success_at": None,
+        "last_error": None,
+        "next_poll_secs": None,
+    }
+    logging.info("Modalità demone attiva: polling tra %.0fs e %.0fs", SETTINGS.daemon_poll_min_secs, SETTINGS.daemon_poll_max_secs)
+    interval = SETTINGS.daemon_poll_min_secs
+    while not _SHUTDOWN.is_set():
+        found = 0
+        failed = False
+        wait_secs: Optional[float] = None
+        health["status"] = "running"
+        try:
+            blocked = GEMINI_CLIENT.blocked_for(_gemini_models_in_use()) if GEMINI_CLIENT is not None else 0.0
+            if blocked > 0:
+                logging.info("Modelli Gemini esclusi dal circuit breaker: salto il ciclo (%.0fs)", blocked)
+                health["status"] = "gemini_bloccato"
+                wait_secs = min(blocked, SETTINGS.daemon_poll_max_secs)
+            else:
+                _refresh_credentials(creds)
+                messages = list_candidate_messages(gmail, ledger, sync)
+                found = len(messages)
+                if messages:
+                    if EVENT_INDEX is not None:
+                        try:
+                            EVENT_INDEX.sync(calendar, SETTINGS.calendar_id)
+                        except Exception as e:
+                            logging.warning("Aggiornamento indice eventi non riuscito: %s", e)
+                    process_messages(creds, gmail, calendar, messages, ledger)
+                health["processed"] += found
+            health["consecutive_errors"] = 0
+            health["last_success_at"] = datetime.now().isoformat(timespec="seconds")
+        except Exception as e:
+            failed = True
+            logging.exception("Errore nel ciclo del demone: %s", e)
+            health["errors"] += 1
+            health["consecutive_errors"] += 1
+            health["last_error"] = str(e)[:500]
+        finally:
+            save_state(ledger)
+            write_run_report()
+        interval = _next_poll_interval(interval, found, failed)
+        if wait_secs is None:
+            wait_secs = interval
+        health["cycles"] += 1
+        health["last_cycle_at"] = datetime.now().isoformat(timespec="seconds")
+        health["next_poll_secs"] = round(wait_secs, 1)
+        _write_health(health)
+        _SHUTDOWN.wait(wait_secs)
+
+    health["status"] = "stopped"
+    health["next_poll_secs"] = None
+    _write_health(health)
+    logging.info("Demone arrestato")
+
+
+def _log_rate_limit(e: RateLimitExceeded) -> None:
+    if e.retry_after_seconds:
+        logging.error(
+            "Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Interrompo il batch.",
+            e.retry_after_seconds,
+        )
+    else:
+        logging.error("Quota Gemini esaurita (429). Interrompo il batch.")
+
+
+def _process_messages(gmail, calendar, messages: List[Dict], ledger: Optional[ProcessedLedger] = None) -> None:
+    if SETTINGS.bulk_writes:
+        writer = BulkWriter(gmail, calendar, ledger)
+        try:
+            _process_messages_with(gmail, calendar, messages, ledger, writer)
+        finally:
+            writer.flush()
+        return
+    _process_messages_with(gmail, calendar, messages, ledger)
+
+
+def _process_messages_with(gmail, calendar, messages: List[Dict], ledger: Optional[ProcessedLedger] = None,
+                           writer: Optional[BulkWriter] = None) -> None:
+    thread_of = {m["id"]: m.get("threadId") for m in messages if m.get("id")} if SETTINGS.thread_coalesce else None
+    if SETTINGS.thread_coalesce:
+        messages = [m for group in group_by_thread(messages) for m in group]
+    msg_ids = [m.get("id") for m in messages if m.get("id")]
+    metadata = None
+    if SCHEDULER is not None:
+        # Priorità sui metadati: il download completo procede in quell'ordine e si ferma alla scadenza
+        metadata = fetch_metadata(gmail, msg_ids, batch_size=SETTINGS.batch_fetch_size or 50)
+        msg_ids = [msg_id for _, msg_id in rank_by_metadata(msg_ids, metadata, thread_of)]
+    if SETTINGS.gmail_prescreen:
+        msg_ids = prescreen_messages(gmail, msg_ids, ledger, thread_of, batch_size=SETTINGS.batch_fetch_size or 50, metadata=metadata)
+    if SETTINGS.batch_fetch_size and SETTINGS.batch_fetch_size > 1:
+        fetched = fetch_messages_batch(gmail, msg_ids, batch_size=SETTINGS.batch_fetch_size)
+    else:
+        fetched = _fetch_messages_sequential(gmail, msg_ids)
+    if SETTINGS.thread_coalesce:
+        fetched = coalesce_thread_records(fetched, thread_of)
+    if SETTINGS.gemini_batch_mode:
+        _process_fetched_batch_mode(gmail, calendar, fetched, ledger, writer)
+        return
+    handled = set()
+    for record in fetched:
+        msg_id = record.msg_id
+        if _SHUTDOWN.is_set():
+            logging.info("Arresto richiesto: le email rimanenti verranno elaborate al prossimo avvio")
+            break
+        if SCHEDULER is not None and not SCHEDULER.can_dispatch():
+            SCHEDULER.defer([i for i in msg_ids if i not in handled])
+            break
+        handled.add(msg_id)
+        handled.update(record.siblings)
+        try:
+            if writer is not None:
+                decision = analyze_email(record, ledger)
+                if decision is not None:
+                    writer.add(msg_id, decision)
+            else:
+                process_fetched_email(gmail, calendar, record, ledger)
+            # Pausa fissa solo se configurata: il rate limiter da solo non la richiede
             if PER_EMAIL_SLEEP_SECS > 0:
                 time.sleep(PER_EMAIL_SLEEP_SECS)
         except RateLimitExceeded as e:
-            if e.retry_after_seconds:
-                logging.error(
-                    "Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Interrompo il batch.",
-                    e.retry_after_seconds,
-                )
-            else:
-                logging.error("Quota Gemini esaurita (429). Interrompo il batch.")
+            _log_rate_limit(e)
             break
         except Exception as e:
             logging.exception("Errore elaborando email %s: %s", msg_id, e)
             # Non marcata come letta in caso di errore
 
 
+def _process_fetched_batch_mode(gmail, calendar, fetched, ledger: Optional[ProcessedLedger] = None,
+                                writer: Optional[BulkWriter] = None) -> None:
+    try:
+        for msg_id, decision in analyze_emails_batch(fetched, ledger):
+            if decision is None:
+                continue
+            if writer is not None:
+                writer.add(msg_id, decision)
+                continue
+            try:
+                apply_event_decision(gmail, calendar, msg_id, decision, ledger)
+            except Exception as e:
+                logging.exception("Errore elaborando email %s: %s", msg_id, e)
+                # Non marcata come letta in caso di errore
+    except RateLimitExceeded as e:
+        _log_rate_limit(e)
+
+
+def run_pipeline(creds: Credentials, messages: List[Dict], ledger: Optional[ProcessedLedger] = None) -> None:
+    """Esecuzione a pipeline: download, analisi Gemini e scritture si sovrappongono.
+    L'email è marcata come letta nello stesso task che crea l'evento.
+    """
+    stop = threading.Event()
+    local = threading.local()
+    acquired: List[Tuple] = []
+
+    def _services():
+        if not hasattr(local, "services"):
+            local.services = _acquire_services(creds)
+            acquired.append(local.services)
+        return local.services
+
+    thread_of = {m["id"]: m.get("threadId") for m in messages if m.get("id")}
+    metadata: Optional[Dict[str, Dict]] = None
+    priority: Dict[str, float] = {}
+    if SCHEDULER is not None:
+        # Priorità sui metadati prima del download: i blocchi partono dalle email più promettenti
+        services = _acquire_services(creds)
+        acquired.append(services)
+        msg_ids = [m.get("id") for m in messages if m.get("id")]
+        metadata = fetch_metadata(services[0], msg_ids, batch_size=SETTINGS.batch_fetch_size or 50)
+        ranked = rank_by_metadata(msg_ids, metadata, thread_of if SETTINGS.thread_coalesce else None)
+        priority = {msg_id: score for score, msg_id in ranked}
+        by_id = {m["id"]: m for m in messages if m.get("id")}
+        messages = [by_id[msg_id] for _, msg_id in ranked]
+
+    def _fetch(chunk: List[str]) -> List[EmailRecord]:
+        if stop.is_set() or _SHUTDOWN.is_set():
+            return []
+        if SCHEDULER is not None and not SCHEDULER.can_dispatch():
+            SCHEDULER.defer(chunk)
+            return []
+        gmail, _ = _services()
+        if SETTINGS.gmail_prescreen:
+            chunk = prescreen_messages(
+                gmail, chunk, ledger, thread_of if SETTINGS.thread_coalesce else None,
+                batch_size=SETTINGS.batch_fetch_size or 50, metadata=metadata,
+            )
+        if SETTINGS.batch_fetch_size and SETTINGS.batch_fetch_size > 1:
+            fetched = list(fetch_messages_batch(gmail, chunk, batch_size=SETTINGS.batch_fetch_size))
+        else:
+            fetched = list(_fetch_messages_sequential(gmail, chunk))
+        if SETTINGS.thread_coalesce:
+            return list(coalesce_thread_records(fetched, thread_of))
+        return fetched
+
+    def _analyze(record: EmailRecord) -> Optional[Dict]:
+        if stop.is_set() or _SHUTDOWN.is_set():
+            return None
+        try:
+            return analyze_email(record, ledger)
+        except RateLimitExceeded as e:
+            if not stop.is_set():
+                stop.set()
+                logging.error(
+                    "Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Non avvio nuove analisi.",
+                    e.retry_after_seconds,
+                )
+            return None
+
+    def _analyze_batch(records: List[EmailRecord]) -> List[Tuple[str, Optional[Dict]]]:
+        results: List[Tuple[str, Optional[Dict]]] = []
+        if stop.is_set() or _SHUTDOWN.is_set():
+            return results
+        try:
+            for pair in analyze_emails_batch(records, ledger):
+                results.append(pair)
+        except RateLimitExceeded as e:
+            if not stop.is_set():
+                stop.set()
+                logging.error(
+                    "Quota Gemini esaurita (429). Suggerito retry dopo %s secondi. Non avvio nuove analisi.",
+                    e.retry_after_seconds,
+                )
+        return results
+
+    writer: Optional[BulkWriter] = None
+    if SETTINGS.bulk_writes:
+        services = _acquire_services(creds)
+        acquired.append(services)
+        writer = BulkWriter(*services, ledger=ledger)
+
+    def _write(msg_id: str, decision: Dict) -> None:
+        if writer is not None:
+            # Scrittura rimandata: il flush avviene nel thread principale a fine pipeline
+            writer.add(msg_id, decision, auto_flush=False)
+            return
+        gmail, calendar = _services()
+        apply_event_decision(gmail, calendar, msg_id, decision, ledger)
+
+    msg_ids = [m.get("id") for m in messages if m.get("id")]
+    chunk_size = SETTINGS.batch_fetch_size if SETTINGS.batch_fetch_size and SETTINGS.batch_fetch_size > 1 else 1
+    # Blocchi piccoli abbastanza da alimentare subito tutti i worker Gemini
+    chunk_size = max(1, min(chunk_size, -(-len(msg_ids) // SETTINGS.fetch_workers) if msg_ids else 1))
+    chunks: List[List[str]] = []
+    if SETTINGS.thread_coalesce:
+        # Una conversazione non viene mai divisa tra due blocchi
+        for group in group_by_thread(messages):
+            ids = [m["id"] for m in group]
+            if chunks and len(chunks[-1]) + len(ids) <= chunk_size:
+                chunks[-1].extend(ids)
+            else:
+                chunks.append(ids)
+    else:
+        chunks = [msg_ids[i:i + chunk_size] for i in range(0, len(msg_ids), chunk_size)]
+
+    fetch_pool = ThreadPoolExecutor(max_workers=SETTINGS.fetch_workers, thread_name_prefix="fetch")
+    gemini_pool = ThreadPoolExecutor(max_workers=SETTINGS.gemini_workers, thread_name_prefix="gemini")
+    write_pool = ThreadPoolExecutor(max_workers=SETTINGS.write_workers, thread_name_prefix="write")
+    stages: Dict = {}
+    # Email scaricate in attesa di analisi: escono dalla coda per punteggio, non in ordine d'arrivo
+    ready: List[Tuple[float, int, EmailRecord]] = []
+    arrivals = itertools.count()
+
+    def _dispatch() -> None:
+        busy = sum(1 for stage, _ in stages.values() if stage == "gemini")
+        while ready and busy < SETTINGS.gemini_workers:
+            _, _, record = heapq.heappop(ready)
+            stages[gemini_pool.submit(_analyze, record)] = ("gemini", record.msg_id)
+            busy += 1
+
+    try:
+        for chunk in chunks:
+            stages[fetch_pool.submit(_fetch, chunk)] = ("fetch", None)
+
+        while stages or ready:
+            _dispatch()
+            done, _ = wait(list(stages), return_when=FIRST_COMPLETED)
+            for fut in done:
+                stage, msg_id = stages.pop(fut)
+                if fut.cancelled():
+                    continue
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    logging.exception("Errore nella fase %s (email %s): %s", stage, msg_id, e)
+                    # Non marcata come letta in caso di errore
+                    continue
+                if stage == "fetch":
+                    if SETTINGS.gemini_batch_mode and result:
+                        stages[gemini_pool.submit(_analyze_batch, result)] = ("gemini_batch", None)
+                        continue
+                    for record in result:
+                        heapq.heappush(ready, (-priority.get(record.msg_id, 0.0), next(arrivals), record))
+                elif stage == "gemini_batch":
+                    for decided_id, decision in result:
+                        if decision is not None:
+                            stages[write_pool.submit(_write, decided_id, decision)] = ("write", decided_id)
+                elif stage == "gemini" and result is not None:
+                    stages[write_pool.submit(_write, msg_id, result)] = ("write", msg_id)
+            if stop.is_set():
+                # Annulla download e analisi non ancora avviati; le scritture proseguono
+                ready.clear()
+                for fut, (stage, _) in list(stages.items()):
+                    if stage != "write" and fut.cancel():
+                        stages.pop(fut)
+    finally:
+        fetch_pool.shutdown(wait=True)
+        gemini_pool.shutdown(wait=True)
+        write_pool.shutdown(wait=True)
+        if writer is not None:
+            writer.flush()
+        for services in acquired:
+            _release_services(services)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,792 @@
+"""Benchmark offline di ControllaEmailCreaEvento.py.
+
+Gmail, Calendar e Gemini finti su una casella sintetica o su fixture registrate.
+
+Esempi:
+    python benchmark.py
+    python benchmark.py --emails 500 --gemini-latency 0.8 --rate-429 0.05
+    python benchmark.py --bench main --env PIPELINE_MODE=true --env BULK_WRITES=true
+    python benchmark.py --save-fixtures casella.json
+    python benchmark.py --fixtures casella.json --output bench.json
+
+Formato delle fixture (JSON):
+    {"messages": [<risorse Gmail in formato "full">],
+     "gemini": {"<oggetto email>": {<risposta JSON registrata>}}}
+Le risposte registrate hanno la precedenza su quelle generate dal Gemini finto.
+"""
+
+import argparse
+import base64
+import copy
+import json
+import logging
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import httplib2
+from google.api_core import exceptions as api_exceptions
+from googleapiclient.errors import HttpError
+
+import ControllaEmailCreaEvento as agent
+
+
+# ---------------------------------------------------------------------------
+# Casella sintetica
+# ---------------------------------------------------------------------------
+
+_EVENTS = ["Riunione", "Consegna", "Visita", "Cena", "Webinar", "Colloquio", "Scadenza", "Assemblea"]
+_TOPICS = ["progetto Alfa", "condominio", "dentista", "cliente Rossi", "corso di formazione",
+           "revisione bilancio", "squadra di calcetto", "fornitore Beta"]
+_SENDERS = ["mario.rossi@example.com", "ufficio@condominio.example", "segreteria@studio.example",
+            "news@negozio.example", "team@progetto.example"]
+_FILLER = (
+    "Ti scrivo per aggiornarti sullo stato delle attività e sui prossimi passi concordati. "
+    "Abbiamo raccolto i commenti di tutti e preparato una nuova versione del documento. "
+)
+_SIGNATURE = "--\nMario Rossi\nResponsabile progetto\nTel. +39 02 1234567"
+_DISCLAIMER = (
+    "Questo messaggio e i suoi allegati sono indirizzati esclusivamente alle persone indicate. "
+    "La diffusione, copia o qualsiasi altra azione derivante dalla conoscenza di queste informazioni "
+    "sono rigorosamente vietate."
+)
+_CSS = "".join(f".c{i}{{font-family:Arial;color:#{i:06x};padding:{i % 9}px}}" for i in range(400))
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def _part(mime: str, text: str) -> Dict:
+    return {"mimeType": mime, "body": {"data": _b64(text), "size": len(text)}}
+
+
+def _event_sentence(rng: random.Random, base: datetime) -> str:
+    when = base + timedelta(days=rng.randint(1, 60))
+    return f"Ci vediamo il {when:%d/%m/%Y} alle {rng.randint(8, 19):02d}:{rng.choice([0, 15, 30, 45]):02d} presso la sala riunioni."
+
+
+def _html_heavy(sentence: str, rng: random.Random) -> str:
+    rows = "".join(
+        f'<tr><td class="c{i}">Articolo {i}</td><td class="c{i + 1}">{rng.randint(5, 500)},00 &euro;</td></tr>'
+        for i in range(rng.randint(80, 300))
+    )
+    return (
+        f"<html><head><style>{_CSS}</style></head><body>"
+        f'<div class="c1"><p>{_FILLER}</p><p>{sentence}</p></div>'
+        f"<table>{rows}</table>"
+        '<img src="https://track.example/pixel.gif" width="1" height="1">'
+        f"<p><small>{_DISCLAIMER}</small></p></body></html>"
+    )
+
+
+def _invite_ics(rng: random.Random, base: datetime, subject: str, uid: str) -> str:
+    start = (base + timedelta(days=rng.randint(1, 60))).replace(hour=rng.randint(8, 18), minute=rng.choice([0, 30]), second=0)
+    end = start + timedelta(minutes=rng.choice([30, 60, 90]))
+    lines = [
+        "BEGIN:VCALENDAR", "PRODID:-//Benchmark//IT", "VERSION:2.0", "METHOD:REQUEST",
+        "BEGIN:VEVENT", f"UID:{uid}", f"SUMMARY:{subject}",
+        f"DTSTART;TZID=Europe/Rome:{start:%Y%m%dT%H%M%S}", f"DTEND;TZID=Europe/Rome:{end:%Y%m%dT%H%M%S}",
+        "LOCATION:Sala riunioni", "END:VEVENT", "END:VCALENDAR",
+    ]
+    if rng.random() < 0.3:
+        lines.insert(-2, "RRULE:FREQ=WEEKLY;COUNT=4")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def generate_mailbox(count: int, seed: int = 42, event_ratio: float = 0.5) -> Dict:
+    """Genera 'count' messaggi Gmail non letti: testo semplice, multipart, HTML pesante, conversazioni lunghe e inviti."""
+    rng = random.Random(seed)
+    base = datetime.now()
+    messages: List[Dict] = []
+    kinds = ["testo", "multipart", "html", "conversazione", "newsletter", "invito"]
+    while len(messages) < count:
+        kind = rng.choice(kinds)
+        subject = f"{rng.choice(_EVENTS)} {rng.choice(_TOPICS)}"
+        sender = rng.choice(_SENDERS)
+        has_event = kind != "newsletter" and rng.random() < event_ratio
+        sentence = _event_sentence(rng, base) if has_event else "Restiamo in attesa di vostre notizie."
+        thread_id = f"t{len(messages):06d}"
+        attachments: Dict[str, str] = {}
+        if kind == "invito":
+            # Invito: text/calendar in linea (stile Google) oppure solo allegato .ics (stile Outlook)
+            ics = _invite_ics(rng, base, subject, f"{thread_id}@benchmark")
+            text = _part("text/plain", f"Sei stato invitato: {subject}.\n\n{_SIGNATURE}")
+            if rng.random() < 0.5:
+                parts = [{"mimeType": "multipart/alternative", "parts": [text, _part("text/calendar", ics)]}]
+            else:
+                attachments["ics1"] = _b64(ics)
+                parts = [text, {"mimeType": "application/ics", "filename": "invite.ics",
+                                "body": {"attachmentId": "ics1", "size": len(ics)}}]
+            payloads = [{"mimeType": "multipart/mixed", "parts": parts}]
+            subjects = [f"Invito: {subject}"]
+        elif kind == "conversazione":
+            bodies: List[str] = []
+            quoted = ""
+            for j in range(rng.randint(3, 8)):
+                own = f"{_FILLER}\n{sentence if j == 0 else 'Va bene, confermo.'}\n\n{_SIGNATURE}"
+                if quoted:
+                    quote = "\n".join("> " + line for line in quoted.splitlines())
+                    own += f"\n\nIl giorno lun 3 nov 2025 alle 10:{j:02d} {sender} ha scritto:\n{quote}"
+                bodies.append(own)
+                quoted = own
+            payloads = [{"mimeType": "text/plain", "body": _part("text/plain", b)["body"]} for b in bodies]
+            subjects = [subject] + [f"Re: {subject}"] * (len(bodies) - 1)
+        elif kind == "multipart":
+            text = f"{_FILLER}\n{sentence}\n\n{_SIGNATURE}\n\n{_DISCLAIMER}"
+            html = f"<div><p>{_FILLER}</p><p>{sentence}</p><div class=\"gmail_signature\">{_SIGNATURE}</div></div>"
+            payloads = [{
+                "mimeType": "multipart/mixed",
+                "parts": [
+                    {"mimeType": "multipart/alternative", "parts": [_part("text/plain", text), _part("text/html", html)]},
+                    {"mimeType": "application/pdf", "filename": "documento.pdf",
+                     "body": {"attachmentId": "att1", "size": 123456}},
+                ],
+            }]
+            subjects = [subject]
+        elif kind == "html":
+            payloads = [_part("text/html", _html_heavy(sentence, rng))]
+            subjects = [subject]
+        elif kind == "newsletter":
+            payloads = [_part("text/html", _html_heavy("Scopri le offerte della settimana!", rng))]
+            subjects = [f"Newsletter {rng.choice(_TOPICS)}"]
+        else:
+            payloads = [_part("text/plain", f"{_FILLER * rng.randint(1, 6)}\n{sentence}\n\n{_SIGNATURE}\n\n{_DISCLAIMER}")]
+            subjects = [subject]
+        for payload, subj in zip(payloads, subjects):
+            if len(messages) >= count:
+                break
+            idx = len(messages)
+            payload = dict(payload)
+            payload["headers"] = [
+                {"name": "Subject", "value": subj},
+                {"name": "From", "value": sender},
+                {"name": "Content-Type", "value": payload.get("mimeType", "text/plain")},
+            ]
+            if kind == "newsletter":
+                payload["headers"].append({"name": "List-Unsubscribe", "value": "<https://example.com/disiscrivi>"})
+            message = {
+                "id": f"m{idx:06d}",
+                "threadId": thread_id,
+                "labelIds": ["UNREAD", "INBOX"],
+                "internalDate": str(int((base - timedelta(minutes=count - idx)).timestamp() * 1000)),
+                # Come Gmail: inizio del testo, circa 200 caratteri su una riga
+                "snippet": " ".join(agent._extract_text_from_payload(payload).split())[:200],
+                "payload": payload,
+            }
+            if attachments:
+                # Contenuto degli allegati, restituito dal finto attachments.get
+                message["_attachments"] = attachments
+            messages.append(message)
+    return {"messages": messages, "gemini": {}}
+
+
+# ---------------------------------------------------------------------------
+# Servizi finti
+# ---------------------------------------------------------------------------
+
+class Faults:
+    """Latenza e guasti simulati, condivisi dai servizi finti."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, rate_429: float = 0.0, seed: int = 7):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.injected: Dict[str, int] = {"429": 0, "5xx": 0}
+
+    def sleep(self) -> None:
+        if self.latency > 0:
+            with self._lock:
+                factor = self._rng.uniform(0.5, 1.5)
+            time.sleep(self.latency * factor)
+
+    def draw(self) -> Optional[int]:
+        """Codice HTTP da simulare per questa chiamata, oppure None."""
+        with self._lock:
+            r = self._rng.random()
+            if r < self.rate_429:
+                self.injected["429"] += 1
+                return 429
+            if r < self.rate_429 + self.error_rate:
+                self.injected["5xx"] += 1
+                return 503
+        return None
+
+
+def _http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({"status": str(status)}), b'{"error": {"message": "errore simulato"}}')
+
+
+class _Request:
+    def __init__(self, faults: Faults, fn):
+        self._faults = faults
+        self._fn = fn
+
+    def execute(self, num_retries: int = 0):
+        self._faults.sleep()
+        status = self._faults.draw()
+        if status is not None:
+            raise _http_error(status)
+        return self._fn()
+
+    def _run_in_batch(self):
+        # In un batch la latenza è pagata una volta sola per l'intera richiesta HTTP
+        status = self._faults.draw()
+        if status is not None:
+            raise _http_error(status)
+        return self._fn()
+
+
+class _Batch:
+    def __init__(self, faults: Faults, callback):
+        self._faults = faults
+        self._callback = callback
+        self._items: List = []
+
+    def add(self, request: _Request, request_id: Optional[str] = None, callback=None):
+        self._items.append((request_id or str(len(self._items)), request))
+
+    def execute(self):
+        self._faults.sleep()
+        for request_id, request in self._items:
+            try:
+                response = request._run_in_batch()
+            except HttpError as e:
+                self._callback(request_id, None, e)
+                continue
+            self._callback(request_id, response, None)
+
+
+class FakeGmail:
+    """Sottoinsieme dell'API Gmail v1 usato dallo script, su una casella in memoria."""
+
+    def __init__(self, messages: List[Dict], faults: Faults):
+        self.faults = faults
+        self._lock = threading.Lock()
+        self._messages = {m["id"]: copy.deepcopy(m) for m in messages}
+        self._order = sorted(self._messages, key=lambda i: int(self._messages[i].get("internalDate", 0)), reverse=True)
+        self._history: List[Dict] = []
+        self._history_id = 1000
+        self.calls: Dict[str, int] = {}
+        self.fetched: set = set()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _request(self, name: str, fn) -> _Request:
+        self._count(name)
+        return _Request(self.faults, fn)
+
+    # Risorse: gmail.users().messages() / .history() / .getProfile()
+    def users(self):
+        return self
+
+    def messages(self):
+        return _GmailMessages(self)
+
+    def history(self):
+        return _GmailHistory(self)
+
+    def getProfile(self, userId="me", **kwargs):
+        return self._request("getProfile", lambda: {"emailAddress": "bench@example.com", "historyId": str(self._history_id)})
+
+    def new_batch_http_request(self, callback=None):
+        self._count("batch")
+        return _Batch(self.faults, callback)
+
+    def unread_ids(self, exclude=None) -> List[str]:
+        with self._lock:
+            ids = [i for i in self._order if "UNREAD" in self._messages[i]["labelIds"]]
+        return [i for i in ids if not exclude or i not in exclude]
+
+    def _modify(self, msg_id: str, remove: List[str]) -> None:
+        with self._lock:
+            msg = self._messages.get(msg_id)
+            if msg is None:
+                raise _http_error(404)
+            removed = [label for label in remove if label in msg["labelIds"]]
+            msg["labelIds"] = [label for label in msg["labelIds"] if label not in remove]
+            if removed:
+                self._history_id += 1
+                self._history.append({
+                    "id": str(self._history_id),
+                    "labelsRemoved": [{"message": {"id": msg_id, "threadId": msg["threadId"], "labelIds": list(msg["labelIds"])},
+                                       "labelIds": removed}],
+                })
+
+
+class _GmailMessages:
+    def __init__(self, owner: FakeGmail):
+        self._owner = owner
+
+    def list(self, userId="me", q=None, pageToken=None, maxResults=100, **kwargs):
+        def _run():
+            ids = self._owner.unread_ids()
+            after = re.search(r"after:(\d+)", q or "")
+            if after:
+                ids = [i for i in ids if int(self._owner._messages[i].get("internalDate", 0)) // 1000 > int(after.group(1))]
+            start = int(pageToken or 0)
+            page = ids[start:start + int(maxResults or 100)]
+            resp = {"messages": [{"id": i, "threadId": self._owner._messages[i]["threadId"]} for i in page],
+                    "resultSizeEstimate": len(ids)}
+            if start + len(page) < len(ids):
+                resp["nextPageToken"] = str(start + len(page))
+            return resp
+        return self._owner._request("messages.list", _run)
+
+    def get(self, userId="me", id=None, format="full", metadataHeaders=None, **kwargs):
+        def _run():
+            msg = self._owner._messages.get(id)
+            if msg is None:
+                raise _http_error(404)
+            if format == "minimal":
+                return {k: msg[k] for k in ("id", "threadId", "labelIds", "internalDate", "snippet")}
+            if format == "metadata":
+                wanted = set(metadataHeaders or [])
+                headers = [h for h in msg["payload"].get("headers", []) if not wanted or h["name"] in wanted]
+                result = {k: msg[k] for k in ("id", "threadId", "labelIds", "internalDate", "snippet")}
+                result["payload"] = {"mimeType": msg["payload"].get("mimeType"), "headers": headers}
+                return result
+            with self._owner._lock:
+                self._owner.fetched.add(id)
+            return msg
+        return self._owner._request("messages.get", _run)
+
+    def modify(self, userId="me", id=None, body=None, **kwargs):
+        def _run():
+            self._owner._modify(id, (body or {}).get("removeLabelIds", []))
+            return {"id": id}
+        return self._owner._request("messages.modify", _run)
+
+    def batchModify(self, userId="me", body=None, **kwargs):
+        def _run():
+            for msg_id in (body or {}).get("ids", []):
+                self._owner._modify(msg_id, (body or {}).get("removeLabelIds", []))
+            return {}
+        return self._owner._request("messages.batchModify", _run)
+
+    def attachments(self):
+        return _GmailAttachments(self._owner)
+
+
+class _GmailAttachments:
+    def __init__(self, owner: FakeGmail):
+        self._owner = owner
+
+    def get(self, userId="me", messageId=None, id=None, **kwargs):
+        def _run():
+            data = (self._owner._messages.get(messageId) or {}).get("_attachments", {}).get(id, "")
+            return {"data": data, "size": len(data)}
+        return self._owner._request("attachments.get", _run)
+
+
+class _GmailHistory:
+    def __init__(self, owner: FakeGmail):
+        self._owner = owner
+
+    def list(self, userId="me", startHistoryId=None, pageToken=None, maxResults=500, **kwargs):
+        def _run():
+            start = int(startHistoryId or 0)
+            with self._owner._lock:
+                records = [h for h in self._owner._history if int(h["id"]) > start]
+                return {"history": records, "historyId": str(self._owner._history_id)}
+        return self._owner._request("history.list", _run)
+
+
+class FakeCalendar:
+    """Sottoinsieme dell'API Calendar v3 (events.insert/list) con eventi in memoria."""
+
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self._lock = threading.Lock()
+        self.events_created: List[Dict] = []
+        self.calls: Dict[str, int] = {}
+
+    def _request(self, name: str, fn) -> _Request:
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        return _Request(self.faults, fn)
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId="primary", body=None, **kwargs):
+        def _run():
+            with self._lock:
+                event = dict(body or {}, id=f"ev{len(self.events_created) + 1}", status="confirmed")
+                self.events_created.append(event)
+            return event
+        return self._request("events.insert", _run)
+
+    def list(self, calendarId="primary", syncToken=None, pageToken=None, **kwargs):
+        def _run():
+            with self._lock:
+                start = int(syncToken or 0)
+                return {"items": list(self.events_created[start:]), "nextSyncToken": str(len(self.events_created))}
+        return self._request("events.list", _run)
+
+    def new_batch_http_request(self, callback=None):
+        with self._lock:
+            self.calls["batch"] = self.calls.get("batch", 0) + 1
+        return _Batch(self.faults, callback)
+
+
+class _FakeUsage:
+    def __init__(self, prompt_tokens: int, response_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = response_tokens
+        self.total_token_count = prompt_tokens + response_tokens
+
+
+class _FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = _FakeUsage(prompt_tokens, len(text) // 4 + 1)
+
+
+_DATE_RE = re.compile(r"(\d{2})/(\d{2})/(\d{4})(?: alle (\d{2}):(\d{2}))?")
+_SUBJECT_RE = re.compile(r"^Oggetto: (.*)$", re.MULTILINE)
+_BATCH_SPLIT_RE = re.compile(r"^=== EMAIL (E\d+) ===$", re.MULTILINE)
+
+
+def fake_gemini_decision(text: str, recorded: Optional[Dict] = None) -> Dict:
+    """Risposta deterministica: evento se il testo contiene 'gg/mm/aaaa [alle hh:mm]'."""
+    subject_match = _SUBJECT_RE.search(text)
+    subject = subject_match.group(1).strip() if subject_match else ""
+    if recorded and subject in recorded:
+        return dict(recorded[subject])
+    m = _DATE_RE.search(text)
+    if not m:
+        return {"creare_evento": "no", "confidenza": 0.95}
+    result = {
+        "creare_evento": "si",
+        "titolo": subject or "Evento",
+        "data": f"{m.group(1)}-{m.group(2)}-{m.group(3)}",
+        "descrizione": "Evento generato dal benchmark",
+        "confidenza": 0.9,
+    }
+    if m.group(4):
+        result["ora_inizio"] = f"{m.group(4)}:{m.group(5)}"
+    return result
+
+
+def fake_structured_decision(text: str, recorded: Optional[Dict] = None) -> Dict:
+    """Come fake_gemini_decision, nel formato dell'output strutturato (un evento per ogni data)."""
+    legacy = fake_gemini_decision(text, recorded)
+    result = {"creare_evento": legacy.get("creare_evento", "no"), "eventi": [], "confidenza": legacy.get("confidenza", 0.9)}
+    if result["creare_evento"] != "si":
+        return result
+    if "eventi" in legacy:
+        result["eventi"] = legacy["eventi"]
+        return result
+    title = legacy.get("titolo") or "Evento"
+    for n, m in enumerate(_DATE_RE.finditer(text), 1):
+        result["eventi"].append({
+            "titolo": title if n == 1 else f"{title} ({n})",
+            "descrizione": legacy.get("descrizione", ""),
+            "data": f"{m.group(1)}-{m.group(2)}-{m.group(3)}",
+            "ora_inizio": f"{m.group(4)}:{m.group(5)}" if m.group(4) else None,
+            "ora_fine": None,
+            "luogo": None,
+        })
+    if not result["eventi"]:
+        # Risposta registrata in formato classico (fixture)
+        event = {k: legacy.get(k) for k in ("titolo", "descrizione", "data", "ora_inizio")}
+        result["eventi"] = [dict(event, ora_fine=None, luogo=None)]
+    return result
+
+
+class _FakeModel:
+    def __init__(self, sdk: "FakeGenai", name: str, system_instruction: Optional[str] = None):
+        self.sdk = sdk
+        self.name = name
+        self.system_instruction = system_instruction
+
+    def count_tokens(self, text: str):
+        return SimpleNamespace(total_tokens=len(text) // 4)
+
+    def generate_content(self, prompt: str, generation_config: Optional[Dict] = None):
+        sdk = self.sdk
+        with sdk.lock:
+            sdk.calls += 1
+        sdk.faults.sleep()
+        status = sdk.faults.draw()
+        if status == 429:
+            raise api_exceptions.ResourceExhausted("Resource has been exhausted (e.g. check quota). retry_delay { seconds: 1 }")
+        if status is not None:
+            raise api_exceptions.ServiceUnavailable("The service is currently unavailable.")
+        tokens = (len(prompt) + len(self.system_instruction or "")) // 4
+        decide = fake_structured_decision if generation_config else fake_gemini_decision
+        parts = _BATCH_SPLIT_RE.split(prompt)
+        if len(parts) > 1:
+            # parts = [istruzioni, E1, testo1, E2, testo2, ...]
+            entries = []
+            for tag, text in zip(parts[1::2], parts[2::2]):
+                entry = decide(text, sdk.recorded)
+                entry["id"] = tag
+                entries.append(entry)
+            return _FakeResponse(json.dumps(entries, ensure_ascii=False), tokens)
+        content = prompt.split("Contenuto da analizzare:", 1)[-1]
+        return _FakeResponse(json.dumps(decide(content, sdk.recorded), ensure_ascii=False), tokens)
+
+
+class FakeGenai:
+    """SDK Gemini simulato per GeminiClient: risposte deterministiche, latenza ed errori da Faults."""
+
+    def __init__(self, faults: Faults, recorded: Optional[Dict] = None):
+        self.faults = faults
+        self.recorded = recorded
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def configure(self, api_key: Optional[str] = None, **kwargs) -> None:
+        pass
+
+    def GenerativeModel(self, name: str, system_instruction: Optional[str] = None) -> _FakeModel:
+        return _FakeModel(self, name, system_instruction)
+
+
+class FakeCredentials:
+    valid = True
+    expired = False
+    expiry = None
+    refresh_token = "bench"
+
+    def refresh(self, request) -> None:
+        pass
+
+    def to_json(self) -> str:
+        return "{}"
+
+
+# ---------------------------------------------------------------------------
+# Misure
+# ---------------------------------------------------------------------------
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def _reset_peak_rss() -> bool:
+    """Azzera il picco RSS del processo (Linux: /proc/self/clear_refs)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+    except Exception:
+        return 0.0
+
+
+def _stage_report(metrics: agent.RunMetrics) -> Dict[str, Dict]:
+    """Fasi misurate dallo script stesso (RunMetrics), una riga per combinazione di etichette."""
+    report = {}
+    for name, by_labels in metrics.summary()["stages"].items():
+        for labels, s in by_labels.items():
+            report[f"{name}[{labels}]" if labels else name] = {
+                "chiamate": s["count"],
+                "p50_ms": s["p50_ms"],
+                "p95_ms": s["p95_ms"],
+                "totale_s": round(s["total_secs"], 3),
+            }
+    return report
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+# Senza limiti di quota locali: si misura la pipeline, non il piano Gemini (sovrascrivibile con --env)
+BENCH_ENV = {
+    "GEMINI_API_KEY": "bench",
+    "FAST_START": "true",
+    "DAEMON_MODE": "false",
+    "PER_EMAIL_SLEEP_SECS": "0",
+    "GEMINI_RATE_LIMITS": "gemini-2.5-pro:0/0/0,gemini-2.5-flash:0/0/0",
+}
+
+
+def _micro_benchmark(name: str, fn, items: List, repeat: int) -> Dict:
+    _reset_peak_rss()
+    samples: List[float] = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            t0 = time.perf_counter()
+            fn(item)
+            samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    return {
+        "benchmark": name,
+        "email": len(samples),
+        "secondi": round(elapsed, 3),
+        "email_al_secondo": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(_percentile(samples, 95) * 1000, 3),
+        "picco_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def bench_extract(mailbox: Dict, repeat: int) -> Dict:
+    payloads = [m["payload"] for m in mailbox["messages"]]
+    return _micro_benchmark(
+        "_extract_text_from_payload",
+        lambda payload: agent._extract_text_from_payload(payload, max_chars=agent.SETTINGS.body_max_chars or None),
+        payloads, repeat,
+    )
+
+
+def bench_prompt(mailbox: Dict, repeat: int) -> Dict:
+    records = []
+    for m in mailbox["messages"]:
+        subject = next((h["value"] for h in m["payload"].get("headers", []) if h["name"] == "Subject"), "")
+        records.append((agent._extract_text_from_payload(m["payload"], max_chars=agent.SETTINGS.body_max_chars or None), subject))
+    return _micro_benchmark("build_prompt", lambda r: agent.build_prompt(r[0], r[1]), records, repeat)
+
+
+def bench_main(mailbox: Dict, args, env_overrides: Dict[str, str]) -> Dict:
+    gmail_faults = Faults(args.gmail_latency, args.error_rate, args.rate_429 if args.gmail_429 else 0.0, seed=args.seed)
+    calendar_faults = Faults(args.calendar_latency, args.error_rate, 0.0, seed=args.seed + 1)
+    gemini_faults = Faults(args.gemini_latency, args.error_rate, args.rate_429, seed=args.seed + 2)
+    gmail = FakeGmail(mailbox["messages"], gmail_faults)
+    calendar = FakeCalendar(calendar_faults)
+    sdk = FakeGenai(gemini_faults, mailbox.get("gemini"))
+    backends = agent.Backends(
+        credentials=FakeCredentials,
+        services=lambda creds: (gmail, calendar),
+        gemini_sdk=sdk,
+    )
+
+    env = dict(BENCH_ENV)
+    env["STATE_DIR"] = tempfile.mkdtemp(prefix="bench-state-")
+    env["MAX_UNREAD_TO_PROCESS"] = str(len(mailbox["messages"]))
+    env.update(env_overrides)
+
+    metrics = agent.RunMetrics()
+    _reset_peak_rss()
+    started = time.perf_counter()
+    agent.main(env, metrics, backends)
+    elapsed = time.perf_counter() - started
+    peak = _peak_rss_mb()
+
+    processed = len(gmail.fetched)
+    return {
+        "benchmark": "main",
+        "configurazione": env_overrides,
+        "email": processed,
+        "secondi": round(elapsed, 3),
+        "email_al_secondo": round(processed / elapsed, 1) if elapsed else 0.0,
+        "eventi_creati": len(calendar.events_created),
+        "email_lette": len(mailbox["messages"]) - len(gmail.unread_ids()),
+        "chiamate_gemini": sdk.calls,
+        "chiamate_gmail": dict(sorted(gmail.calls.items())),
+        "chiamate_calendar": dict(sorted(calendar.calls.items())),
+        "errori_simulati": {
+            "gmail": gmail_faults.injected, "calendar": calendar_faults.injected, "gemini": gemini_faults.injected,
+        },
+        "fasi": _stage_report(metrics),
+        "picco_rss_mb": round(peak, 1),
+    }
+
+
+def _print_result(result: Dict) -> None:
+    print(f"\n== {result['benchmark']} ==")
+    for key, value in result.items():
+        if key in ("benchmark", "fasi"):
+            continue
+        print(f"  {key}: {value}")
+    if result.get("fasi"):
+        print(f"  {'fase':<40}{'chiamate':>10}{'p50 ms':>12}{'p95 ms':>12}{'totale s':>12}")
+        for stage, s in result["fasi"].items():
+            print(f"  {stage:<40}{s['chiamate']:>10}{s['p50_ms']:>12}{s['p95_ms']:>12}{s['totale_s']:>12}")
+
+
+def _parse_env(items: List[str]) -> Dict[str, str]:
+    env: Dict[str, str] = {}
+    for item in items or []:
+        if "=" not in item:
+            raise SystemExit(f"--env richiede CHIAVE=VALORE, ricevuto: {item}")
+        key, value = item.split("=", 1)
+        env[key.strip()] = value
+    return env
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark offline con Gmail, Calendar e Gemini simulati.")
+    parser.add_argument("--bench", choices=["all", "main", "extract", "prompt"], default="all")
+    parser.add_argument("--emails", type=int, default=200, help="Numero di email della casella sintetica")
+    parser.add_argument("--event-ratio", type=float, default=0.5, help="Quota di email con un evento")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fixtures", help="File JSON con messaggi (e risposte Gemini) registrati")
+    parser.add_argument("--save-fixtures", help="Salva la casella sintetica in questo file JSON ed esce")
+    parser.add_argument("--repeat", type=int, default=3, help="Ripetizioni per i micro-benchmark")
+    parser.add_argument("--gmail-latency", type=float, default=0.03, help="Latenza media per richiesta Gmail (s)")
+    parser.add_argument("--calendar-latency", type=float, default=0.05, help="Latenza media per richiesta Calendar (s)")
+    parser.add_argument("--gemini-latency", type=float, default=0.3, help="Latenza media per chiamata Gemini (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilità di errore 503 per richiesta")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Probabilità di 429 per chiamata Gemini")
+    parser.add_argument("--gmail-429", action="store_true", help="Applica --rate-429 anche alle richieste Gmail")
+    parser.add_argument("--env", action="append", default=[], help="Variabile CHIAVE=VALORE per main() (ripetibile)")
+    parser.add_argument("--output", help="Scrive i risultati in questo file JSON")
+    parser.add_argument("--log-level", default="WARNING", help="Livello di log dello script durante il benchmark")
+    args = parser.parse_args()
+    # Configurato prima di main(): setup_logging() dello script non lo sovrascrive
+    logging.basicConfig(level=args.log_level, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    if args.fixtures:
+        with open(args.fixtures, "r", encoding="utf-8") as f:
+            mailbox = json.load(f)
+        mailbox.setdefault("gemini", {})
+    else:
+        mailbox = generate_mailbox(args.emails, seed=args.seed, event_ratio=args.event_ratio)
+    if args.save_fixtures:
+        with open(args.save_fixtures, "w", encoding="utf-8") as f:
+            json.dump(mailbox, f, ensure_ascii=False)
+        print(f"Casella sintetica salvata in {args.save_fixtures} ({len(mailbox['messages'])} email)")
+        return
+
+    results = []
+    if args.bench in ("all", "extract"):
+        results.append(bench_extract(mailbox, args.repeat))
+    if args.bench in ("all", "prompt"):
+        results.append(bench_prompt(mailbox, args.repeat))
+    if args.bench in ("all", "main"):
+        results.append(bench_main(mailbox, args, _parse_env(args.env)))
+    for result in results:
+        _print_result(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Componenti dell'agente email -> calendario usati da ControllaEmailCreaEvento.py."""
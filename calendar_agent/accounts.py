@@ -0,0 +1,118 @@
+"""Configurazione e riepilogo della modalità multi-account."""
+
+import json
+import logging
+import os
+import re
+from multiprocessing.managers import BaseManager
+from typing import Dict, List, Mapping, Optional
+
+from .rate_limit import GeminiRateLimiter
+
+
+_ACCOUNT_NAME_RE = re.compile(r"^[\w.-]+$")
+
+
+def load_accounts_config(path: str) -> Dict:
+    """Legge il file JSON degli account; i percorsi sono relativi alla sua cartella."""
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    def _resolve(value: Optional[str]) -> Optional[str]:
+        return os.path.join(base_dir, os.path.expanduser(value)) if value else None
+
+    accounts: List[Dict] = []
+    seen = set()
+    for raw in config.get("accounts") or []:
+        name = str(raw.get("name") or "").strip()
+        if not _ACCOUNT_NAME_RE.match(name) or name in seen:
+            raise ValueError(f"Nome account non valido o duplicato: {name!r}")
+        seen.add(name)
+        accounts.append({
+            "name": name,
+            "token": _resolve(raw.get("token")) or os.path.join(base_dir, f"token_{name}.json"),
+            "client_secret": _resolve(raw.get("client_secret")),
+            "calendar": raw.get("calendar") or "primary",
+            "token_env": raw.get("token_env"),
+            "gemini_limits": raw.get("gemini_limits"),
+            "state_dir": _resolve(raw.get("state_dir")),
+            "env": {str(k): str(v) for k, v in (raw.get("env") or {}).items()},
+        })
+    if not accounts:
+        raise ValueError("Nessun account configurato")
+    config["accounts"] = accounts
+    return config
+
+
+class BudgetManager(BaseManager):
+    """Processo manager che ospita il budget Gemini condiviso tra gli account."""
+
+
+# A livello di modulo: i processi spawn devono poter importare la classe
+BudgetManager.register("GeminiRateLimiter", GeminiRateLimiter)
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record) -> None:
+        self.count += 1
+
+
+def account_env(account: Dict, root_state_dir: str, base: Mapping[str, str],
+                 deadline: Optional[float] = None) -> Dict[str, str]:
+    """Configurazione di un account: ambiente del processo più le impostazioni dell'account."""
+    env = dict(base)
+    env.update(account["env"])
+    env["ACCOUNT_NAME"] = account["name"]
+    # Vuota (non assente): il processo figlio non deve riattivare la modalità multi-account
+    env["ACCOUNTS_FILE"] = ""
+    env["DAEMON_MODE"] = "false"
+    # Il recupero storico vale solo per gli account che lo indicano nella propria configurazione
+    env["BACKFILL_SOURCE"] = account["env"].get("BACKFILL_SOURCE", "")
+    env["TOKEN_FILE"] = account["token"]
+    env["CALENDAR_ID"] = account["calendar"]
+    state_dir = account["state_dir"] or os.path.join(root_state_dir, "accounts", account["name"])
+    env["STATE_DIR"] = state_dir
+    # File di output per account, salvo diversa indicazione nella configurazione dell'account
+    for name, default in (
+        ("RUN_REPORT_FILE", os.path.join(state_dir, "run_report.json")),
+        ("METRICS_TEXTFILE", os.path.join(state_dir, "metrics.prom")),
+        ("PROFILE_OUTPUT", ""),
+    ):
+        if name not in account["env"]:
+            env[name] = default
+    if account["client_secret"]:
+        env["CLIENT_SECRET_FILE"] = account["client_secret"]
+    # Il TOKEN_JSON globale appartiene a un solo account: ogni account usa il proprio secret, se indicato
+    env["TOKEN_JSON"] = env.get(account["token_env"], "") if account["token_env"] else ""
+    if account["gemini_limits"]:
+        env["GEMINI_RATE_LIMITS"] = account["gemini_limits"]
+    else:
+        env["GEMINI_RATE_LIMITER"] = "false"  # solo il budget globale
+    if deadline is not None:
+        # Scadenza comune: anche gli account avviati per ultimi si fermano in tempo
+        env["RUN_DEADLINE_AT"] = str(deadline)
+    return env
+
+
+def aggregate_reports(results: List[Dict]) -> Dict:
+    """Somma contatori e tempi per fase di tutti gli account."""
+    counters: Dict[str, Dict[str, float]] = {}
+    stages: Dict[str, Dict[str, float]] = {}
+    for result in results:
+        report = result.get("report") or {}
+        for name, by_label in (report.get("counters") or {}).items():
+            for label, value in by_label.items():
+                counters.setdefault(name, {})
+                counters[name][label] = counters[name].get(label, 0) + value
+        for name, by_label in (report.get("stages") or {}).items():
+            total = stages.setdefault(name, {"count": 0, "total_secs": 0.0, "max_ms": 0.0})
+            for v in by_label.values():
+                total["count"] += v["count"]
+                total["total_secs"] = round(total["total_secs"] + v["total_secs"], 4)
+                total["max_ms"] = max(total["max_ms"], v["max_ms"])
+    return {"counters": counters, "stages": stages}
@@ -0,0 +1,136 @@
+"""Lettura di archivi mbox/.eml e checkpoint del recupero storico."""
+
+import base64
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from .ics import is_calendar_part
+from .util import write_json_file
+
+
+def iter_mbox(path: str, start: int = 0):
+    """Messaggi di un file mbox come (offset del successivo, byte), letti in streaming."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        lines: List[bytes] = []
+        for line in f:
+            if line.startswith(b"From ") and lines:
+                yield offset, b"".join(lines)
+                lines = []
+            offset += len(line)
+            # La riga separatrice "From " non fa parte del messaggio
+            if not line.startswith(b"From ") or lines:
+                lines.append(line)
+        if lines:
+            yield offset, b"".join(lines)
+
+
+def iter_eml_dir(root: str, after: Optional[str] = None):
+    """File .eml di una cartella, in ordine di percorso, come (percorso relativo, byte)."""
+    after_parts = tuple(after.split("/")) if after else None
+
+    def walk(rel: Tuple[str, ...]):
+        with os.scandir(os.path.join(root, *rel)) as it:
+            entries = sorted((e for e in it if not e.name.startswith(".")), key=lambda e: e.name)
+        for entry in entries:
+            parts = rel + (entry.name,)
+            if entry.is_dir():
+                if after_parts is None or parts >= after_parts[:len(parts)]:
+                    yield from walk(parts)
+            elif entry.name.lower().endswith(".eml") and (after_parts is None or parts > after_parts):
+                with open(entry.path, "rb") as f:
+                    yield "/".join(parts), f.read()
+
+    yield from walk(())
+
+
+def payload_from_email(part) -> Dict:
+    """Converte un messaggio del modulo 'email' nel formato 'payload' dell'API Gmail."""
+    payload: Dict = {
+        "mimeType": part.get_content_type(),
+        "filename": part.get_filename() or "",
+        "headers": [{"name": name, "value": str(value)} for name, value in part.items()],
+    }
+    if part.is_multipart():
+        payload["parts"] = [payload_from_email(sub) for sub in part.get_payload()]
+        payload["body"] = {"size": 0}
+        return payload
+    data = part.get_payload(decode=True) or b""
+    # Servono solo il testo e gli inviti: gli altri allegati non vengono copiati
+    if not (is_calendar_part(payload) or (part.get_content_maintype() == "text" and not payload["filename"])):
+        payload["body"] = {"size": len(data)}
+        return payload
+    try:
+        text = data.decode(part.get_content_charset() or "utf-8", errors="replace")
+    except LookupError:
+        text = data.decode("utf-8", errors="replace")
+    encoded = text.encode("utf-8")
+    payload["body"] = {"size": len(encoded), "data": base64.urlsafe_b64encode(encoded).decode("ascii")}
+    return payload
+
+
+def email_sent_at(msg) -> Optional[datetime]:
+    from email.utils import parsedate_to_datetime
+
+    try:
+        sent = parsedate_to_datetime(str(msg.get("Date", "")))
+    except Exception:
+        return None
+    if sent is not None and sent.tzinfo is None:
+        sent = sent.replace(tzinfo=timezone.utc)
+    return sent
+
+
+def load_checkpoint(path: str, source: str) -> Dict:
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("source") == source:
+                return data
+            logging.info("Checkpoint di recupero relativo a un altro archivio (%s): riparto dall'inizio", data.get("source"))
+        except Exception as e:
+            logging.warning("Checkpoint di recupero illeggibile (%s): riparto dall'inizio", e)
+    return {"source": source, "position": None, "processed": 0, "events": 0, "output_bytes": 0, "failed": {}}
+
+
+# Tentativi per un messaggio dell'archivio la cui analisi fallisce, poi viene abbandonato
+MAX_ATTEMPTS = 3
+
+
+def pending_messages(source: str, state: Dict):
+    """Messaggi da elaborare come (posizione, chiave, byte): prima i falliti, poi i nuovi."""
+    is_dir = os.path.isdir(source)
+    for key in list(state.get("failed") or {}):
+        try:
+            if is_dir:
+                with open(os.path.join(source, *key.split("/")), "rb") as f:
+                    raw = f.read()
+            else:
+                raw = next(iter_mbox(source, int(key)))[1]
+        except (OSError, StopIteration, ValueError) as e:
+            logging.warning("Email %s dell'archivio non più leggibile, non la ritento: %s", key, e)
+            state["failed"].pop(key, None)
+            continue
+        yield None, key, raw
+    if is_dir:
+        for position, raw in iter_eml_dir(source, state["position"]):
+            yield position, position, raw
+        return
+    start = state["position"] or 0
+    for position, raw in iter_mbox(source, start):
+        yield position, str(start), raw
+        start = position
+
+
+def save_checkpoint(path: str, state: Dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        state["updated"] = datetime.now().isoformat(timespec="seconds")
+        write_json_file(path, json.dumps(state, ensure_ascii=False))
+    except Exception as e:
+        logging.warning("Salvataggio checkpoint di recupero non riuscito: %s", e)
@@ -0,0 +1,182 @@
+"""Indice locale degli eventi del calendario."""
+
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from googleapiclient.errors import HttpError
+
+from .util import write_json_file
+
+
+def _normalize_title(title: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", (title or "").lower())).strip()
+
+
+class CalendarEventIndex:
+    """Indice locale degli eventi del calendario, aggiornato con il syncToken."""
+
+    FIELDS = "items(id,status,summary,start,iCalUID,extendedProperties),nextPageToken,nextSyncToken"
+
+    def __init__(self, path: Optional[str] = None, past_days: int = 30, future_days: int = 400):
+        self.path = path
+        self.past_days = past_days
+        self.future_days = future_days
+        self.sync_token: Optional[str] = None
+        self._events: Dict[str, Dict] = {}  # id evento -> {"key", "source", "uid"}
+        self._by_key: Dict[str, str] = {}
+        self._by_source: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.sync_token = data.get("syncToken")
+                for event_id, entry in (data.get("events") or {}).items():
+                    self._put(event_id, entry.get("key"), entry.get("source"), entry.get("uid"))
+            except Exception as e:
+                logging.warning("Indice eventi illeggibile, riparto da zero: %s", e)
+                self.sync_token = None
+
+    @staticmethod
+    def make_key(title: str, date_iso: str, time_str: Optional[str]) -> str:
+        hhmm = ""
+        if time_str:
+            parts = str(time_str).split(":")
+            try:
+                hhmm = f"{int(parts[0]):02d}:{int(parts[1]):02d}"
+            except Exception:
+                hhmm = str(time_str)
+        return f"{_normalize_title(title)}|{date_iso}|{hhmm}"
+
+    @classmethod
+    def key_for_event(cls, event: Dict) -> Optional[str]:
+        start = event.get("start") or {}
+        if start.get("dateTime"):
+            value = start["dateTime"]
+            return cls.make_key(event.get("summary", ""), value[:10], value[11:16])
+        if start.get("date"):
+            return cls.make_key(event.get("summary", ""), start["date"], None)
+        return None
+
+    def _in_window(self, key: str) -> bool:
+        try:
+            d = datetime.strptime(key.split("|")[1], "%Y-%m-%d").date()
+        except Exception:
+            return False
+        today = datetime.now().date()
+        return today - timedelta(days=self.past_days) <= d <= today + timedelta(days=self.future_days)
+
+    def _put(self, event_id: str, key: Optional[str], source: Optional[str], uid: Optional[str] = None) -> None:
+        self._drop(event_id)
+        if not key or not self._in_window(key):
+            return
+        self._events[event_id] = {"key": key, "source": source, "uid": uid}
+        self._by_key[key] = event_id
+        if source:
+            self._by_source[source] = event_id
+        if uid:
+            self._by_source[f"ical:{uid}"] = event_id
+
+    def _drop(self, event_id: str) -> None:
+        old = self._events.pop(event_id, None)
+        if not old:
+            return
+        if self._by_key.get(old["key"]) == event_id:
+            self._by_key.pop(old["key"], None)
+        if old.get("source") and self._by_source.get(old["source"]) == event_id:
+            self._by_source.pop(old["source"], None)
+        if old.get("uid") and self._by_source.get(f"ical:{old['uid']}") == event_id:
+            self._by_source.pop(f"ical:{old['uid']}", None)
+
+    def add_event(self, event: Dict) -> None:
+        event_id = event.get("id")
+        if not event_id:
+            return
+        with self._lock:
+            if event.get("status") == "cancelled":
+                self._drop(event_id)
+                return
+            private = (event.get("extendedProperties") or {}).get("private") or {}
+            uid = private.get("icalUID") or event.get("iCalUID")
+            self._put(event_id, self.key_for_event(event), private.get("sourceMessageId"), uid)
+
+    def _time_min(self) -> str:
+        start = datetime.now(timezone.utc) - timedelta(days=self.past_days)
+        return start.isoformat(timespec="seconds").replace("+00:00", "Z")
+
+    def sync(self, calendar, calendar_id: str = "primary") -> None:
+        """Aggiorna l'indice: incrementale con syncToken, completa (dalla finestra) se assente o scaduto."""
+        full = not self.sync_token
+        if full:
+            with self._lock:
+                self._events, self._by_key, self._by_source = {}, {}, {}
+        page_token: Optional[str] = None
+        changes = 0
+        try:
+            while True:
+                kwargs = {"calendarId": calendar_id, "maxResults": 2500, "pageToken": page_token, "fields": self.FIELDS}
+                if self.sync_token:
+                    kwargs["syncToken"] = self.sync_token
+                else:
+                    # timeMin non è ammesso insieme al syncToken: vale solo per la sincronizzazione completa
+                    kwargs["timeMin"] = self._time_min()
+                resp = calendar.events().list(**kwargs).execute()
+                for event in resp.get("items", []):
+                    self.add_event(event)
+                    changes += 1
+                page_token = resp.get("nextPageToken")
+                if not page_token:
+                    self.sync_token = resp.get("nextSyncToken") or self.sync_token
+                    break
+        except HttpError as e:
+            if getattr(e, "resp", None) is not None and e.resp.status == 410 and not full:
+                logging.info("Sync token Calendar scaduto: sincronizzazione completa dell'indice eventi")
+                self.sync_token = None
+                self.sync(calendar, calendar_id)
+                return
+            raise
+        logging.info(
+            "Indice eventi %s: %d modifiche, %d eventi nella finestra",
+            "completo" if full else "incrementale", changes, len(self._events),
+        )
+
+    def find_duplicate(self, key: str, source_id: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            if source_id and source_id in self._by_source:
+                return self._by_source[source_id]
+            return self._by_key.get(key)
+
+    def claim(self, key: str, source_id: Optional[str] = None, uid: Optional[str] = None) -> Optional[str]:
+        """Controlla e prenota atomicamente una chiave: restituisce l'evento (o prenotazione) già esistente."""
+        with self._lock:
+            existing = (
+                (self._by_source.get(source_id) if source_id else None)
+                or (self._by_source.get(f"ical:{uid}") if uid else None)
+                or self._by_key.get(key)
+            )
+            if existing is None:
+                self._by_key[key] = f"pending:{source_id}"
+                if uid:
+                    self._by_source[f"ical:{uid}"] = f"pending:{source_id}"
+            return existing
+
+    def release(self, key: str, source_id: Optional[str] = None, uid: Optional[str] = None) -> None:
+        with self._lock:
+            if self._by_key.get(key) == f"pending:{source_id}":
+                self._by_key.pop(key, None)
+            if uid and self._by_source.get(f"ical:{uid}") == f"pending:{source_id}":
+                self._by_source.pop(f"ical:{uid}", None)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            events = {k: v for k, v in self._events.items() if self._in_window(v["key"])}
+            content = json.dumps({"syncToken": self.sync_token, "events": events}, ensure_ascii=False)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        write_json_file(self.path, content)
@@ -0,0 +1,30 @@
+"""Data di riferimento per prompt e modelli per mittente."""
+
+import functools
+import threading
+from datetime import datetime
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:  # pragma: no cover
+    ZoneInfo = None
+
+
+# Data di riferimento del prompt per il thread corrente (backfill: data di invio dell'email)
+REFERENCE = threading.local()
+
+
+@functools.lru_cache(maxsize=1)
+def italy_tz():
+    try:
+        return ZoneInfo("Europe/Rome")
+    except Exception:
+        import pytz  # Fallback senza zoneinfo/tzdata
+
+        return pytz.timezone("Europe/Rome")
+
+
+def reference_now() -> datetime:
+    """Ora corrente in Italia, o la data di invio dell'email nel recupero storico."""
+    reference = getattr(REFERENCE, "today", None)
+    return reference.astimezone(italy_tz()) if reference is not None else datetime.now(italy_tz())
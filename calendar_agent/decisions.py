@@ -0,0 +1,95 @@
+"""Lettura e validazione delle risposte di Gemini."""
+
+import re
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+
+def parse_event_decision(data: Dict) -> Tuple[bool, str, Optional[str], Optional[str], str]:
+    # Normalizza chiavi/valori
+    creare = str(data.get("creare_evento", "no")).strip().lower()
+    titolo = str(data.get("titolo", "")).strip() or "Evento"
+    data_str = data.get("data")
+    ora_inizio = data.get("ora_inizio")
+    descrizione = str(data.get("descrizione", "")).strip()
+
+    if data_str:
+        data_str = str(data_str).strip()
+    if ora_inizio:
+        ora_inizio = str(ora_inizio).strip()
+
+    return (
+        creare == "si",
+        titolo,
+        data_str if data_str and data_str.lower() != "null" else None,
+        ora_inizio if ora_inizio and ora_inizio.lower() != "null" else None,
+        descrizione,
+    )
+
+
+def normalize_date(date_str: str) -> str:
+    """Accetta 'YYYY-MM-DD' o 'DD-MM-YYYY' (anche con '/') e restituisce 'YYYY-MM-DD'."""
+    date_str = date_str.strip()
+    # Sostituisci / con -
+    date_str = date_str.replace("/", "-")
+    # Prova ISO
+    try:
+        d = datetime.strptime(date_str, "%Y-%m-%d").date()
+        return d.isoformat()
+    except ValueError:
+        pass
+    # Prova DD-MM-YYYY
+    try:
+        d = datetime.strptime(date_str, "%d-%m-%Y").date()
+        return d.isoformat()
+    except ValueError:
+        pass
+    raise ValueError(f"Formato data non riconosciuto: {date_str}")
+
+
+def optional_field(value) -> Optional[str]:
+    value = str(value).strip() if value is not None else ""
+    return value if value and value.lower() != "null" else None
+
+
+TIME_RE = re.compile(r"^\d{1,2}:\d{2}(:\d{2})?$")
+
+
+def is_valid_decision(data) -> bool:
+    """Verifica che una risposta di Gemini sia utilizzabile senza errori a valle."""
+    if not isinstance(data, dict):
+        return False
+    if str(data.get("creare_evento", "")).strip().lower() not in ("si", "no"):
+        return False
+    creare, _, data_str, ora_inizio, _ = parse_event_decision(data)
+    if not creare:
+        return True
+    events = data.get("eventi") if isinstance(data.get("eventi"), list) else [data]
+    for event in events:
+        _, _, data_str, ora_inizio, _ = parse_event_decision(dict(event, creare_evento="si"))
+        if data_str:
+            try:
+                normalize_date(data_str)
+            except ValueError:
+                return False
+        for value in (ora_inizio, optional_field(event.get("ora_fine"))):
+            if value and not TIME_RE.match(value):
+                return False
+    return True
+
+
+def decision_confidence(data) -> float:
+    try:
+        return max(0.0, min(1.0, float(data.get("confidenza"))))
+    except Exception:
+        return 0.0
+
+
+def needs_escalation(data, min_confidence: float) -> Optional[str]:
+    """Motivo per cui una risposta del modello veloce va verificata col modello pro (None se ok)."""
+    if not is_valid_decision(data):
+        return "risposta non valida"
+    confidence = decision_confidence(data)
+    if confidence < min_confidence:
+        return f"confidenza bassa ({confidence:.2f})"
+    return None
@@ -0,0 +1,203 @@
+"""Client Gemini condiviso, con circuit breaker e cache di contesto."""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from .metrics import RunMetrics
+from .util import write_json_file
+
+
+# Codici degli errori dell'SDK che escludono il modello: NotFound (404) e ResourceExhausted (429)
+MODEL_NOT_FOUND = 404
+QUOTA_EXHAUSTED = 429
+
+
+def error_status(exc: BaseException) -> Optional[int]:
+    """Codice HTTP di un errore dell'SDK (attributo 'code' di google.api_core), se presente."""
+    code = getattr(exc, "code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    # Stima grossolana (~4 caratteri per token) più un margine per la risposta JSON
+    return len(text) // 4 + 300
+
+
+class GeminiClient:
+    """Client Gemini riutilizzabile per tutta l'esecuzione, con circuit breaker per modello.
+    'sdk' sostituisce google.generativeai (es. nel benchmark).
+    """
+
+    def __init__(self, api_key: str, breaker_path: Optional[str] = None, cooldown_secs: float = 6 * 3600,
+                 context_cache: bool = False, cache_ttl_secs: float = 900.0, cache_min_tokens: int = 1024,
+                 count_tokens: bool = False, sdk=None, metrics: Optional[RunMetrics] = None):
+        if sdk is None:
+            import google.generativeai as sdk
+
+        sdk.configure(api_key=api_key)
+        self._genai = sdk
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self._models: Dict[Tuple[str, Optional[str]], object] = {}
+        self._lock = threading.Lock()
+        self.breaker_path = breaker_path
+        self.cooldown_secs = cooldown_secs
+        self.context_cache = context_cache
+        self.cache_ttl_secs = cache_ttl_secs
+        self.cache_min_tokens = cache_min_tokens
+        self.count_tokens = count_tokens
+        self._caches: Dict[Tuple[str, str], Tuple[object, object, float]] = {}
+        self._no_cache: set = set()
+        self._cache_lock = threading.Lock()
+        self._instruction_tokens: Dict[Tuple[str, str], int] = {}
+        self._open: Dict[str, Dict] = {}
+        if breaker_path and os.path.exists(breaker_path):
+            try:
+                with open(breaker_path, "r", encoding="utf-8") as f:
+                    self._open = json.load(f).get("open", {})
+            except Exception as e:
+                logging.warning("Stato circuit breaker Gemini illeggibile: %s", e)
+
+    def model(self, name: str, system_instruction: Optional[str] = None):
+        with self._lock:
+            mdl = self._models.get((name, system_instruction))
+            if mdl is None:
+                if system_instruction:
+                    mdl = self._genai.GenerativeModel(name, system_instruction=system_instruction)
+                else:
+                    mdl = self._genai.GenerativeModel(name)
+                self._models[(name, system_instruction)] = mdl
+            return mdl
+
+    def instruction_tokens(self, name: str, system_instruction: str) -> int:
+        """Token delle istruzioni di sistema: conteggio dell'API (count_tokens) una volta, o stima locale."""
+        key = (name, system_instruction)
+        with self._lock:
+            cached = self._instruction_tokens.get(key)
+        if cached is not None:
+            return cached
+        tokens = estimate_tokens(system_instruction)
+        if self.count_tokens:
+            try:
+                tokens = int(self.model(name).count_tokens(system_instruction).total_tokens)
+            except Exception as e:
+                logging.debug("Conteggio token Gemini non riuscito per %s: %s", name, e)
+        with self._lock:
+            self._instruction_tokens[key] = tokens
+        return tokens
+
+    def _cached_model(self, name: str, system_instruction: str):
+        """Modello legato a un CachedContent con le istruzioni; None se la cache non è utilizzabile."""
+        key = (name, system_instruction)
+        with self._cache_lock:
+            entry = self._caches.get(key)
+            # Rinnovata poco prima della scadenza (esecuzioni lunghe e modalità demone)
+            if entry is not None and time.time() < entry[2] - 60:
+                return entry[0]
+            if key in self._no_cache:
+                return None
+            tokens = self.instruction_tokens(name, system_instruction)
+            if tokens < self.cache_min_tokens:
+                self._no_cache.add(key)
+                logging.info(
+                    "Istruzioni di sistema di circa %d token, sotto il minimo per la cache di contesto (%d): "
+                    "%s le riceve a ogni richiesta", tokens, self.cache_min_tokens, name,
+                )
+                return None
+            try:
+                cache = self._genai.caching.CachedContent.create(
+                    model=name,
+                    display_name="calendar-agent",
+                    system_instruction=system_instruction,
+                    ttl=timedelta(seconds=self.cache_ttl_secs),
+                )
+                mdl = self._genai.GenerativeModel.from_cached_content(cached_content=cache)
+            except Exception as e:
+                self._no_cache.add(key)
+                logging.info("Cache di contesto Gemini non disponibile per %s (%s): uso le istruzioni di sistema", name, e)
+                return None
+            self._caches[key] = (mdl, cache, time.time() + self.cache_ttl_secs)
+        self.metrics.incr("gemini_cache", model=name, esito="creata")
+        logging.info("Cache di contesto Gemini creata per %s (%d token di istruzioni)", name, tokens)
+        return mdl
+
+    @staticmethod
+    def _generate_with(mdl, prompt: str, generation_config: Optional[Dict]):
+        if generation_config:
+            return mdl.generate_content(prompt, generation_config=generation_config)
+        return mdl.generate_content(prompt)
+
+    def generate(self, name: str, prompt: str, generation_config: Optional[Dict] = None,
+                 system_instruction: Optional[str] = None):
+        if system_instruction and self.context_cache:
+            cached = self._cached_model(name, system_instruction)
+            if cached is not None:
+                try:
+                    return self._generate_with(cached, prompt, generation_config)
+                except Exception as e:
+                    # Cache scaduta o rimossa: non è un errore del modello (niente circuit breaker)
+                    if "cache" not in str(e).lower():
+                        raise
+                    logging.warning("Cache di contesto Gemini non più valida per %s (%s): uso le istruzioni di sistema", name, e)
+                    with self._cache_lock:
+                        self._caches.pop((name, system_instruction), None)
+                        self._no_cache.add((name, system_instruction))
+        return self._generate_with(self.model(name, system_instruction), prompt, generation_config)
+
+    def close(self) -> None:
+        """Elimina le cache di contesto create dall'esecuzione (altrimenti restano fino al TTL)."""
+        with self._cache_lock:
+            entries = list(self._caches.values())
+            self._caches.clear()
+        for _, cache, _ in entries:
+            try:
+                cache.delete()
+            except Exception as e:
+                logging.debug("Eliminazione cache di contesto Gemini non riuscita: %s", e)
+
+    def blocked(self, name: str) -> Optional[Dict]:
+        """None se il modello è utilizzabile, altrimenti {"until", "reason"}."""
+        with self._lock:
+            entry = self._open.get(name)
+            if not entry:
+                return None
+            if time.time() >= float(entry.get("until", 0)):
+                self._open.pop(name, None)
+                logging.info("Circuit breaker Gemini: %s di nuovo disponibile", name)
+                return None
+            return dict(entry)
+
+    def is_available(self, name: str) -> bool:
+        return self.blocked(name) is None
+
+    def blocked_for(self, names: List[str]) -> float:
+        """Secondi prima che almeno uno dei modelli torni utilizzabile (0 se uno lo è già)."""
+        waits = []
+        for name in names:
+            entry = self.blocked(name)
+            if entry is None:
+                return 0.0
+            waits.append(max(0.0, float(entry.get("until", 0)) - time.time()))
+        return min(waits) if waits else 0.0
+
+    def trip(self, name: str, reason: str, cooldown: Optional[float] = None) -> None:
+        cooldown = self.cooldown_secs if cooldown is None else cooldown
+        with self._lock:
+            self._open[name] = {"until": time.time() + cooldown, "reason": reason}
+        logging.warning("Circuit breaker Gemini: escludo %s per %.0fs (%s)", name, cooldown, reason)
+
+    def save(self) -> None:
+        if not self.breaker_path:
+            return
+        with self._lock:
+            now = time.time()
+            content = json.dumps({"open": {k: v for k, v in self._open.items() if float(v.get("until", 0)) > now}})
+        os.makedirs(os.path.dirname(self.breaker_path) or ".", exist_ok=True)
+        write_json_file(self.breaker_path, content)
@@ -0,0 +1,209 @@
+"""Inviti iCalendar (.ics) letti senza Gemini."""
+
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:  # pragma: no cover
+    ZoneInfo = None
+
+
+CALENDAR_MIME_TYPES = ("text/calendar", "application/ics", "text/x-vcalendar")
+
+
+# Eventi massimi accettati da un singolo file .ics
+MAX_ICS_EVENTS = 50
+
+
+# Nomi di fuso Windows (Outlook/Exchange) più comuni -> IANA
+_WINDOWS_TIMEZONES = {
+    "W. Europe Standard Time": "Europe/Rome",
+    "Central Europe Standard Time": "Europe/Budapest",
+    "Central European Standard Time": "Europe/Warsaw",
+    "Romance Standard Time": "Europe/Paris",
+    "GMT Standard Time": "Europe/London",
+    "Greenwich Standard Time": "Atlantic/Reykjavik",
+    "E. Europe Standard Time": "Europe/Chisinau",
+    "FLE Standard Time": "Europe/Kiev",
+    "GTB Standard Time": "Europe/Bucharest",
+    "Eastern Standard Time": "America/New_York",
+    "Central Standard Time": "America/Chicago",
+    "Mountain Standard Time": "America/Denver",
+    "Pacific Standard Time": "America/Los_Angeles",
+    "UTC": "UTC",
+    "Coordinated Universal Time": "UTC",
+}
+
+
+def is_calendar_part(part: Dict) -> bool:
+    mime = part.get("mimeType", "").lower().split(";")[0].strip()
+    return mime in CALENDAR_MIME_TYPES or str(part.get("filename") or "").lower().endswith(".ics")
+
+
+def calendar_parts(payload: Dict) -> List[Dict]:
+    found: List[Dict] = []
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if is_calendar_part(part):
+            found.append(part)
+        stack.extend(reversed(part.get("parts") or []))
+    return found
+
+
+def _ics_lines(text: str) -> List[Tuple[str, Dict[str, str], str]]:
+    """Righe iCalendar "spiegate" (RFC 5545 §3.1) come (NOME, parametri, valore)."""
+    unfolded = re.sub(r"\r?\n[ \t]", "", text.replace("\r\n", "\n"))
+    lines = []
+    for raw in unfolded.split("\n"):
+        if ":" not in raw:
+            continue
+        # Il primo ':' fuori dalle virgolette separa nome/parametri dal valore
+        in_quotes = False
+        for pos, ch in enumerate(raw):
+            if ch == '"':
+                in_quotes = not in_quotes
+            elif ch == ":" and not in_quotes:
+                break
+        head, value = raw[:pos], raw[pos + 1:]
+        name, *params = head.split(";")
+        parsed = {}
+        for param in params:
+            key, _, val = param.partition("=")
+            parsed[key.strip().upper()] = val.strip().strip('"')
+        lines.append((name.strip().upper(), parsed, value))
+    return lines
+
+
+def _ics_text(value: str) -> str:
+    return re.sub(r"\\([\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value).strip()
+
+
+def ics_timezone(tzid: Optional[str]) -> Optional[str]:
+    """Nome IANA per un TZID iCalendar (anche nomi Windows o prefissati); None se sconosciuto."""
+    if not tzid or ZoneInfo is None:
+        return None
+    candidates = [tzid, _WINDOWS_TIMEZONES.get(tzid, "")]
+    # Es. "/mozilla.org/20050126_1/Europe/Rome" o "/citadel.org/.../Europe/Rome"
+    candidates.append("/".join(tzid.strip("/").split("/")[-2:]))
+    for name in candidates:
+        if not name:
+            continue
+        try:
+            ZoneInfo(name)
+            return name
+        except Exception:
+            continue
+    return None
+
+
+def _ics_datetime(
+    value: str, params: Dict[str, str], default_tz: str, keep_utc: bool = False
+) -> Tuple[datetime, bool, str]:
+    """Interpreta DTSTART/DTEND: (data/ora locale nel fuso, giornata intera, fuso IANA)."""
+    value = value.strip()
+    if params.get("VALUE", "").upper() == "DATE" or re.fullmatch(r"\d{8}", value):
+        return datetime.strptime(value[:8], "%Y%m%d"), True, default_tz
+    naive = datetime.strptime(value.rstrip("Zz")[:15], "%Y%m%dT%H%M%S")
+    if value.upper().endswith("Z"):
+        # Orario UTC: convertito nel fuso configurato (le serie restano in UTC, come da RFC 5545)
+        if ZoneInfo is None or keep_utc:
+            return naive, False, "UTC"
+        local = naive.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(default_tz))
+        return local.replace(tzinfo=None), False, default_tz
+    tz_name = ics_timezone(params.get("TZID"))
+    if params.get("TZID") and tz_name is None:
+        logging.debug("Fuso iCalendar sconosciuto %s: uso %s", params.get("TZID"), default_tz)
+    return naive, False, tz_name or default_tz
+
+
+def _ics_duration(value: str) -> Optional[timedelta]:
+    m = re.fullmatch(r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?", value.strip().upper())
+    if not m:
+        return None
+    weeks, days, hours, minutes, seconds = (int(g or 0) for g in m.groups()[1:])
+    delta = timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+    return -delta if m.group(1) == "-" else delta
+
+
+def _ics_convert(dt: datetime, from_tz: str, to_tz: str) -> datetime:
+    if from_tz == to_tz or ZoneInfo is None:
+        return dt
+    return dt.replace(tzinfo=ZoneInfo(from_tz)).astimezone(ZoneInfo(to_tz)).replace(tzinfo=None)
+
+
+def parse_ics(text: str, default_tz: str = "Europe/Rome") -> Tuple[Optional[str], List[Dict]]:
+    """Legge un file iCalendar: restituisce (METHOD, eventi nel formato delle decisioni)."""
+    method: Optional[str] = None
+    events: List[Dict] = []
+    current: Optional[List[Tuple[str, Dict[str, str], str]]] = None
+    depth = 0  # Componenti annidati nel VEVENT (es. VALARM)
+    for name, params, value in _ics_lines(text):
+        if name == "METHOD" and current is None:
+            method = value.strip().upper()
+        elif name == "BEGIN":
+            if value.strip().upper() == "VEVENT" and current is None:
+                current, depth = [], 0
+            elif current is not None:
+                depth += 1
+        elif name == "END":
+            if current is not None and depth:
+                depth -= 1
+            elif current is not None and value.strip().upper() == "VEVENT":
+                try:
+                    event = _ics_event(current, default_tz)
+                except Exception as e:
+                    logging.warning("VEVENT non interpretabile, ignorato: %s", e)
+                    event = None
+                if event is not None:
+                    events.append(event)
+                current = None
+        elif current is not None and not depth:
+            current.append((name, params, value))
+    return method, events
+
+
+def _ics_event(props: List[Tuple[str, Dict[str, str], str]], default_tz: str) -> Optional[Dict]:
+    first = {}
+    recurrence: List[str] = []
+    for name, params, value in props:
+        first.setdefault(name, (params, value))
+        if name in ("RRULE", "EXRULE", "RDATE", "EXDATE"):
+            if params.get("TZID"):
+                # Calendar accetta solo nomi IANA (Outlook usa nomi Windows)
+                params = dict(params, TZID=ics_timezone(params["TZID"]) or default_tz)
+            param_str = "".join(f";{k}={v}" for k, v in params.items())
+            recurrence.append(f"{name}{param_str}:{value.strip()}")
+    if "DTSTART" not in first:
+        return None
+    if "RECURRENCE-ID" in first or first.get("STATUS", ({}, ""))[1].strip().upper() == "CANCELLED":
+        return None
+    start, all_day, tz_name = _ics_datetime(first["DTSTART"][1], first["DTSTART"][0], default_tz, bool(recurrence))
+    end: Optional[datetime] = None
+    if "DTEND" in first:
+        end, _, end_tz = _ics_datetime(first["DTEND"][1], first["DTEND"][0], default_tz, bool(recurrence))
+        if not all_day:
+            end = _ics_convert(end, end_tz, tz_name)
+    elif "DURATION" in first:
+        duration = _ics_duration(first["DURATION"][1])
+        end = start + duration if duration else None
+    event = {
+        "titolo": _ics_text(first.get("SUMMARY", ({}, ""))[1]) or "Evento",
+        "data": start.strftime("%Y-%m-%d"),
+        "ora_inizio": None if all_day else start.strftime("%H:%M"),
+        "ora_fine": None,
+        "data_fine": None,
+        "luogo": _ics_text(first.get("LOCATION", ({}, ""))[1]) or None,
+        "descrizione": _ics_text(first.get("DESCRIPTION", ({}, ""))[1])[:1000],
+        "fuso": tz_name,
+        "uid": first.get("UID", ({}, ""))[1].strip() or None,
+        "ricorrenza": recurrence or None,
+    }
+    if end is not None and end > start:
+        event["data_fine"] = end.strftime("%Y-%m-%d")
+        if not all_day:
+            event["ora_fine"] = end.strftime("%H:%M")
+    return event
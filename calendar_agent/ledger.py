@@ -0,0 +1,118 @@
+"""Registro delle email già decise."""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class ProcessedLedger:
+    """Registro locale delle email già decise (JSONL, le righe più recenti prevalgono)."""
+
+    def __init__(self, path: str, ttl_days: int = 30):
+        self.path = path
+        self.ttl_secs = max(0, ttl_days) * 86400
+        self._by_id: Dict[str, Dict] = {}
+        self._by_hash: Dict[str, Dict] = {}
+        self._senders: Optional[Dict[str, List[int]]] = None
+        self._lines_on_disk = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def content_hash(subject: str, body: str) -> str:
+        normalized = re.sub(r"\s+", " ", f"{subject or ''}\n{body or ''}").strip()
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, entry: Dict, now: float) -> bool:
+        return bool(self.ttl_secs) and now - float(entry.get("ts", 0)) > self.ttl_secs
+
+    def _index(self, entry: Dict) -> None:
+        self._by_id[entry["id"]] = entry
+        if entry.get("hash"):
+            self._by_hash[entry["hash"]] = entry
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                self._lines_on_disk += 1
+                try:
+                    entry = json.loads(line)
+                except Exception:
+                    continue  # riga troncata (es. job interrotto): la compattazione la elimina
+                if not entry.get("id") or self._is_expired(entry, now):
+                    continue
+                self._index(entry)
+        logging.info("Registro email elaborate: %d voci valide da %s", len(self._by_id), self.path)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, msg_id: str) -> bool:
+        return msg_id in self._by_id
+
+    def window_start(self) -> Optional[float]:
+        """Inizio (epoch) della finestra coperta dalle decisioni; None se il registro è vuoto o non scade."""
+        return time.time() - self.ttl_secs if self.ttl_secs and self._by_id else None
+
+    def decision_for_hash(self, content_hash: str) -> Optional[str]:
+        entry = self._by_hash.get(content_hash)
+        return entry.get("decision") if entry else None
+
+    def sender_event_rate(self, sender: str) -> float:
+        """Quota (stimata) di email del mittente che contenevano eventi; 0.5 se sconosciuto."""
+        with self._lock:
+            if self._senders is None:
+                self._senders = {}
+                for entry in self._by_id.values():
+                    if entry.get("from"):
+                        stats = self._senders.setdefault(entry["from"], [0, 0])
+                        stats[0] += entry.get("decision") in ("evento_creato", "evento_esistente")
+                        stats[1] += 1
+            events, total = self._senders.get(sender, (0, 0))
+        return (events + 0.5) / (total + 1)
+
+    def record(self, msg_id: str, content_hash: Optional[str], decision: str, sender: Optional[str] = None) -> None:
+        entry = {"id": msg_id, "hash": content_hash, "decision": decision, "ts": int(time.time())}
+        if sender:
+            entry["from"] = sender
+        with self._lock:
+            self._senders = None
+            self._index(entry)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._lines_on_disk += 1
+
+    def compact(self, force: bool = False) -> None:
+        """Riscrive il file con le sole voci valide (una per id, non scadute).
+        Il lock copre lettura e sostituzione: una record() concorrente non va persa.
+        """
+        with self._lock:
+            now = time.time()
+            live = [e for e in self._by_id.values() if not self._is_expired(e, now)]
+            if not force and self._lines_on_disk <= max(2 * len(live), 100):
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in live:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            logging.info("Registro compattato: %d -> %d righe", self._lines_on_disk, len(live))
+            self._by_id = {}
+            self._by_hash = {}
+            self._senders = None
+            for entry in live:
+                self._index(entry)
+            self._lines_on_disk = len(live)
@@ -0,0 +1,127 @@
+"""Tempi e contatori dell'esecuzione."""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Tuple
+
+
+class RunMetrics:
+    """Timer e contatori dell'esecuzione, esportati in JSON e per Prometheus."""
+
+    PREFIX = "calendar_agent"
+    MAX_SAMPLES = 2048
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.time()
+            self._timings: Dict[Tuple[str, Tuple], Dict] = {}
+            self._counters: Dict[Tuple[str, Tuple], float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        with self._lock:
+            entry = self._timings.setdefault(
+                self._key(name, labels), {"count": 0, "sum": 0.0, "max": 0.0, "samples": deque(maxlen=self.MAX_SAMPLES)}
+            )
+            entry["count"] += 1
+            entry["sum"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["samples"].append(seconds)
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    @staticmethod
+    def _quantile(samples, q: float) -> float:
+        ordered = sorted(samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @staticmethod
+    def _label_str(labels: Tuple) -> str:
+        return ",".join(f"{k}={v}" for k, v in labels)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            timings = {k: dict(v, samples=list(v["samples"])) for k, v in self._timings.items()}
+            counters = dict(self._counters)
+        stages: Dict[str, Dict] = {}
+        for (name, labels), v in sorted(timings.items()):
+            stages.setdefault(name, {})[self._label_str(labels)] = {
+                "count": v["count"],
+                "total_secs": round(v["sum"], 4),
+                "p50_ms": round(self._quantile(v["samples"], 0.5) * 1000, 2),
+                "p95_ms": round(self._quantile(v["samples"], 0.95) * 1000, 2),
+                "max_ms": round(v["max"] * 1000, 2),
+            }
+        counts: Dict[str, Dict] = {}
+        for (name, labels), value in sorted(counters.items()):
+            counts.setdefault(name, {})[self._label_str(labels)] = value
+        now = time.time()
+        return {
+            "started_at": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "finished_at": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+            "duration_secs": round(now - self.started, 3),
+            "stages": stages,
+            "counters": counts,
+        }
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+    def to_prometheus(self) -> str:
+        def _labels(labels: Tuple, extra: Tuple = ()) -> str:
+            items = labels + extra
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{self._escape(v)}"' for k, v in items) + "}"
+
+        with self._lock:
+            timings = {k: dict(v, samples=list(v["samples"])) for k, v in self._timings.items()}
+            counters = dict(self._counters)
+        p = self.PREFIX
+        lines = [
+            f"# HELP {p}_stage_seconds Durata delle fasi dell'esecuzione.",
+            f"# TYPE {p}_stage_seconds summary",
+        ]
+        for (name, labels), v in sorted(timings.items()):
+            base = (("stage", name),) + labels
+            for q in (0.5, 0.95):
+                lines.append(f"{p}_stage_seconds{_labels(base, (('quantile', str(q)),))} {self._quantile(v['samples'], q):.6f}")
+            lines.append(f"{p}_stage_seconds_sum{_labels(base)} {v['sum']:.6f}")
+            lines.append(f"{p}_stage_seconds_count{_labels(base)} {v['count']}")
+        for name in sorted({n for n, _ in counters}):
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{p}_{name}_total{_labels(labels)} {value:g}")
+        now = time.time()
+        lines += [
+            f"# TYPE {p}_run_duration_seconds gauge",
+            f"{p}_run_duration_seconds {now - self.started:.3f}",
+            f"# TYPE {p}_last_run_timestamp_seconds gauge",
+            f"{p}_last_run_timestamp_seconds {now:.0f}",
+        ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,98 @@
+"""Prefiltro locale delle email senza riferimenti temporali."""
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+class EmailPrefilter:
+    """Scarta senza Gemini le email prive di riferimenti temporali."""
+
+    _MONTHS = (
+        r"gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre"
+        r"|gen|feb|mar|apr|mag|giu|lug|ago|set|ott|nov|dic"
+        r"|january|february|march|april|may|june|july|august|september|october|november|december"
+        r"|jan|jun|jul|aug|sep|sept|oct|dec"
+    )
+    _WEEKDAYS = (
+        r"luned[iì]|marted[iì]|mercoled[iì]|gioved[iì]|venerd[iì]|sabato|domenica"
+        r"|monday|tuesday|wednesday|thursday|friday|saturday|sunday"
+    )
+    PATTERNS = [
+        ("data", 0.6, re.compile(
+            r"\b\d{4}-\d{2}-\d{2}\b"
+            r"|\b\d{1,2}[/.\-]\d{1,2}(?:[/.\-]\d{2,4})?\b"
+            rf"|\b\d{{1,2}}(?:°|º|st|nd|rd|th)?\s+(?:di\s+|of\s+)?(?:{_MONTHS})\b"
+            rf"|\b(?:{_MONTHS})\.?\s+\d{{1,2}}(?:st|nd|rd|th)?\b",
+            re.IGNORECASE,
+        )),
+        ("orario", 0.3, re.compile(
+            r"\b(?:[01]?\d|2[0-3])[:.][0-5]\d\b"
+            r"|\b(?:ore|alle|dalle|at)\s+(?:[01]?\d|2[0-3])\b"
+            r"|\b(?:1[0-2]|0?[1-9])\s?(?:am|pm)\b",
+            re.IGNORECASE,
+        )),
+        ("giorno_settimana", 0.3, re.compile(rf"\b(?:{_WEEKDAYS})\b", re.IGNORECASE)),
+        ("relativa", 0.4, re.compile(
+            r"\b(?:oggi|domani|dopodomani|stasera|stamattina|stanotte|entro\s+il|entro"
+            r"|(?:la\s+)?prossima\s+settimana|settimana\s+prossima|fine\s+mese|scadenza|scade"
+            rf"|(?:{_WEEKDAYS})\s+prossim[oa]|prossim[oa]\s+(?:{_WEEKDAYS})"
+            r"|today|tomorrow|tonight|next\s+week|this\s+week|due\s+(?:by|on)|deadline"
+            rf"|(?:next|this|by)\s+(?:{_WEEKDAYS}))\b",
+            re.IGNORECASE,
+        )),
+    ]
+
+    def __init__(
+        self,
+        threshold: float = 0.3,
+        allow_senders: Optional[List[str]] = None,
+        deny_senders: Optional[List[str]] = None,
+        allow_labels: Optional[List[str]] = None,
+        deny_labels: Optional[List[str]] = None,
+        max_chars: int = 20000,
+    ):
+        self.threshold = threshold
+        self.allow_senders = [x.lower() for x in allow_senders or [] if x]
+        self.deny_senders = [x.lower() for x in deny_senders or [] if x]
+        self.allow_labels = set(x.upper() for x in allow_labels or [] if x)
+        self.deny_labels = set(x.upper() for x in deny_labels or [] if x)
+        self.max_chars = max_chars
+
+    @staticmethod
+    def split_list(raw: Optional[str]) -> List[str]:
+        return [x.strip() for x in (raw or "").split(",") if x.strip()]
+
+    def list_verdict(self, meta: Optional[Dict] = None) -> Tuple[Optional[bool], str]:
+        """Esito di mittenti ed etichette consentiti/esclusi: (True/False, motivo), o (None, "") se nessuno si applica."""
+        meta = meta or {}
+        sender = str(meta.get("from") or "").lower()
+        labels = set(str(x).upper() for x in meta.get("labels") or [])
+        for s_allow in self.allow_senders:
+            if s_allow in sender:
+                return True, f"mittente consentito ({s_allow})"
+        if labels & self.allow_labels:
+            return True, f"etichetta consentita ({', '.join(sorted(labels & self.allow_labels))})"
+        for s_deny in self.deny_senders:
+            if s_deny in sender:
+                return False, f"mittente escluso ({s_deny})"
+        if labels & self.deny_labels:
+            return False, f"etichetta esclusa ({', '.join(sorted(labels & self.deny_labels))})"
+        return None, ""
+
+    def evaluate(self, subject: str, body: str, meta: Optional[Dict] = None) -> Tuple[bool, float, str]:
+        """Restituisce (inviare_a_gemini, confidenza, motivo)."""
+        verdict, reason = self.list_verdict(meta)
+        if verdict is not None:
+            return verdict, 1.0 if verdict else 0.0, reason
+
+        text = f"{subject or ''}\n{(body or '')[:self.max_chars]}"
+        score = 0.0
+        found = []
+        for name, weight, pattern in self.PATTERNS:
+            if pattern.search(text):
+                score += weight
+                found.append(name)
+        score = min(1.0, score)
+        if score >= self.threshold:
+            return True, score, "indizi temporali: " + ", ".join(found)
+        return False, score, "nessun riferimento a date/orari" if not found else "confidenza bassa: " + ", ".join(found)
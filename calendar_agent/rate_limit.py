@@ -0,0 +1,203 @@
+"""Budget delle chiamate Gemini per modello."""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:  # pragma: no cover
+    ZoneInfo = None
+
+from .util import write_json_file
+
+
+# Limiti Gemini del piano gratuito (richieste/minuto, token/minuto, richieste/giorno),
+# usati dal rate limiter se GEMINI_RATE_LIMITS non li sovrascrive
+GEMINI_PRO_FREE_LIMITS = (5, 250000, 100)
+
+GEMINI_FLASH_FREE_LIMITS = (10, 250000, 250)
+
+
+# Attesa massima per il budget di un modello prima di passare al successivo (GEMINI_MAX_WAIT_SECS)
+GEMINI_MAX_WAIT_DEFAULT_SECS = 60.0
+
+
+def _quota_day() -> str:
+    # Le quote giornaliere Gemini si azzerano a mezzanotte ora del Pacifico
+    if ZoneInfo is not None:
+        try:
+            return datetime.now(ZoneInfo("America/Los_Angeles")).date().isoformat()
+        except Exception:
+            pass
+    return datetime.utcnow().date().isoformat()
+
+
+class GeminiRateLimiter:
+    """Token bucket per modello (richieste/minuto, token/minuto, richieste/giorno)."""
+
+    DEFAULT_LIMITS = {
+        "gemini-2.5-pro": GEMINI_PRO_FREE_LIMITS,
+        "gemini-2.5-flash": GEMINI_FLASH_FREE_LIMITS,
+    }
+
+    def __init__(self, path: Optional[str] = None, limits: Optional[Dict[str, Tuple[int, int, int]]] = None,
+                 max_wait: float = GEMINI_MAX_WAIT_DEFAULT_SECS):
+        self.path = path
+        self.limits = dict(self.DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._models: Dict[str, Dict] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._models = json.load(f).get("models", {})
+            except Exception as e:
+                logging.warning("Stato budget Gemini illeggibile, riparto da zero: %s", e)
+
+    @staticmethod
+    def parse_limits(spec: str) -> Dict[str, Tuple[int, int, int]]:
+        """Interpreta 'modello:rpm/tpm/rpd,modello:rpm/tpm/rpd' (0 = nessun limite)."""
+        limits: Dict[str, Tuple[int, int, int]] = {}
+        for item in (spec or "").split(","):
+            if ":" not in item:
+                continue
+            name, values = item.split(":", 1)
+            try:
+                nums = [int(v) for v in values.split("/")]
+            except ValueError:
+                logging.warning("Limite Gemini non valido ignorato: %s", item)
+                continue
+            nums += [0] * (3 - len(nums))
+            limits[name.strip()] = (nums[0], nums[1], nums[2])
+        return limits
+
+    def _limits_for(self, model: str) -> Tuple[int, int, int]:
+        return self.limits.get(model) or self.limits.get("gemini-2.5-flash") or (0, 0, 0)
+
+    def _state(self, model: str, now: float) -> Dict:
+        rpm, tpm, _ = self._limits_for(model)
+        st = self._models.setdefault(
+            model,
+            {"requests": float(rpm), "tokens": float(tpm), "updated": now, "blocked_until": 0.0,
+             "day": _quota_day(), "day_count": 0, "failures": 0},
+        )
+        elapsed = max(0.0, now - float(st.get("updated", now)))
+        if rpm:
+            st["requests"] = min(float(rpm), float(st.get("requests", rpm)) + elapsed * rpm / 60.0)
+        if tpm:
+            st["tokens"] = min(float(tpm), float(st.get("tokens", tpm)) + elapsed * tpm / 60.0)
+        st["updated"] = now
+        day = _quota_day()
+        if st.get("day") != day:
+            st["day"] = day
+            st["day_count"] = 0
+        return st
+
+    def _wait_time(self, model: str, st: Dict, est_tokens: int, now: float) -> float:
+        rpm, tpm, rpd = self._limits_for(model)
+        if rpd and st.get("day_count", 0) >= rpd:
+            return float("inf")
+        wait = max(0.0, float(st.get("blocked_until", 0.0)) - now)
+        if rpm and st["requests"] < 1.0:
+            wait = max(wait, (1.0 - st["requests"]) * 60.0 / rpm)
+        if tpm:
+            needed = min(float(est_tokens), float(tpm))
+            if st["tokens"] < needed:
+                wait = max(wait, (needed - st["tokens"]) * 60.0 / tpm)
+        return wait
+
+    def acquire(self, model: str, est_tokens: int = 0) -> bool:
+        """Attende il budget per una chiamata. False se il modello è esaurito (attesa > max_wait)."""
+        while True:
+            with self._lock:
+                now = time.time()
+                st = self._state(model, now)
+                wait = self._wait_time(model, st, est_tokens, now)
+                if wait <= 0:
+                    st["requests"] -= 1.0
+                    st["tokens"] -= float(est_tokens)
+                    st["day_count"] = int(st.get("day_count", 0)) + 1
+                    return True
+            if wait > self.max_wait:
+                return False
+            logging.info("Budget Gemini %s: attendo %.1fs", model, wait)
+            time.sleep(wait + random.uniform(0, 0.25))
+
+    def refund(self, model: str, est_tokens: int = 0) -> None:
+        """Restituisce il budget di un acquire() per una chiamata non partita o fallita senza 429."""
+        with self._lock:
+            st = self._state(model, time.time())
+            rpm, tpm, _ = self._limits_for(model)
+            st["requests"] = min(float(rpm), st["requests"] + 1.0) if rpm else st["requests"] + 1.0
+            st["tokens"] = min(float(tpm), st["tokens"] + float(est_tokens)) if tpm else st["tokens"] + float(est_tokens)
+            st["day_count"] = max(0, int(st.get("day_count", 0)) - 1)
+
+    def record_usage(self, model: str, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        with self._lock:
+            st = self._state(model, time.time())
+            st["failures"] = 0
+            if actual_tokens:
+                st["tokens"] += float(est_tokens - actual_tokens)
+
+    def penalize(self, model: str, retry_after: Optional[int] = None) -> float:
+        """Registra un 429: blocca il modello e restituisce il ritardo applicato."""
+        with self._lock:
+            now = time.time()
+            st = self._state(model, now)
+            st["failures"] = int(st.get("failures", 0)) + 1
+            if retry_after:
+                delay = float(retry_after) + random.uniform(0, 1.0)
+            else:
+                delay = min(120.0, 2.0 ** st["failures"]) * random.uniform(0.5, 1.5)
+            st["blocked_until"] = max(float(st.get("blocked_until", 0.0)), now + delay)
+            st["requests"] = min(st["requests"], 0.0)
+            return delay
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            content = json.dumps({"models": self._models}, ensure_ascii=False)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        write_json_file(self.path, content)
+
+
+class CombinedRateLimiter:
+    """Più limitatori applicati insieme, con la stessa interfaccia di GeminiRateLimiter."""
+
+    def __init__(self, limiters: List, max_wait: float = GEMINI_MAX_WAIT_DEFAULT_SECS):
+        self.limiters = list(limiters)
+        self.max_wait = max_wait
+
+    def acquire(self, model: str, est_tokens: int = 0) -> bool:
+        """Acquisisce il budget da tutti i limitatori; se uno è esaurito restituisce quello già preso."""
+        acquired = []
+        for limiter in self.limiters:
+            if not limiter.acquire(model, est_tokens):
+                for previous in acquired:
+                    previous.refund(model, est_tokens)
+                return False
+            acquired.append(limiter)
+        return True
+
+    def refund(self, model: str, est_tokens: int = 0) -> None:
+        for limiter in self.limiters:
+            limiter.refund(model, est_tokens)
+
+    def record_usage(self, model: str, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        for limiter in self.limiters:
+            limiter.record_usage(model, est_tokens, actual_tokens)
+
+    def penalize(self, model: str, retry_after: Optional[int] = None) -> float:
+        return max([limiter.penalize(model, retry_after) for limiter in self.limiters] or [0.0])
+
+    def save(self) -> None:
+        for limiter in self.limiters:
+            limiter.save()
@@ -0,0 +1,28 @@
+"""Email scaricata e passata alle fasi di analisi."""
+
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+def sender_address(value: Optional[str]) -> str:
+    """Indirizzo email del mittente in minuscolo ("Nome <a@b.it>" -> "a@b.it")."""
+    match = re.search(r"<([^<>]+)>", value or "")
+    return (match.group(1) if match else value or "").strip().lower()
+
+
+class EmailRecord(NamedTuple):
+    """Email scaricata, con i dati letti al download che servono alle fasi locali prima di Gemini."""
+
+    msg_id: str
+    subject: str
+    body: str
+    # Mittente, etichette e data di ricezione
+    meta: Optional[Dict] = None
+    # Eventi degli inviti iCalendar (None: nessun invito; lista vuota: invito senza eventi da creare)
+    calendar_events: Optional[List[Dict]] = None
+    # Altre email della stessa conversazione rappresentate da questo record
+    siblings: Tuple[str, ...] = ()
+
+    @property
+    def sender(self) -> str:
+        return sender_address((self.meta or {}).get("from"))
@@ -0,0 +1,128 @@
+"""Priorità delle email e scadenza dell'esecuzione."""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from .ledger import ProcessedLedger
+from .metrics import RunMetrics
+from .prefilter import EmailPrefilter
+from .records import EmailRecord
+from .util import write_json_file
+
+
+class RunScheduler:
+    """Ordine di priorità delle email e scadenza dell'esecuzione."""
+
+    DEFAULT_LATENCY_SECS = 15.0
+    SNIPPET_CHARS = 300
+    CARRIED_BONUS = 0.3
+
+    def __init__(self, path: str, deadline: Optional[float] = None, ledger: Optional[ProcessedLedger] = None,
+                 prioritize: bool = True, metrics: Optional[RunMetrics] = None):
+        self.path = path
+        self.deadline = deadline
+        self.ledger = ledger
+        self.prioritize = prioritize
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.carried: List[str] = []
+        self.deferred: Dict[str, None] = {}
+        self._samples: deque = deque(maxlen=256)
+        self._saved_latency: Optional[float] = None
+        self._lock = threading.Lock()
+        self._announced = False
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.carried = [i for i in data.get("deferred", []) if i]
+                self._saved_latency = data.get("latency_p95_secs")
+            except Exception as e:
+                logging.warning("Stato dello scheduler illeggibile (%s): lo ignoro", e)
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def latency_p95(self) -> float:
+        with self._lock:
+            samples = list(self._samples)
+        if samples:
+            return RunMetrics._quantile(samples, 0.95)
+        return self._saved_latency or self.DEFAULT_LATENCY_SECS
+
+    def observe(self, seconds: float) -> None:
+        """Registra la durata di un'analisi Gemini (singola email o blocco)."""
+        with self._lock:
+            self._samples.append(seconds)
+        self.metrics.observe("analisi_gemini", seconds)
+
+    def can_dispatch(self) -> bool:
+        """True se c'è ancora tempo per una nuova chiamata Gemini prima della scadenza."""
+        remaining = self.remaining()
+        if remaining is None:
+            return True
+        latency = self.latency_p95()
+        if remaining > latency:
+            return True
+        if not self._announced:
+            self._announced = True
+            logging.warning(
+                "Scadenza vicina (restano %.0fs, p95 analisi %.1fs): nessuna nuova chiamata Gemini, "
+                "le email rimanenti passano al prossimo avvio", max(0.0, remaining), latency,
+            )
+        return False
+
+    def defer(self, msg_ids: List[str]) -> None:
+        with self._lock:
+            for msg_id in msg_ids:
+                self.deferred[msg_id] = None
+        self.metrics.incr("email_rimandate", len(msg_ids))
+
+    def with_carried(self, messages: List[Dict], limit: Optional[int] = None, exclude=None) -> List[Dict]:
+        """Antepone ai candidati le email rimandate dall'esecuzione precedente (entro il limite)."""
+        listed = {m.get("id") for m in messages}
+        extra = [{"id": i} for i in self.carried if i not in listed and (exclude is None or i not in exclude)]
+        if extra:
+            logging.info("%d email rimandate dall'esecuzione precedente riprese per prime", len(extra))
+        combined = extra + messages
+        return combined if limit is None else combined[:limit]
+
+    def score(self, record: EmailRecord) -> float:
+        meta = record.meta or {}
+        text = f"{record.subject or ''}\n{(record.body or '')[:self.SNIPPET_CHARS]}"
+        temporal = min(1.0, sum(weight for _, weight, pattern in EmailPrefilter.PATTERNS if pattern.search(text)))
+        sender = self.ledger.sender_event_rate(record.sender) if self.ledger is not None else 0.5
+        recency = 0.5
+        if meta.get("date"):
+            age_days = max(0.0, time.time() - int(meta["date"]) / 1000) / 86400
+            recency = 1 / (1 + age_days / 7)
+        bonus = self.CARRIED_BONUS if record.msg_id in self.carried else 0.0
+        return 0.5 * temporal + 0.3 * sender + 0.2 * recency + bonus
+
+    def rank(self, records) -> List[Tuple[float, EmailRecord]]:
+        """Coppie (punteggio, record) dalla più promettente; scarta le rimandate lette nel frattempo."""
+        scored = []
+        for record in records:
+            labels = (record.meta or {}).get("labels")
+            if labels and "UNREAD" not in labels and record.msg_id in self.carried:
+                logging.info("Email rimandata %s letta nel frattempo: non la analizzo", record.msg_id)
+                continue
+            scored.append((self.score(record) if self.prioritize else 0.0, record))
+        if self.prioritize:
+            scored.sort(key=lambda item: item[0], reverse=True)
+        return scored
+
+    def save(self) -> None:
+        samples = list(self._samples)
+        latency = RunMetrics._quantile(samples, 0.95) if samples else self._saved_latency
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        content = json.dumps(
+            {"deferred": list(self.deferred), "latency_p95_secs": latency, "ts": int(time.time())}, ensure_ascii=False
+        )
+        write_json_file(self.path, content)
+        if self.deferred:
+            logging.info("%d email rimandate al prossimo avvio per la scadenza", len(self.deferred))
@@ -0,0 +1,356 @@
+"""Modelli di estrazione appresi per mittente."""
+
+import functools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .dates import reference_now
+from .decisions import TIME_RE, normalize_date, parse_event_decision
+from .metrics import RunMetrics
+from .prefilter import EmailPrefilter
+from .records import EmailRecord
+from .util import write_json_file
+
+
+# Prefissi di risposta/inoltro nell'oggetto ("Re: ", "R: ", "Fwd: ", "I: ")
+_REPLY_PREFIX = re.compile(r"^(?:(?:re|r|fwd?|i|rif)\s*:\s*)+", re.IGNORECASE)
+
+
+class SenderTemplates:
+    """Modelli di estrazione per mittente, appresi dalle risposte di Gemini.
+    Una quota delle email coperte va comunque a Gemini; al primo disaccordo il modello è scartato.
+    """
+
+    MAX_SENDERS = 500
+    MAX_ANCHOR_WORDS = 3
+    _MONTH_NUMBERS = {
+        "gen": 1, "jan": 1, "feb": 2, "mar": 3, "apr": 4, "mag": 5, "may": 5, "giu": 6, "jun": 6,
+        "lug": 7, "jul": 7, "ago": 8, "aug": 8, "set": 9, "sep": 9, "ott": 10, "oct": 10,
+        "nov": 11, "dic": 12, "dec": 12,
+    }
+    DATE_FORMATS = {
+        "iso": r"(?<!\d)(\d{4})-(\d{2})-(\d{2})(?!\d)",
+        "numerica": r"(?<!\d)(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4}|\d{2})(?!\d)",
+        "testuale": (
+            rf"(?:(?:{EmailPrefilter._WEEKDAYS}),?\s+)?(?<!\d)(\d{{1,2}})(?:°|º)?\s+"
+            rf"({EmailPrefilter._MONTHS})\.?(?:\s+(\d{{4}}))?\b"
+        ),
+    }
+    TIME_FORMATS = {
+        "orario": r"(?<!\d)([01]?\d|2[0-3])[:.h]([0-5]\d)(?!\d)",
+        "ore": r"\b(?:ore|alle)\s+([01]?\d|2[0-3])\b(?![:.h]?\d)",
+    }
+
+    def __init__(self, path: str, min_examples: int = 3, verify_rate: float = 0.1,
+                 metrics: Optional[RunMetrics] = None):
+        self.path = path
+        self.min_examples = max(2, min_examples)
+        self.verify_rate = max(0.0, min(1.0, verify_rate))
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.senders: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.senders = json.load(f).get("senders", {})
+            except Exception as e:
+                logging.warning("Modelli per mittente illeggibili (%s): li ignoro", e)
+
+    # --- riconoscimento di date e orari -------------------------------------------------
+
+    @staticmethod
+    def _reference_day():
+        # Stessa data di riferimento del prompt (o la data di invio nel recupero storico)
+        return reference_now().date()
+
+    @classmethod
+    def _parse_date(cls, fmt: str, match, today) -> Optional[str]:
+        try:
+            if fmt == "iso":
+                year, month, day = (int(g) for g in match.groups())
+            elif fmt == "numerica":
+                day, month, year = (int(g) for g in match.groups())
+                year += 2000 if year < 100 else 0
+            else:
+                day, month = int(match.group(1)), cls._MONTH_NUMBERS[match.group(2)[:3].lower()]
+                year = int(match.group(3)) if match.group(3) else None
+            if year is None:
+                # Anno mancante: stessa regola del prompt (anno corrente, o il successivo se già passata)
+                year = today.year if datetime(today.year, month, day).date() >= today else today.year + 1
+            return datetime(year, month, day).date().isoformat()
+        except (ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _parse_time(fmt: str, match) -> str:
+        minutes = int(match.group(2)) if fmt == "orario" else 0
+        return f"{int(match.group(1)):02d}:{minutes:02d}"
+
+    @classmethod
+    def _anchors(cls, text: str, start: int) -> List[str]:
+        """Ancore candidate: da 1 a MAX_ANCHOR_WORDS parole prima dell'occorrenza."""
+        line_start = text.rfind("\n", 0, start) + 1
+        words = text[line_start:start].split()
+        prefix = ""
+        if not words:
+            previous = text[:line_start].rstrip()
+            words = previous[previous.rfind("\n") + 1:].split()
+            prefix = "\n"
+        return [prefix + " ".join(words[-n:]).lower() for n in range(1, min(len(words), cls.MAX_ANCHOR_WORDS) + 1)]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _anchor_regex(anchor: str, pattern: str):
+        separator = r"[ \t]*\n\s*" if anchor.startswith("\n") else r"\s*"
+        words = r"\s+".join(re.escape(w) for w in anchor.split())
+        return re.compile(rf"(?<!\w){words}{separator}(?:{pattern})", re.IGNORECASE)
+
+    @classmethod
+    def _find(cls, rule: List[str], text: str, today, kind: str) -> Optional[str]:
+        anchor, fmt = rule
+        formats = cls.DATE_FORMATS if kind == "data" else cls.TIME_FORMATS
+        # L'ancora non ha gruppi: quelli della corrispondenza sono i gruppi del formato
+        match = cls._anchor_regex(anchor, formats[fmt]).search(text)
+        if match is None:
+            return None
+        return cls._parse_date(fmt, match, today) if kind == "data" else cls._parse_time(fmt, match)
+
+    @classmethod
+    def _value_rules(cls, text: str, expected: str, today, kind: str) -> List[List[str]]:
+        """Coppie (ancora, formato) che, applicate al testo, restituiscono proprio il valore atteso."""
+        formats = cls.DATE_FORMATS if kind == "data" else cls.TIME_FORMATS
+        rules = []
+        for fmt, pattern in formats.items():
+            for match in re.finditer(pattern, text, re.IGNORECASE):
+                parsed = cls._parse_date(fmt, match, today) if kind == "data" else cls._parse_time(fmt, match)
+                if parsed != expected:
+                    continue
+                for anchor in cls._anchors(text, match.start()):
+                    rule = [anchor, fmt]
+                    if rule not in rules and cls._find(rule, text, today, kind) == expected:
+                        rules.append(rule)
+        return rules
+
+    @classmethod
+    def subject_shape(cls, subject: str) -> str:
+        """Forma dell'oggetto: minuscolo, senza prefissi Re/Fwd, con date, orari e numeri sostituiti."""
+        shape = _REPLY_PREFIX.sub("", (subject or "").strip()).lower()
+        for pattern in cls.DATE_FORMATS.values():
+            shape = re.sub(pattern, "<data>", shape, flags=re.IGNORECASE)
+        for pattern in cls.TIME_FORMATS.values():
+            shape = re.sub(pattern, "<ora>", shape, flags=re.IGNORECASE)
+        return " ".join(re.sub(r"\d+", "#", shape).split())
+
+    @staticmethod
+    def _clean(value: str) -> str:
+        return " ".join(value.split()).strip(" :-–").lower()
+
+    @classmethod
+    def _title_rules(cls, title: str, subject: str, text: str) -> List[List[str]]:
+        wanted = cls._clean(title)
+        rules = []
+        for line in text.splitlines():
+            for sep in (":", " - ", " – "):
+                label, found, rest = line.partition(sep)
+                if found and label.strip() and len(label.split()) <= cls.MAX_ANCHOR_WORDS and cls._clean(rest) == wanted:
+                    rules.append(["riga", label.strip().lower() + sep.strip()])
+        if cls._clean(subject) == wanted:
+            rules.append(["oggetto"])
+        rules.append(["fisso", title.strip()])
+        return rules
+
+    @staticmethod
+    def _title(rule: List[str], subject: str, text: str) -> Optional[str]:
+        if rule[0] == "riga":
+            for line in text.splitlines():
+                if line.strip().lower().startswith(rule[1]):
+                    value = line.strip()[len(rule[1]):].strip()
+                    return value or None
+            return None
+        if rule[0] == "fisso":
+            return rule[1]
+        return subject.strip() or None
+
+    # --- apprendimento e applicazione ---------------------------------------------------
+
+    @staticmethod
+    def _single_event(result: Dict) -> Optional[Dict]:
+        if parse_event_decision(result)[0] is not True:
+            return None
+        events = result.get("eventi") if isinstance(result.get("eventi"), list) else [result]
+        return events[0] if len(events) == 1 else None
+
+    @staticmethod
+    def _expected(event: Dict) -> Tuple[Optional[str], Optional[str], str]:
+        _, titolo, data_str, ora_inizio, _ = parse_event_decision(dict(event, creare_evento="si"))
+        try:
+            data_str = normalize_date(data_str) if data_str else None
+        except ValueError:
+            data_str = None
+        if ora_inizio and TIME_RE.match(ora_inizio):
+            hours, minutes = ora_inizio.split(":")[:2]
+            ora_inizio = f"{int(hours):02d}:{minutes}"
+        else:
+            ora_inizio = None
+        return data_str, ora_inizio, titolo
+
+    def _derive(self, examples: List[Dict]) -> Optional[Dict]:
+        """Modello comune agli esempi, o None se le ancore non coincidono."""
+        def common(key):
+            rules = [r for r in examples[0][key] if all(r in e[key] for e in examples[1:])]
+            # Ancora più lunga = più specifica
+            return sorted(rules, key=lambda r: len(r[0].split()), reverse=True)
+
+        dates = common("data")
+        if not dates:
+            return None
+        has_time = [e["ora"] is not None for e in examples]
+        if any(has_time) and not all(has_time):
+            return None
+        times = common("ora") if all(has_time) else None
+        if times is not None and not times:
+            return None
+        titles = common("titolo")
+        order = {"riga": 0, "oggetto": 1, "fisso": 2}
+        titles.sort(key=lambda r: order[r[0]])
+        return {
+            "data": dates[0],
+            "ora": times[0] if times else None,
+            # Titoli parafrasati da Gemini: si ripiega sull'oggetto
+            "titolo": titles[0] if titles else ["oggetto"],
+            "oggetti": sorted({e["oggetto"] for e in examples if e.get("oggetto") is not None}),
+            "creato": int(time.time()),
+            "usi": 0,
+            "verifiche": 0,
+        }
+
+    def _apply(self, template: Dict, subject: str, body: str) -> Optional[Dict]:
+        text = f"{subject or ''}\n{body or ''}"
+        today = self._reference_day()
+        data_str = self._find(template["data"], text, today, "data")
+        if data_str is None:
+            return None
+        ora_inizio = None
+        if template.get("ora"):
+            ora_inizio = self._find(template["ora"], text, today, "ora")
+            if ora_inizio is None:
+                return None
+        titolo = self._title(template["titolo"], subject or "", text)
+        if not titolo:
+            return None
+        return {"creare_evento": "si", "titolo": titolo, "data": data_str, "ora_inizio": ora_inizio, "descrizione": ""}
+
+    def lookup(self, record: EmailRecord) -> Optional[Dict]:
+        """Risposta ricavata dal modello del mittente, o None (anche per le email da verificare)."""
+        _, subject, body = record[:3]
+        with self._lock:
+            template = (self.senders.get(record.sender) or {}).get("modello")
+        if not template:
+            return None
+        if self.subject_shape(subject) not in template.get("oggetti", ()):
+            self.metrics.incr("modelli_mittente", esito="oggetto_diverso")
+            return None
+        if random.random() < self.verify_rate:
+            self.metrics.incr("modelli_mittente", esito="verifica")
+            return None
+        result = self._apply(template, subject, body)
+        if result is None:
+            self.metrics.incr("modelli_mittente", esito="non_applicabile")
+            return None
+        with self._lock:
+            template["usi"] = template.get("usi", 0) + 1
+            self._dirty = True
+        self.metrics.incr("modelli_mittente", esito="applicato")
+        return result
+
+    def observe(self, record: EmailRecord, result: Dict) -> None:
+        """Apprende dalla risposta di Gemini e la usa per verificare il modello esistente."""
+        msg_id, subject, body = record[:3]
+        sender = record.sender
+        if not sender or not isinstance(result, dict):
+            return
+        with self._lock:
+            template = (self.senders.get(sender) or {}).get("modello")
+        if template:
+            local = self._apply(template, subject, body)
+            if local is None:
+                return
+            event = self._single_event(result)
+            expected = self._expected(event)[:2] if event is not None else None
+            shape = self.subject_shape(subject)
+            known_shape = shape in template.get("oggetti", ())
+            if expected == (local["data"], local["ora_inizio"]):
+                with self._lock:
+                    template["verifiche"] = template.get("verifiche", 0) + 1
+                    if not known_shape:
+                        # Stessa estrazione di Gemini con un nuovo tipo di oggetto: il modello vale anche per questo
+                        template.setdefault("oggetti", []).append(shape)
+                    self._dirty = True
+                self.metrics.incr("modelli_mittente", esito="confermato")
+                return
+            if not known_shape:
+                # Email di altro tipo, a cui il modello non sarebbe stato applicato
+                return
+            with self._lock:
+                template["verifiche"] = template.get("verifiche", 0) + 1
+                self._dirty = True
+            logging.warning(
+                "Modello del mittente %s in disaccordo con Gemini sull'email %s (%s/%s contro %s): lo scarto",
+                sender, msg_id, local["data"], local["ora_inizio"], "nessun evento" if expected is None else "/".join(map(str, expected)),
+            )
+            self.metrics.incr("modelli_mittente", esito="scartato")
+            with self._lock:
+                self.senders.pop(sender, None)
+        self._learn(sender, subject, body, result)
+
+    def _learn(self, sender: str, subject: str, body: str, result: Dict) -> None:
+        event = self._single_event(result)
+        if event is None:
+            return
+        data_str, ora_inizio, titolo = self._expected(event)
+        if data_str is None:
+            return
+        text = f"{subject or ''}\n{body or ''}"
+        today = self._reference_day()
+        example = {
+            "oggetto": self.subject_shape(subject),
+            "data": self._value_rules(text, data_str, today, "data"),
+            "ora": self._value_rules(text, ora_inizio, today, "ora") if ora_inizio else None,
+            "titolo": self._title_rules(titolo, subject or "", text),
+        }
+        with self._lock:
+            entry = self.senders.setdefault(sender, {"esempi": []})
+            entry["esempi"] = (entry["esempi"] + [example])[-self.min_examples:]
+            entry["aggiornato"] = int(time.time())
+            self._dirty = True
+            if entry.get("modello") or len(entry["esempi"]) < self.min_examples:
+                return
+            template = self._derive(entry["esempi"])
+            if template is None:
+                return
+            entry["modello"] = template
+            entry["esempi"] = []
+        logging.info("Nuovo modello di estrazione per il mittente %s: data dopo %r, orario %s",
+                     sender, template["data"][0].strip(), "dopo %r" % template["ora"][0].strip() if template["ora"] else "assente")
+        self.metrics.incr("modelli_mittente", esito="appreso")
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            if len(self.senders) > self.MAX_SENDERS:
+                # Tiene i mittenti con un modello e, tra gli altri, i più recenti
+                ranked = sorted(self.senders.items(), key=lambda kv: (bool(kv[1].get("modello")), kv[1].get("aggiornato", 0)))
+                self.senders = dict(ranked[-self.MAX_SENDERS:])
+            content = json.dumps({"senders": self.senders, "ts": int(time.time())}, ensure_ascii=False)
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        write_json_file(self.path, content)
@@ -0,0 +1,121 @@
+"""Configurazione dell'agente letta dalle variabili d'ambiente."""
+
+import logging
+import os
+from typing import Mapping, NamedTuple, Optional
+
+
+def env_int(name: str, default: int, env: Optional[Mapping[str, str]] = None) -> int:
+    try:
+        return int((os.environ if env is None else env).get(name, str(default)))
+    except Exception:
+        return default
+
+
+def env_float(name: str, default: float, env: Optional[Mapping[str, str]] = None) -> float:
+    try:
+        return float((os.environ if env is None else env).get(name, str(default)))
+    except Exception:
+        return default
+
+
+def env_bool(name: str, default: bool, env: Optional[Mapping[str, str]] = None) -> bool:
+    raw = (os.environ if env is None else env).get(name)
+    if raw is None or not raw.strip():
+        return default
+    return raw.strip().lower() in ("1", "true", "si", "sì", "yes", "on")
+
+
+class Settings(NamedTuple):
+    # Stato locale e credenziali
+    state_dir: str
+    token_file: Optional[str]
+    client_secret_file: Optional[str]
+    calendar_id: str
+    backfill_source: Optional[str]
+    # Lettura di Gmail
+    ledger_enabled: bool
+    ledger_ttl_days: int
+    incremental_sync: bool
+    batch_fetch_size: int
+    pipeline_mode: bool
+    fetch_workers: int
+    gemini_workers: int
+    write_workers: int
+    http_shared_session: bool
+    prefilter_enabled: bool
+    gmail_prescreen: bool
+    priority_order: bool
+    # Testo inviato a Gemini
+    body_max_chars: int
+    body_cleanup: bool
+    thread_coalesce: bool
+    ics_fast_path: bool
+    # Chiamate a Gemini
+    gemini_max_retries: int
+    gemini_batch_mode: bool
+    gemini_batch_size: int
+    gemini_batch_tokens: int
+    structured_output: bool
+    cascade_mode: bool
+    cascade_fast_model: str
+    cascade_strong_model: str
+    cascade_min_confidence: float
+    # Scrittura su Calendar e Gmail
+    bulk_writes: bool
+    # Demone e report (stringa vuota = file disattivato)
+    daemon_mode: bool
+    daemon_poll_min_secs: float
+    daemon_poll_max_secs: float
+    daemon_health_file: str
+    run_report_file: str
+    metrics_textfile: str
+
+
+def load_settings(env: Mapping[str, str], default_state_dir: str) -> Settings:
+    state_dir = env.get("STATE_DIR") or default_state_dir
+    daemon_poll_min_secs = max(1.0, env_float("DAEMON_POLL_MIN_SECS", 15.0, env))
+    prefilter_enabled = env_bool("PREFILTER_ENABLED", False, env)
+    gmail_prescreen = env_bool("GMAIL_PRESCREEN", False, env)
+    if gmail_prescreen and not prefilter_enabled:
+        logging.warning("GMAIL_PRESCREEN richiede PREFILTER_ENABLED=true: pre-selezione disattivata")
+        gmail_prescreen = False
+    return Settings(
+        state_dir=state_dir,
+        token_file=env.get("TOKEN_FILE") or None,
+        client_secret_file=env.get("CLIENT_SECRET_FILE") or None,
+        calendar_id=env.get("CALENDAR_ID") or "primary",
+        backfill_source=env.get("BACKFILL_SOURCE") or None,
+        ledger_enabled=env_bool("LEDGER_ENABLED", True, env),
+        ledger_ttl_days=env_int("LEDGER_TTL_DAYS", 30, env),
+        incremental_sync=env_bool("INCREMENTAL_SYNC", False, env),
+        batch_fetch_size=env_int("BATCH_FETCH_SIZE", 50, env),
+        pipeline_mode=env_bool("PIPELINE_MODE", False, env),
+        fetch_workers=max(1, env_int("FETCH_WORKERS", 2, env)),
+        gemini_workers=max(1, env_int("GEMINI_WORKERS", 4, env)),
+        write_workers=max(1, env_int("WRITE_WORKERS", 2, env)),
+        http_shared_session=env_bool("HTTP_SHARED_SESSION", True, env),
+        prefilter_enabled=prefilter_enabled,
+        gmail_prescreen=gmail_prescreen,
+        priority_order=env_bool("PRIORITY_ORDER", True, env),
+        body_max_chars=max(0, env_int("BODY_MAX_CHARS", 20000, env)),
+        body_cleanup=env_bool("BODY_CLEANUP", True, env),
+        thread_coalesce=env_bool("THREAD_COALESCE", True, env),
+        ics_fast_path=env_bool("ICS_FAST_PATH", True, env),
+        gemini_max_retries=max(0, env_int("GEMINI_MAX_RETRIES", 3, env)),
+        gemini_batch_mode=env_bool("GEMINI_BATCH_MODE", False, env),
+        gemini_batch_size=max(1, env_int("GEMINI_BATCH_SIZE", 10, env)),
+        gemini_batch_tokens=max(1000, env_int("GEMINI_BATCH_TOKENS", 8000, env)),
+        structured_output=env_bool("STRUCTURED_OUTPUT", False, env),
+        cascade_mode=env_bool("CASCADE_MODE", False, env),
+        cascade_fast_model=env.get("CASCADE_FAST_MODEL") or "gemini-2.5-flash",
+        cascade_strong_model=env.get("CASCADE_STRONG_MODEL") or env.get("GEMINI_MODEL", "gemini-2.5-pro"),
+        cascade_min_confidence=env_float("CASCADE_MIN_CONFIDENCE", 0.7, env),
+        bulk_writes=env_bool("BULK_WRITES", False, env),
+        daemon_mode=env_bool("DAEMON_MODE", False, env),
+        daemon_poll_min_secs=daemon_poll_min_secs,
+        daemon_poll_max_secs=max(daemon_poll_min_secs, env_float("DAEMON_POLL_MAX_SECS", 300.0, env)),
+        daemon_health_file=env.get("DAEMON_HEALTH_FILE") or os.path.join(state_dir, "health.json"),
+        run_report_file=env.get("RUN_REPORT_FILE", os.path.join(state_dir, "run_report.json")),
+        metrics_textfile=env.get("METRICS_TEXTFILE", os.path.join(state_dir, "metrics.prom")),
+    )
@@ -0,0 +1,23 @@
+"""Scrittura atomica dei file di stato."""
+
+import json
+import os
+
+
+def write_json_file(path: str, content: str) -> None:
+    # Valida JSON minimo
+    json.loads(content)
+    write_text_file(path, content)
+
+
+def write_text_file(path: str, content: str) -> None:
+    """Scrittura atomica: file temporaneo e poi rinomina."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    try:
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
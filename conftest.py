@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+import pytest
+
+import ControllaEmailCreaEvento as agent
+from benchmark import BENCH_ENV, FakeCalendar, FakeGenai, FakeGmail, FakeCredentials, Faults, generate_mailbox
+
+# Globali che main() e configure() sostituiscono: ripristinati a fine test
+_RUN_GLOBALS = (
+    "MODEL", "TIMEZONE", "MAX_UNREAD_TO_PROCESS", "PER_EMAIL_SLEEP_SECS", "SETTINGS", "METRICS", "BACKENDS",
+    "RATE_LIMITER", "PREFILTER", "RUN_DEADLINE", "SCHEDULER", "SENDER_TEMPLATES", "GEMINI_CLIENT", "EVENT_INDEX",
+)
+
+
+@pytest.fixture
+def run_agent(tmp_path, monkeypatch):
+    """Esegue main() contro Gmail, Calendar e Gemini finti del benchmark."""
+    for name in _RUN_GLOBALS:
+        monkeypatch.setattr(agent, name, getattr(agent, name))
+
+    def _run(messages=None, count=12, gmail=None, state="state", **env_overrides):
+        if gmail is None:
+            gmail = FakeGmail(messages if messages is not None else generate_mailbox(count)["messages"], Faults())
+        calendar = FakeCalendar(Faults())
+        sdk = FakeGenai(Faults())
+        backends = agent.Backends(credentials=FakeCredentials, services=lambda creds: (gmail, calendar), gemini_sdk=sdk)
+        env = dict(BENCH_ENV, STATE_DIR=str(tmp_path / state), MAX_UNREAD_TO_PROCESS="100")
+        env.update({key: str(value) for key, value in env_overrides.items()})
+        metrics = agent.RunMetrics()
+        agent.main(env, metrics, backends)
+        return SimpleNamespace(gmail=gmail, calendar=calendar, sdk=sdk, metrics=metrics, state_dir=tmp_path / state)
+
+    return _run
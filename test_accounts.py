@@ -0,0 +1,61 @@
+import json
+import multiprocessing
+import os
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent import accounts
+
+
+def _write_config(tmp_path, accounts, **extra):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps(dict(extra, accounts=accounts)), encoding="utf-8")
+    return str(path)
+
+
+def test_percorsi_relativi_alla_cartella_del_file(tmp_path):
+    config = agent.load_accounts_config(_write_config(tmp_path, [{"name": "casa", "token": "t/casa.json"}]))
+    account = config["accounts"][0]
+    assert account["token"] == os.path.join(str(tmp_path), "t/casa.json")
+    assert account["calendar"] == "primary"
+
+
+def test_nome_duplicato_rifiutato(tmp_path):
+    path = _write_config(tmp_path, [{"name": "a"}, {"name": "a"}])
+    try:
+        agent.load_accounts_config(path)
+    except ValueError:
+        return
+    raise AssertionError("nome duplicato accettato")
+
+
+def test_ambiente_dell_account_non_modifica_quello_del_processo(tmp_path, monkeypatch):
+    monkeypatch.setenv("TOKEN_JSON", "token-globale")
+    monkeypatch.setenv("TOKEN_LAVORO", "token-lavoro")
+    config = agent.load_accounts_config(_write_config(
+        tmp_path, [{"name": "lavoro", "token_env": "TOKEN_LAVORO", "env": {"GEMINI_MODEL": "gemini-2.5-flash"}}],
+    ))
+    before = dict(os.environ)
+    env = accounts.account_env(config["accounts"][0], str(tmp_path), os.environ, deadline=123.0)
+    assert dict(os.environ) == before
+    assert env["TOKEN_JSON"] == "token-lavoro"
+    assert env["GEMINI_MODEL"] == "gemini-2.5-flash"
+    assert env["STATE_DIR"] == os.path.join(str(tmp_path), "accounts", "lavoro")
+    assert env["RUN_DEADLINE_AT"] == "123.0"
+    assert env["GEMINI_RATE_LIMITER"] == "false"
+    assert env["ACCOUNTS_FILE"] == ""
+
+
+def test_configure_legge_la_configurazione_esplicita(tmp_path):
+    agent.configure({"STATE_DIR": str(tmp_path), "GEMINI_MODEL": "gemini-2.5-flash", "MAX_UNREAD_TO_PROCESS": "7"})
+    assert agent.MODEL == "gemini-2.5-flash"
+    assert agent.MAX_UNREAD_TO_PROCESS == 7
+    assert agent.SETTINGS.state_dir == str(tmp_path)
+
+
+def test_budget_condiviso_nel_processo_manager(tmp_path):
+    with accounts.BudgetManager(ctx=multiprocessing.get_context("spawn")) as manager:
+        budget = manager.GeminiRateLimiter(None, {"gemini-2.5-flash": (0, 0, 1)}, 0)
+        assert budget.acquire("gemini-2.5-flash", 10)
+        assert not budget.acquire("gemini-2.5-flash", 10)
+        budget.refund("gemini-2.5-flash", 10)
+        assert budget.acquire("gemini-2.5-flash", 10)
@@ -0,0 +1,88 @@
+import json
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent import backfill
+
+
+def _mbox(tmp_path, subjects):
+    lines = []
+    for n, subject in enumerate(subjects, 1):
+        lines.append(f"From mittente@example.com Mon Jan {n} 10:00:00 2024\n")
+        lines.append(f"Message-ID: <m{n}@example.com>\nSubject: {subject}\n\nCorpo {n}\n\n")
+    path = tmp_path / "posta.mbox"
+    path.write_text("".join(lines), encoding="utf-8")
+    return path
+
+
+def _env(tmp_path):
+    return {
+        "GEMINI_API_KEY": "chiave-di-prova",
+        "STATE_DIR": str(tmp_path / "state"),
+        "GEMINI_WORKERS": "2",
+        "BACKFILL_CHECKPOINT_EVERY": "1",
+        "RUN_REPORT_FILE": "",
+        "METRICS_TEXTFILE": "",
+    }
+
+
+def test_mbox_letto_a_messaggi_con_posizione(tmp_path):
+    path = _mbox(tmp_path, ["Uno", "Due"])
+    messages = list(backfill.iter_mbox(str(path)))
+    assert len(messages) == 2
+    assert b"Subject: Uno" in messages[0][1]
+    # La posizione del primo messaggio è l'inizio del secondo
+    assert b"Subject: Due" in next(backfill.iter_mbox(str(path), messages[0][0]))[1]
+
+
+def test_email_fallita_ritentata_alla_ripresa(tmp_path, monkeypatch):
+    path = _mbox(tmp_path, ["Uno", "Due", "Tre"])
+    failures = {"m2@example.com": 1}
+
+    def fake_analyze(raw):
+        msg_id = raw.split(b"Message-ID: <")[1].split(b">")[0].decode()
+        if failures.get(msg_id):
+            failures[msg_id] -= 1
+            raise RuntimeError("errore temporaneo")
+        decision = {"titolo": msg_id, "data": "2024-02-01", "ora_inizio": None}
+        return msg_id, msg_id, None, dict(decision, eventi=[decision])
+
+    monkeypatch.setattr(agent, "_backfill_analyze", fake_analyze)
+    monkeypatch.setattr(agent, "GeminiClient", lambda *args, **kwargs: None)
+    env = _env(tmp_path)
+
+    agent.run_backfill(str(path), env)
+    checkpoint = json.loads((tmp_path / "state" / "backfill_checkpoint.json").read_text(encoding="utf-8"))
+    assert checkpoint["processed"] == 2
+    assert list(checkpoint["failed"].values()) == [1]
+
+    agent.run_backfill(str(path), env)
+    checkpoint = json.loads((tmp_path / "state" / "backfill_checkpoint.json").read_text(encoding="utf-8"))
+    assert checkpoint["processed"] == 3
+    assert checkpoint["failed"] == {}
+    lines = (tmp_path / "state" / "backfill_events.jsonl").read_text(encoding="utf-8").splitlines()
+    assert sorted(json.loads(line)["message_id"] for line in lines) == ["m1@example.com", "m2@example.com", "m3@example.com"]
+
+
+def test_email_abbandonata_dopo_i_tentativi_massimi(tmp_path, monkeypatch):
+    path = _mbox(tmp_path, ["Uno"])
+
+    def broken(raw):
+        raise RuntimeError("messaggio illeggibile")
+
+    monkeypatch.setattr(agent, "_backfill_analyze", broken)
+    monkeypatch.setattr(agent, "GeminiClient", lambda *args, **kwargs: None)
+    env = _env(tmp_path)
+    for _ in range(backfill.MAX_ATTEMPTS):
+        agent.run_backfill(str(path), env)
+    checkpoint = json.loads((tmp_path / "state" / "backfill_checkpoint.json").read_text(encoding="utf-8"))
+    assert checkpoint["failed"] == {}
+    assert checkpoint["processed"] == 0
+
+
+def test_metriche_del_recupero_avviato_da_main(tmp_path, monkeypatch):
+    path = _mbox(tmp_path, ["Uno"])
+    monkeypatch.setattr(agent, "_backfill_analyze", lambda raw: ("m1@example.com", "Uno", None, None))
+    monkeypatch.setattr(agent, "GeminiClient", lambda *args, **kwargs: None)
+    metrics = agent.RunMetrics()
+    agent.main(dict(_env(tmp_path), BACKFILL_SOURCE=str(path)), metrics)
+    assert metrics.summary()["counters"]["backfill_email"] == {"esito=nessun_evento": 1}
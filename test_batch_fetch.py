@@ -0,0 +1,72 @@
+import base64
+
+from googleapiclient.errors import HttpError
+import httplib2
+
+import ControllaEmailCreaEvento as agent
+
+
+def _error(status):
+    return HttpError(httplib2.Response({"status": str(status)}), b"")
+
+
+class _Batch:
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.ids = []
+
+    def add(self, request, request_id):
+        self.ids.append(request_id)
+
+    def execute(self):
+        self.gmail.batches.append(list(self.ids))
+        for msg_id in self.ids:
+            failures = self.gmail.failures.get(msg_id)
+            if failures:
+                status = failures.pop(0)
+                self.callback(msg_id, None, _error(status))
+            else:
+                self.callback(msg_id, self.gmail.message(msg_id), None)
+
+
+class _FakeGmail:
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.batches = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, **kwargs):
+        assert kwargs["format"] == "full" and kwargs["fields"]
+        return kwargs["id"]
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
+
+    @staticmethod
+    def message(msg_id):
+        body = {"data": base64.urlsafe_b64encode(f"Corpo {msg_id}".encode()).decode()}
+        headers = [{"name": "Subject", "value": f"Oggetto {msg_id}"}]
+        return {"id": msg_id, "payload": {"mimeType": "text/plain", "body": body, "headers": headers}}
+
+
+def test_messaggi_scaricati_a_gruppi():
+    gmail = _FakeGmail()
+    records = list(agent.fetch_messages_batch(gmail, ["m1", "m2", "m3"], batch_size=2))
+    assert gmail.batches == [["m1", "m2"], ["m3"]]
+    assert [(r.msg_id, r.subject, r.body) for r in records[:1]] == [("m1", "Oggetto m1", "Corpo m1")]
+    assert len(records) == 3
+
+
+def test_errori_temporanei_ritentati_gli_altri_saltati(monkeypatch):
+    monkeypatch.setattr(agent.time, "sleep", lambda secs: None)
+    gmail = _FakeGmail({"m1": [429, 503], "m2": [404]})
+    records = list(agent.fetch_messages_batch(gmail, ["m1", "m2", "m3"]))
+    assert [r.msg_id for r in records] == ["m1", "m3"]
+    # Solo gli elementi falliti con 429/5xx tornano nel batch successivo
+    assert gmail.batches == [["m1", "m2", "m3"], ["m1"], ["m1"]]
@@ -0,0 +1,79 @@
+import ControllaEmailCreaEvento as agent
+
+
+def _decision(title, day):
+    return {"titolo": title, "data": f"2030-03-{day:02d}", "ora_inizio": "10:00", "descrizione": ""}
+
+
+def test_scritture_in_blocco_a_fine_esecuzione(run_agent):
+    single = run_agent(count=20, state="singole")
+    bulk = run_agent(count=20, state="blocco", BULK_WRITES="true")
+    assert sorted(bulk.gmail.unread_ids()) == sorted(single.gmail.unread_ids())
+    assert len(bulk.calendar.events_created) == len(single.calendar.events_created)
+    assert bulk.gmail.calls["messages.batchModify"] == 1
+    assert "messages.modify" not in bulk.gmail.calls
+    assert bulk.calendar.calls["batch"] == 1
+
+
+class _FailingCalendar:
+    """Calendar il cui batch di inserimenti fallisce sempre."""
+
+    def events(self):
+        return self
+
+    def insert(self, **kwargs):
+        return kwargs
+
+    def new_batch_http_request(self, callback=None):
+        return self
+
+    def add(self, request, request_id=None):
+        pass
+
+    def execute(self):
+        raise RuntimeError("Calendar non disponibile")
+
+
+def test_email_non_marcata_se_l_evento_non_viene_creato(monkeypatch):
+    monkeypatch.setattr(agent, "EVENT_INDEX", None)
+    monkeypatch.setattr(agent.time, "sleep", lambda secs: None)
+    gmail = _FakeGmail()
+    writer = agent.BulkWriter(gmail, _FailingCalendar())
+    writer.add("m1", _decision("Riunione", 10))
+    writer.flush()
+    assert gmail.marked == []
+
+
+class _Request:
+    def __init__(self, calls, name, kwargs):
+        self.calls = calls
+        self.call = (name, kwargs)
+
+    def execute(self):
+        if self.call[0] == "batchModify":
+            raise RuntimeError("batchModify non disponibile")
+        self.calls.append(self.call[1]["id"])
+        return {}
+
+
+class _FakeGmail:
+    def __init__(self):
+        self.marked = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def modify(self, **kwargs):
+        return _Request(self.marked, "modify", kwargs)
+
+    def batchModify(self, **kwargs):
+        return _Request(self.marked, "batchModify", kwargs)
+
+
+def test_batch_modify_fallito_ripiega_su_modify():
+    gmail = _FakeGmail()
+    assert agent.mark_emails_as_read(gmail, ["m1", "m2"]) == ["m1", "m2"]
+    assert gmail.marked == ["m1", "m2"]
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+
+import ControllaEmailCreaEvento as agent
+
+
+class _Request:
+    def __init__(self, response):
+        self._response = response
+
+    def execute(self):
+        return self._response
+
+
+class _FakeCalendar:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def events(self):
+        return self
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        return _Request(self.responses.pop(0))
+
+
+def _event(event_id, day, summary="Riunione"):
+    return {"id": event_id, "summary": summary, "start": {"date": day}}
+
+
+def test_sincronizzazione_completa_limitata_alla_finestra_poi_incrementale():
+    today = datetime.now().date()
+    calendar = _FakeCalendar([
+        {"items": [_event("e1", today.isoformat())], "nextSyncToken": "tok1"},
+        {"items": [_event("e2", (today + timedelta(days=1)).isoformat(), "Cena")], "nextSyncToken": "tok2"},
+    ])
+    index = agent.CalendarEventIndex(past_days=10)
+    index.sync(calendar)
+    first = calendar.calls[0]
+    assert "syncToken" not in first
+    time_min = datetime.fromisoformat(first["timeMin"].replace("Z", "+00:00"))
+    expected = datetime.now(timezone.utc) - timedelta(days=10)
+    assert abs((time_min - expected).total_seconds()) < 5
+
+    index.sync(calendar)
+    second = calendar.calls[1]
+    assert second["syncToken"] == "tok1"
+    assert "timeMin" not in second
+    assert index.sync_token == "tok2"
+    key = agent.CalendarEventIndex.make_key("Cena", (today + timedelta(days=1)).isoformat(), None)
+    assert index.find_duplicate(key) == "e2"
+
+
+def test_eventi_fuori_finestra_ignorati_e_cancellazioni():
+    today = datetime.now().date()
+    calendar = _FakeCalendar([
+        {"items": [_event("vecchio", (today - timedelta(days=100)).isoformat()), _event("e1", today.isoformat())],
+         "nextSyncToken": "tok1"},
+        {"items": [{"id": "e1", "status": "cancelled"}], "nextSyncToken": "tok2"},
+    ])
+    index = agent.CalendarEventIndex(past_days=10)
+    index.sync(calendar)
+    key = agent.CalendarEventIndex.make_key("Riunione", today.isoformat(), None)
+    assert index.find_duplicate(key) == "e1"
+    old_key = agent.CalendarEventIndex.make_key("Riunione", (today - timedelta(days=100)).isoformat(), None)
+    assert index.find_duplicate(old_key) is None
+    index.sync(calendar)
+    assert index.find_duplicate(key) is None
+
+
+def test_claim_e_release():
+    index = agent.CalendarEventIndex()
+    key = agent.CalendarEventIndex.make_key("Visita", "2030-01-10", "9:00")
+    assert index.claim(key, "m1") is None
+    assert index.claim(key, "m2") == "pending:m1"
+    index.release(key, "m1")
+    assert index.claim(key, "m2") is None
@@ -0,0 +1,55 @@
+import pytest
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent.decisions import is_valid_decision, needs_escalation
+
+
+@pytest.fixture
+def cascade(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(
+        cascade_mode=True, cascade_fast_model="flash", cascade_strong_model="pro", cascade_min_confidence=0.7,
+    ))
+    monkeypatch.setattr(agent, "METRICS", agent.RunMetrics())
+    calls = []
+
+    def answer(responses):
+        def fake_gemini(prompt, model, **kwargs):
+            calls.append(model)
+            response = responses[model]
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        monkeypatch.setattr(agent, "call_gemini_api", fake_gemini)
+        return calls
+
+    return answer
+
+
+def test_risposta_sicura_del_modello_veloce(cascade):
+    calls = cascade({"flash": {"creare_evento": "no", "confidenza": 0.9}})
+    assert agent.call_gemini_cascade("prompt") == {"creare_evento": "no", "confidenza": 0.9}
+    assert calls == ["flash"]
+
+
+def test_confidenza_bassa_passa_al_pro(cascade):
+    strong = {"creare_evento": "si", "titolo": "Visita", "data": "10-03-2030", "confidenza": 0.95}
+    calls = cascade({"flash": {"creare_evento": "si", "data": "10-03-2030", "confidenza": 0.4}, "pro": strong})
+    assert agent.call_gemini_cascade("prompt") == strong
+    assert calls == ["flash", "pro"]
+    assert agent.METRICS.summary()["counters"]["gemini_escalation"] == {"model=pro": 1}
+
+
+def test_quota_del_pro_esaurita_usa_la_risposta_veloce(cascade):
+    fast = {"creare_evento": "si", "titolo": "Visita", "data": "10-03-2030", "confidenza": 0.5}
+    cascade({"flash": fast, "pro": agent.RateLimitExceeded("429")})
+    assert agent.call_gemini_cascade("prompt") == fast
+
+
+def test_risposte_non_valide_sempre_verificate():
+    assert not is_valid_decision({"creare_evento": "forse"})
+    assert not is_valid_decision({"creare_evento": "si", "eventi": [{"data": "31-02-2030"}]})
+    assert not is_valid_decision({"creare_evento": "si", "data": "10-03-2030", "ora_inizio": "alle dieci"})
+    assert needs_escalation({"creare_evento": "si", "data": "32/13/2030", "confidenza": 1.0}, 0.7) == "risposta non valida"
+    assert needs_escalation({"creare_evento": "no"}, 0.7) == "confidenza bassa (0.00)"
+    assert needs_escalation({"creare_evento": "no", "confidenza": "0.8"}, 0.7) is None
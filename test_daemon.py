@@ -0,0 +1,42 @@
+import json
+import threading
+
+import ControllaEmailCreaEvento as agent
+
+
+class _Cycles(threading.Event):
+    """Arresta il demone dopo 'count' cicli, al posto dell'attesa tra un polling e l'altro."""
+
+    def __init__(self, count):
+        super().__init__()
+        self.count = count
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        if len(self.waits) >= self.count:
+            self.set()
+        return self.is_set()
+
+
+def test_intervallo_di_polling_adattivo(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(daemon_poll_min_secs=15.0, daemon_poll_max_secs=300.0))
+    assert agent._next_poll_interval(100.0, found=3, failed=False) == 15.0
+    assert agent._next_poll_interval(100.0, found=0, failed=False) == 150.0
+    assert agent._next_poll_interval(250.0, found=0, failed=False) == 300.0
+    assert agent._next_poll_interval(15.0, found=3, failed=True) == 30.0
+
+
+def test_demone_si_ferma_dopo_i_cicli_e_scrive_lo_stato(run_agent, monkeypatch):
+    cycles = _Cycles(2)
+    monkeypatch.setattr(agent, "_SHUTDOWN", cycles)
+    monkeypatch.setattr(agent.signal, "signal", lambda *args: None)
+    result = run_agent(count=10, DAEMON_MODE="true", DAEMON_POLL_MIN_SECS=20, DAEMON_POLL_MAX_SECS=60)
+    # Primo ciclo con posta: intervallo minimo; secondo a vuoto: +50%
+    assert cycles.waits == [20.0, 30.0]
+    assert result.gmail.calls["messages.get"] == 10
+    health = json.loads((result.state_dir / "health.json").read_text(encoding="utf-8"))
+    assert health["status"] == "stopped"
+    assert health["cycles"] == 2
+    assert health["processed"] == 10
+    assert health["errors"] == 0
@@ -0,0 +1,46 @@
+from datetime import date, datetime, timezone
+
+import pytest
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent.dates import REFERENCE
+
+
+@pytest.fixture
+def reference():
+    def _set(day):
+        REFERENCE.today = day
+
+    yield _set
+    REFERENCE.today = None
+
+
+def test_istruzioni_statiche_senza_data(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(structured_output=False, cascade_mode=False))
+    instruction = agent._system_instruction()
+    assert instruction is agent._system_instruction()
+    assert str(date.today().year) not in instruction
+
+
+def test_contesto_temporale_nel_prompt(reference):
+    # Recupero storico: la data di riferimento è quella di invio dell'email
+    reference(datetime(2024, 12, 30, 23, 30, tzinfo=timezone.utc))
+    prompt = agent.build_prompt("Ci vediamo il 2 gennaio", "Visita")
+    assert prompt.startswith("INFORMAZIONI TEMPORALI CORRENTI:\n- Data di oggi: 31-12-2024 (martedì)")
+    assert "usa 2024. Se la data è già passata quest'anno, usa 2025." in prompt
+    assert "Oggetto: Visita\n" in prompt
+
+
+def test_contesto_calcolato_una_volta_per_giorno():
+    agent._date_context.cache_clear()
+    for _ in range(3):
+        agent._date_context(date(2030, 3, 10))
+    agent._date_context(date(2030, 3, 11))
+    info = agent._date_context.cache_info()
+    assert (info.hits, info.misses) == (2, 2)
+
+
+def test_cache_di_contesto_spenta_di_default():
+    # Le istruzioni (~416-541 token) restano sotto il minimo di 1024 token della cache
+    assert agent._gemini_client_options({})["context_cache"] is False
+    assert agent._gemini_client_options({"GEMINI_CONTEXT_CACHE": "true"})["context_cache"] is True
@@ -0,0 +1,91 @@
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.errors import HttpError
+
+import ControllaEmailCreaEvento as agent
+
+
+def test_senza_posta_nuova_nessun_client_gemini(run_agent, monkeypatch):
+    first = run_agent(count=10)
+    created = []
+    monkeypatch.setattr(agent, "GeminiClient", lambda *args, **kwargs: created.append(args))
+    first.gmail.calls.clear()
+    run_agent(gmail=first.gmail)
+    assert created == []
+    # Una sola lista di una pagina: nessun download né lettura della cronologia
+    assert first.gmail.calls == {"messages.list": 1}
+
+
+def test_documenti_discovery_letti_una_volta(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(http_shared_session=False))
+    monkeypatch.setattr(agent, "_DISCOVERY_DOCS", {})
+    loaded = []
+    get_static_doc = discovery_cache.get_static_doc
+
+    def counting(name, version):
+        loaded.append(name)
+        return get_static_doc(name, version)
+
+    monkeypatch.setattr(discovery_cache, "get_static_doc", counting)
+    creds = Credentials(token="token-di-prova")
+    agent.build_services(creds)
+    agent.build_services(creds)
+    assert loaded == ["gmail", "calendar"]
+
+
+class _Request:
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+
+    def execute(self):
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class _FakeGmail:
+    def __init__(self, unread, history=None, history_error=None):
+        self.unread = unread
+        self.history_response = history
+        self.history_error = history_error
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return _History(self)
+
+    def list(self, **kwargs):
+        return _Request({"messages": [{"id": i} for i in self.unread]})
+
+
+class _History:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, **kwargs):
+        return _Request(self.gmail.history_response, self.gmail.history_error)
+
+
+class _Sync:
+    def __init__(self, history_id, pending=()):
+        self.history_id = history_id
+        self.pending = list(pending)
+
+
+def test_controllo_rapido_con_la_lista_gmail():
+    assert agent.has_pending_work(_FakeGmail(["m1", "m2"]), ledger={"m1"})
+    assert not agent.has_pending_work(_FakeGmail(["m1"]), ledger={"m1"})
+    assert not agent.has_pending_work(_FakeGmail([]))
+
+
+def test_controllo_rapido_con_la_cronologia():
+    assert not agent.has_pending_work(_FakeGmail([], history={}), sync=_Sync("100"))
+    assert agent.has_pending_work(_FakeGmail([], history={"history": [{"id": "101"}]}), sync=_Sync("100"))
+    expired = HttpError(httplib2.Response({"status": "404"}), b"")
+    assert agent.has_pending_work(_FakeGmail([], history_error=expired), sync=_Sync("100"))
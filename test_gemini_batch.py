@@ -0,0 +1,42 @@
+import ControllaEmailCreaEvento as agent
+from calendar_agent.records import EmailRecord
+
+
+def _events(result):
+    return sorted((e["summary"], str(e["start"])) for e in result.calendar.events_created)
+
+
+def test_piu_email_in_una_sola_richiesta(run_agent):
+    single = run_agent(count=20, state="singola", ICS_FAST_PATH="false")
+    batch = run_agent(count=20, state="blocchi", ICS_FAST_PATH="false", GEMINI_BATCH_MODE="true", GEMINI_BATCH_SIZE=10)
+    assert single.sdk.calls > 10
+    assert batch.sdk.calls <= 3
+    assert _events(batch) == _events(single)
+
+
+def test_blocchi_entro_il_budget_di_token():
+    items = [EmailRecord(f"m{n}", "Oggetto", "x" * 4000) for n in range(6)]
+    groups = agent._pack_batches(items, token_budget=4000, max_items=10)
+    assert [len(g) for g in groups] == [2, 2, 2]
+    assert [len(g) for g in agent._pack_batches(items, token_budget=100000, max_items=4)] == [4, 2]
+
+
+def test_voci_mancanti_rianalizzate_singolarmente(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(cascade_mode=False, gemini_batch_size=10))
+    monkeypatch.setattr(agent, "SENDER_TEMPLATES", None)
+    monkeypatch.setattr(agent, "SCHEDULER", None)
+    monkeypatch.setattr(agent, "PREFILTER", None)
+    calls = []
+
+    def fake_gemini(prompt, model, **kwargs):
+        calls.append(prompt)
+        if "=== EMAIL E1 ===" in prompt:
+            return [{"id": "E1", "creare_evento": "si", "titolo": "Visita", "data": "10-03-2030"}]
+        return {"creare_evento": "no"}
+
+    monkeypatch.setattr(agent, "call_gemini_api", fake_gemini)
+    records = [EmailRecord("m1", "Visita", "Il 10/03/2030 alle 10:00"), EmailRecord("m2", "Cena", "Venerdì alle 20:00")]
+    decisions = dict(agent.analyze_emails_batch(records))
+    assert decisions["m1"]["titolo"] == "Visita"
+    assert "m2" in decisions and decisions["m2"] is None
+    assert len(calls) == 2
@@ -0,0 +1,91 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent.gemini_client import GeminiClient
+
+
+class _Model:
+    def __init__(self, sdk, name):
+        self.sdk = sdk
+        self.name = name
+
+    def generate_content(self, prompt, generation_config=None):
+        self.sdk.calls.append(self.name)
+        if self.name in self.sdk.missing:
+            raise api_exceptions.NotFound(f"models/{self.name} is not found")
+        if self.name in self.sdk.errors:
+            raise self.sdk.errors[self.name]
+        return SimpleNamespace(text='{"creare_evento": "no"}', usage_metadata=None)
+
+
+class _FakeSdk:
+    def __init__(self, missing=(), errors=None):
+        self.missing = set(missing)
+        self.errors = errors or {}
+        self.configured = 0
+        self.created = []
+        self.calls = []
+
+    def configure(self, api_key=None):
+        self.configured += 1
+
+    def GenerativeModel(self, name, system_instruction=None):
+        self.created.append(name)
+        return _Model(self, name)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    def _client(sdk):
+        client = GeminiClient("chiave", breaker_path=str(tmp_path / "breaker.json"), context_cache=False, sdk=sdk)
+        monkeypatch.setattr(agent, "GEMINI_CLIENT", client)
+        monkeypatch.setattr(agent, "RATE_LIMITER", None)
+        monkeypatch.setattr(agent, "METRICS", agent.RunMetrics())
+        return client
+
+    return _client
+
+
+def test_sdk_configurato_una_volta_e_modelli_riusati(client):
+    sdk = _FakeSdk()
+    client(sdk)
+    for _ in range(3):
+        assert agent.call_gemini_api("prompt", "gemini-2.5-pro") == {"creare_evento": "no"}
+    assert sdk.configured == 1
+    assert sdk.created == ["gemini-2.5-pro"]
+
+
+def test_modello_non_disponibile_escluso_per_l_esecuzione(client):
+    sdk = _FakeSdk(missing=["gemini-2.5-pro"])
+    client(sdk)
+    agent.call_gemini_api("prompt", "gemini-2.5-pro")
+    agent.call_gemini_api("prompt", "gemini-2.5-pro")
+    assert sdk.calls == ["gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.5-flash"]
+
+
+def test_errore_generico_non_esclude_il_modello(client):
+    # Il testo cita 404 e quota, ma non è NotFound né ResourceExhausted
+    error = api_exceptions.InternalServerError("404 rate quota not available")
+    sdk = _FakeSdk(errors={"gemini-2.5-pro": error})
+    gemini = client(sdk)
+    assert agent.call_gemini_api("prompt", "gemini-2.5-pro") is None
+    assert sdk.calls == ["gemini-2.5-pro"]
+    assert gemini.is_available("gemini-2.5-pro")
+
+
+def test_circuit_breaker_salvato_fino_al_cooldown(client, tmp_path):
+    first = client(_FakeSdk())
+    first.trip("gemini-2.5-pro", "modello non disponibile", cooldown=3600)
+    first.trip("gemini-2.5-flash", "quota esaurita", cooldown=-1)
+    first.save()
+    saved = json.loads((tmp_path / "breaker.json").read_text(encoding="utf-8"))
+    assert list(saved["open"]) == ["gemini-2.5-pro"]
+
+    second = client(_FakeSdk())
+    assert second.blocked("gemini-2.5-pro")["reason"] == "modello non disponibile"
+    assert second.is_available("gemini-2.5-flash")
+    assert 3500 < second.blocked_for(["gemini-2.5-pro"]) <= 3600
@@ -0,0 +1,109 @@
+import json
+
+from googleapiclient.errors import HttpError
+import httplib2
+
+import ControllaEmailCreaEvento as agent
+
+
+class _Request:
+    def __init__(self, gmail, name, fn):
+        gmail.calls[name] = gmail.calls.get(name, 0) + 1
+        self._fn = fn
+
+    def execute(self):
+        return self._fn()
+
+
+class _History:
+    def __init__(self, gmail):
+        self._gmail = gmail
+
+    def list(self, startHistoryId=None, **kwargs):
+        gmail = self._gmail
+        records = [r for r in gmail.records if int(r["id"]) > int(startHistoryId)]
+        return _Request(gmail, "history.list", lambda: {"history": records, "historyId": str(gmail.history_id)})
+
+
+class _FakeGmail:
+    """Casella in memoria: messages.list/modify, history.list e getProfile."""
+
+    def __init__(self, messages):
+        self.by_id = {m["id"]: m for m in messages}
+        self.history_id = 1000
+        self.records = []
+        self.calls = {}
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, **kwargs):
+        return _Request(self, "getProfile", lambda: {"historyId": str(self.history_id)})
+
+    def list(self, **kwargs):
+        unread = [m for m in self.by_id.values() if "UNREAD" in m["labelIds"]]
+        unread.sort(key=lambda m: int(m["internalDate"]), reverse=True)
+        page = [{"id": m["id"], "threadId": m["threadId"]} for m in unread]
+        return _Request(self, "messages.list", lambda: {"messages": page})
+
+    def modify(self, id=None, body=None, **kwargs):
+        msg = self.by_id[id]
+        msg["labelIds"] = [label for label in msg["labelIds"] if label not in body["removeLabelIds"]]
+        self.history_id += 1
+        self.records.append({
+            "id": str(self.history_id),
+            "labelsRemoved": [{"message": {"id": id, "threadId": msg["threadId"], "labelIds": list(msg["labelIds"])},
+                               "labelIds": body["removeLabelIds"]}],
+        })
+        return _Request(self, "messages.modify", lambda: {"id": id})
+
+
+def _message(msg_id, labels=("UNREAD", "INBOX")):
+    return {"id": msg_id, "threadId": f"t{msg_id}", "labelIds": list(labels), "internalDate": msg_id[1:],
+            "payload": {"mimeType": "text/plain", "headers": []}}
+
+
+def _mark_read(gmail, msg_id):
+    gmail.users().messages().modify(userId="me", id=msg_id, body={"removeLabelIds": ["UNREAD"]}).execute()
+
+
+def test_prima_esecuzione_con_la_query_completa(tmp_path):
+    path = tmp_path / "gmail_sync.json"
+    gmail = _FakeGmail([_message("m1"), _message("m2"), _message("m3", labels=("INBOX",))])
+    sync = agent.GmailHistorySync(str(path))
+    assert [m["id"] for m in sync.list_candidates(gmail)] == ["m2", "m1"]
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert saved["historyId"] == "1000"
+    assert saved["threads"] == {"m2": "tm2", "m1": "tm1"}
+
+
+def test_esecuzione_successiva_legge_solo_le_modifiche(tmp_path):
+    path = str(tmp_path / "gmail_sync.json")
+    gmail = _FakeGmail([_message("m1"), _message("m2"), _message("m3")])
+    agent.GmailHistorySync(path).list_candidates(gmail)
+    _mark_read(gmail, "m2")
+    gmail.calls.clear()
+
+    candidates = agent.GmailHistorySync(path).list_candidates(gmail, limit=5, exclude={"m3"})
+    assert [m["id"] for m in candidates] == ["m1"]
+    assert gmail.calls == {"history.list": 1}
+
+
+class _ExpiredHistory:
+    def list(self, **kwargs):
+        raise HttpError(httplib2.Response({"status": "404"}), b"")
+
+
+def test_checkpoint_scaduto_torna_alla_query_completa(tmp_path):
+    path = str(tmp_path / "gmail_sync.json")
+    gmail = _FakeGmail([_message("m1")])
+    agent.GmailHistorySync(path).list_candidates(gmail)
+    gmail.history = _ExpiredHistory
+    assert [m["id"] for m in agent.GmailHistorySync(path).list_candidates(gmail)] == ["m1"]
+    assert gmail.calls["messages.list"] == 2
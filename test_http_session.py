@@ -0,0 +1,18 @@
+from google.oauth2.credentials import Credentials
+
+import ControllaEmailCreaEvento as agent
+
+
+def test_sessione_propria_per_ogni_coppia_di_servizi(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(http_shared_session=True))
+    creds = Credentials(token="token-di-prova")
+    try:
+        gmail1, calendar1 = agent.build_services(creds)
+        gmail2, _ = agent.build_services(creds)
+        assert gmail1._http.session is calendar1._http.session
+        assert gmail1._http.session is not gmail2._http.session
+        # Nessuno User-Agent scritto a mano: resta quello della libreria
+        assert "gzip" not in gmail1._http.session.headers.get("User-Agent", "")
+    finally:
+        agent._close_http_session()
+    assert agent._HTTP_SESSIONS == []
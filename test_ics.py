@@ -0,0 +1,76 @@
+import base64
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent.ics import ics_timezone, parse_ics
+
+INVITE = """BEGIN:VCALENDAR
+METHOD:REQUEST
+BEGIN:VTIMEZONE
+TZID:Pacific Standard Time
+END:VTIMEZONE
+BEGIN:VEVENT
+UID:abc@example.com
+SUMMARY:Revisione progetto\\, fase 2
+DTSTART;TZID=Pacific Standard Time:20300310T100000
+DTEND;TZID=Pacific Standard Time:20300310T113000
+LOCATION:Sala riunioni
+DESCRIPTION:Ordine del giorno:\\nbudget
+  e tempi
+BEGIN:VALARM
+TRIGGER:-PT15M
+END:VALARM
+END:VEVENT
+BEGIN:VEVENT
+UID:abc@example.com
+RECURRENCE-ID:20300317T100000
+DTSTART:20300318T100000
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def test_invito_outlook_letto_dal_file_ics():
+    method, events = parse_ics(INVITE.replace("\n", "\r\n"))
+    assert method == "REQUEST"
+    # L'eccezione della serie (RECURRENCE-ID) non crea un secondo evento
+    (event,) = events
+    assert (event["titolo"], event["data"]) == ("Revisione progetto, fase 2", "2030-03-10")
+    assert (event["ora_inizio"], event["ora_fine"]) == ("10:00", "11:30")
+    assert event["fuso"] == "America/Los_Angeles"
+    assert event["luogo"] == "Sala riunioni"
+    assert event["descrizione"] == "Ordine del giorno:\nbudget e tempi"
+    assert event["uid"] == "abc@example.com"
+
+
+def test_evento_di_un_giorno_intero_e_utc():
+    text = "BEGIN:VEVENT\nSUMMARY:Ferie\nDTSTART;VALUE=DATE:20300801\nDTEND;VALUE=DATE:20300815\nEND:VEVENT\n"
+    (event,) = parse_ics(text)[1]
+    assert (event["data"], event["ora_inizio"], event["data_fine"]) == ("2030-08-01", None, "2030-08-15")
+    text = "BEGIN:VEVENT\nSUMMARY:Call\nDTSTART:20300310T090000Z\nDURATION:PT45M\nEND:VEVENT\n"
+    (event,) = parse_ics(text, default_tz="Europe/Rome")[1]
+    assert (event["ora_inizio"], event["ora_fine"], event["fuso"]) == ("10:00", "10:45", "Europe/Rome")
+    assert ics_timezone("Romance Standard Time") == "Europe/Paris"
+
+
+def test_annullamento_non_crea_eventi(monkeypatch):
+    monkeypatch.setattr(agent, "TIMEZONE", "Europe/Rome")
+    message = {"id": "m1", "payload": {"mimeType": "multipart/alternative", "parts": [
+        {"mimeType": "text/plain", "body": {"data": _b64("Riunione annullata")}},
+        {"mimeType": "text/calendar", "body": {"data": _b64(INVITE.replace("METHOD:REQUEST", "METHOD:CANCEL"))}},
+    ]}}
+    assert agent._load_calendar_events(None, message) == []
+    assert agent._load_calendar_events(None, {"id": "m2", "payload": message["payload"]["parts"][0]}) is None
+
+
+def test_inviti_senza_chiamate_gemini(run_agent):
+    with_ics = run_agent(count=40, state="ics")
+    without = run_agent(count=40, state="gemini", ICS_FAST_PATH="false")
+    invites = with_ics.metrics.summary()["counters"]["inviti_calendario"]["esito=evento"]
+    assert invites > 0
+    # Un'analisi Gemini in meno per ogni invito, e un evento in più (il testo dell'invito non ha la data)
+    assert with_ics.sdk.calls == without.sdk.calls - invites
+    assert len(with_ics.calendar.events_created) == len(without.calendar.events_created) + invites
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent.ledger import ProcessedLedger
+
+
+class _Inbox:
+    """messages.list a pagine su una casella di sole email non lette, dalla più recente."""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.queries = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, q=None, pageToken=None, maxResults=100, **kwargs):
+        self.queries.append(q)
+        start = int(pageToken or 0)
+        page = self.ids[start:start + maxResults]
+        resp = {"messages": [{"id": i} for i in page]}
+        if start + len(page) < len(self.ids):
+            resp["nextPageToken"] = str(start + len(page))
+        return SimpleNamespace(execute=lambda: resp)
+
+
+def test_decisione_ricaricata_da_file(tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    ledger = ProcessedLedger(path)
+    content_hash = ProcessedLedger.content_hash("Newsletter", "Offerte  della\nsettimana")
+    ledger.record("m1", content_hash, "nessun_evento", sender="news@negozio.example")
+
+    reloaded = ProcessedLedger(path)
+    assert "m1" in reloaded
+    # Spazi e a capo diversi non cambiano l'hash
+    assert reloaded.decision_for_hash(ProcessedLedger.content_hash("Newsletter", "Offerte della settimana")) == "nessun_evento"
+    assert reloaded.sender_event_rate("news@negozio.example") < 0.5
+
+
+def test_voci_scadute_e_righe_troncate_ignorate(tmp_path):
+    path = tmp_path / "ledger.jsonl"
+    lines = [
+        json.dumps({"id": "vecchia", "hash": "h1", "decision": "nessun_evento", "ts": 0}),
+        json.dumps({"id": "m2", "hash": "h2", "decision": "nessun_evento", "ts": 4102444800}),
+        json.dumps({"id": "m2", "hash": "h2", "decision": "evento_creato", "ts": 4102444800}),
+        '{"id": "tronc',
+    ]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    ledger = ProcessedLedger(str(path), ttl_days=30)
+    assert "vecchia" not in ledger
+    assert ledger.decision_for_hash("h2") == "evento_creato"
+
+    ledger.compact(force=True)
+    assert [json.loads(line)["id"] for line in path.read_text(encoding="utf-8").splitlines()] == ["m2"]
+
+
+def test_compattazione_attende_le_scritture_in_corso(tmp_path):
+    path = tmp_path / "ledger.jsonl"
+    ledger = ProcessedLedger(str(path))
+    ledger.record("m1", None, "nessun_evento")
+    with ledger._lock:
+        worker = threading.Thread(target=ledger.compact, kwargs={"force": True})
+        worker.start()
+        worker.join(0.2)
+        assert worker.is_alive()
+        # Voce registrata mentre la compattazione attende il lock
+        ledger._index({"id": "m2", "hash": None, "decision": "nessun_evento", "ts": int(time.time())})
+    worker.join()
+    assert sorted(json.loads(line)["id"] for line in path.read_text(encoding="utf-8").splitlines()) == ["m1", "m2"]
+
+
+def test_limite_speso_solo_sulla_posta_nuova(tmp_path):
+    gmail = _Inbox([f"m{n}" for n in range(7, 0, -1)])
+    ledger = ProcessedLedger(str(tmp_path / "ledger.jsonl"))
+    for msg_id in ("m7", "m6", "m5"):
+        ledger.record(msg_id, None, "nessun_evento")
+    messages = agent.list_unread_messages(gmail, limit=2, exclude=ledger)
+    assert [m["id"] for m in messages] == ["m4", "m3"]
+
+
+def test_lista_limitata_alla_finestra_del_registro(tmp_path):
+    gmail = _Inbox(["m1"])
+    ledger = ProcessedLedger(str(tmp_path / "ledger.jsonl"), ttl_days=30)
+    ledger.record("m0", None, "nessun_evento")
+    agent.list_unread_messages(gmail, limit=2, exclude=ledger)
+    after = int(gmail.queries[0].split("after:")[1])
+    assert gmail.queries[0].startswith("is:unread after:")
+    assert abs(after - (time.time() - 30 * 86400)) < 60
+
+    # Senza scadenza delle voci nessun limite di data
+    gmail = _Inbox(["m1"])
+    eternal = ProcessedLedger(str(tmp_path / "eterno.jsonl"), ttl_days=0)
+    eternal.record("m0", None, "nessun_evento")
+    agent.list_unread_messages(gmail, limit=2, exclude=eternal)
+    assert gmail.queries == ["is:unread"]
+
+
+def test_email_senza_eventi_non_rimandate_a_gemini(run_agent):
+    first = run_agent(count=20)
+    assert first.sdk.calls > 0
+    unread = first.gmail.unread_ids()
+    assert unread
+    second = run_agent(gmail=first.gmail)
+    assert second.sdk.calls == 0
+    assert second.gmail.unread_ids() == unread
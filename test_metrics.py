@@ -0,0 +1,30 @@
+import ControllaEmailCreaEvento as agent
+
+
+class _Request:
+    def execute(self):
+        return {}
+
+
+class _FakeGmail:
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def modify(self, **kwargs):
+        return _Request()
+
+
+def test_le_fasi_usano_le_metriche_dell_esecuzione_in_corso(monkeypatch):
+    metrics = agent.RunMetrics()
+    monkeypatch.setattr(agent, "METRICS", metrics)
+    agent.mark_email_as_read(_FakeGmail(), "m1")
+    assert metrics.summary()["stages"]["gmail_mark_read"][""]["count"] == 1
+
+
+def test_main_usa_le_metriche_ricevute(run_agent):
+    result = run_agent(count=3)
+    assert agent.METRICS is result.metrics
+    assert result.metrics.summary()["counters"]["gemini_requests"]
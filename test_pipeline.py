@@ -0,0 +1,34 @@
+import ControllaEmailCreaEvento as agent
+from benchmark import generate_mailbox
+
+
+def _summary(result):
+    return sorted((e["summary"], str(e["start"])) for e in result.calendar.events_created), sorted(result.gmail.unread_ids())
+
+
+def test_pipeline_con_gli_stessi_risultati_della_sequenza(run_agent):
+    sequential = run_agent(count=30, state="sequenziale")
+    pipeline = run_agent(count=30, state="pipeline", PIPELINE_MODE="true", FETCH_WORKERS=3, GEMINI_WORKERS=4, BATCH_FETCH_SIZE=5)
+    assert sequential.calendar.events_created
+    assert _summary(pipeline) == _summary(sequential)
+    assert pipeline.gmail.calls["batch"] > sequential.gmail.calls["batch"]
+
+
+def test_quota_esaurita_nessuna_nuova_analisi(run_agent, monkeypatch):
+    analyzed = []
+    analyze_email = agent.analyze_email
+
+    def limited(record, ledger=None, **kwargs):
+        analyzed.append(record.msg_id)
+        if len(analyzed) == 3:
+            raise agent.RateLimitExceeded("429", retry_after_seconds=60)
+        return analyze_email(record, ledger, **kwargs)
+
+    monkeypatch.setattr(agent, "analyze_email", limited)
+    messages = generate_mailbox(30)["messages"]
+    result = run_agent(messages, PIPELINE_MODE="true", GEMINI_WORKERS=1, ICS_FAST_PATH="false", THREAD_COALESCE="false")
+    assert len(analyzed) == 3
+    # Le decisioni ottenute prima del 429 vengono comunque scritte
+    read = {m["id"] for m in messages} - set(result.gmail.unread_ids())
+    assert read <= set(analyzed[:2])
+    assert len(read) == len(result.calendar.events_created)
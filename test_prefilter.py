@@ -0,0 +1,41 @@
+import pytest
+
+from calendar_agent.prefilter import EmailPrefilter
+
+
+@pytest.mark.parametrize("text", [
+    "Ci vediamo il 12/03 in ufficio",
+    "Riunione giovedì 5 marzo alle 15:30",
+    "La consegna è prevista per domani",
+    "Meeting next Tuesday at 3pm",
+])
+def test_riferimenti_temporali_inviati_a_gemini(text):
+    send, score, _ = EmailPrefilter().evaluate("Aggiornamento", text)
+    assert send and score >= 0.3
+
+
+def test_email_senza_date_non_inviata():
+    send, score, reason = EmailPrefilter().evaluate("Grazie", "Grazie per il documento, lo leggo con calma.")
+    assert not send
+    assert score == 0.0
+    assert reason == "nessun riferimento a date/orari"
+
+
+def test_mittenti_ed_etichette_prevalgono_sul_testo():
+    prefilter = EmailPrefilter(
+        allow_senders=EmailPrefilter.split_list("segreteria@studio.example"),
+        deny_senders=EmailPrefilter.split_list("news@, promo@negozio.example"),
+        deny_labels=["CATEGORY_PROMOTIONS"],
+    )
+    assert prefilter.evaluate("Ciao", "Nessuna data", {"from": "Segreteria@Studio.example"})[0]
+    assert not prefilter.evaluate("Offerte", "Solo domani alle 10:00", {"from": "news@negozio.example"})[0]
+    assert not prefilter.evaluate("Evento", "Il 12/03 alle 10:00", {"labels": ["category_promotions"]})[0]
+
+
+def test_meno_chiamate_gemini_con_il_prefiltro(run_agent):
+    without = run_agent(count=30, state="senza", ICS_FAST_PATH="false")
+    with_prefilter = run_agent(count=30, state="con", ICS_FAST_PATH="false", PREFILTER_ENABLED="true")
+    assert with_prefilter.sdk.calls < without.sdk.calls
+    assert len(with_prefilter.calendar.events_created) == len(without.calendar.events_created)
+    ledger = (with_prefilter.state_dir / "processed_ledger.jsonl").read_text(encoding="utf-8")
+    assert '"scartata_prefiltro"' in ledger
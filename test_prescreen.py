@@ -0,0 +1,93 @@
+import pytest
+
+import ControllaEmailCreaEvento as agent
+
+
+class _Batch:
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.ids = []
+
+    def add(self, request, request_id):
+        self.ids.append(request_id)
+
+    def execute(self):
+        for msg_id in self.ids:
+            self.callback(msg_id, self.gmail.metadata[msg_id], None)
+
+
+class _FakeGmail:
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, **kwargs):
+        assert kwargs["format"] == "metadata"
+        return kwargs["id"]
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
+
+
+def _meta(sender, *extra_headers, labels=("UNREAD", "INBOX")):
+    headers = [{"name": "From", "value": sender}, {"name": "Content-Type", "value": "text/plain"}]
+    headers += [{"name": name, "value": value} for name, value in extra_headers]
+    return {"labelIds": list(labels), "payload": {"headers": headers}}
+
+
+class _Ledger:
+    def __init__(self):
+        self.records = {}
+
+    def record(self, msg_id, content_hash, decision, sender=None):
+        self.records[msg_id] = decision
+
+
+@pytest.fixture
+def prefilter(monkeypatch):
+    monkeypatch.setattr(agent, "PREFILTER", agent.EmailPrefilter(deny_senders=["noreply@shop.example"]))
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(ics_fast_path=True))
+
+
+def test_snippet_senza_data_viene_scaricato(prefilter):
+    # Nessuna data nelle intestazioni: si scarica, deciderà il prefiltro sul testo completo
+    gmail = _FakeGmail({"m1": _meta("hr@azienda.example")})
+    ledger = _Ledger()
+    assert agent.prescreen_messages(gmail, ["m1"], ledger) == ["m1"]
+    assert ledger.records == {}
+
+
+def test_newsletter_e_mittente_escluso_non_scaricati(prefilter):
+    gmail = _FakeGmail({
+        "m1": _meta("news@blog.example", ("List-Unsubscribe", "<mailto:off@blog.example>")),
+        "m2": _meta("Negozio <noreply@shop.example>"),
+        "m3": _meta("lista@gruppo.example", ("Precedence", "bulk")),
+        "m4": _meta("amico@example.com"),
+    })
+    ledger = _Ledger()
+    assert agent.prescreen_messages(gmail, ["m1", "m2", "m3", "m4"], ledger) == ["m4"]
+    assert ledger.records == {"m1": "scartata_prefiltro", "m2": "scartata_prefiltro", "m3": "scartata_prefiltro"}
+
+
+def test_conversazione_scaricata_se_una_email_passa(prefilter):
+    gmail = _FakeGmail({
+        "r1": _meta("lista@gruppo.example", ("List-Id", "<gruppo.example>")),
+        "r2": _meta("dentista@studio.example"),
+    })
+    ledger = _Ledger()
+    kept = agent.prescreen_messages(gmail, ["r1", "r2"], ledger, thread_of={"r1": "t", "r2": "t"})
+    assert kept == ["r1", "r2"]
+    assert ledger.records == {}
+
+
+def test_invito_allegato_sempre_scaricato(prefilter):
+    gmail = _FakeGmail({"m1": {"labelIds": [], "payload": {"headers": [
+        {"name": "From", "value": "noreply@shop.example"}, {"name": "Content-Type", "value": "multipart/mixed; boundary=x"},
+    ]}}})
+    assert agent.prescreen_messages(gmail, ["m1"]) == ["m1"]
@@ -0,0 +1,99 @@
+from google.api_core import exceptions as api_exceptions
+
+import ControllaEmailCreaEvento as agent
+from calendar_agent import rate_limit
+
+
+def _state(limiter, model="gemini-2.5-flash"):
+    return limiter._models[model]
+
+
+def test_acquire_consuma_il_budget():
+    limiter = agent.GeminiRateLimiter(limits={"gemini-2.5-flash": (10, 1000, 5)}, max_wait=0)
+    assert limiter.acquire("gemini-2.5-flash", 100)
+    st = _state(limiter)
+    assert st["day_count"] == 1
+    assert 8.9 < st["requests"] < 9.1
+    assert st["tokens"] < 901
+
+
+def test_limite_giornaliero_esaurito():
+    limiter = agent.GeminiRateLimiter(limits={"gemini-2.5-flash": (0, 0, 2)}, max_wait=0)
+    assert limiter.acquire("gemini-2.5-flash")
+    assert limiter.acquire("gemini-2.5-flash")
+    assert not limiter.acquire("gemini-2.5-flash")
+
+
+def test_refund_non_supera_la_capienza():
+    limiter = agent.GeminiRateLimiter(limits={"gemini-2.5-flash": (10, 1000, 5)}, max_wait=0)
+    assert limiter.acquire("gemini-2.5-flash", 100)
+    limiter.refund("gemini-2.5-flash", 100)
+    limiter.refund("gemini-2.5-flash", 100)
+    st = _state(limiter)
+    assert st["day_count"] == 0
+    assert st["requests"] <= 10.0
+    assert st["tokens"] <= 1000.0
+
+
+def test_combinato_restituisce_il_budget_se_un_limitatore_e_esaurito():
+    account = agent.GeminiRateLimiter(limits={"gemini-2.5-flash": (10, 1000, 5)}, max_wait=0)
+    shared = agent.GeminiRateLimiter(limits={"gemini-2.5-flash": (0, 0, 1)}, max_wait=0)
+    combined = agent.CombinedRateLimiter([account, shared], max_wait=0)
+    assert combined.acquire("gemini-2.5-flash", 100)
+    assert _state(account)["day_count"] == 1
+    assert not combined.acquire("gemini-2.5-flash", 100)
+    # La seconda chiamata non è partita: il budget dell'account non deve calare
+    assert _state(account)["day_count"] == 1
+    assert _state(shared)["day_count"] == 1
+    assert 8.9 < _state(account)["requests"] < 9.1
+
+
+def test_limiti_predefiniti_del_piano_gratuito_sovrascrivibili():
+    limiter = agent.GeminiRateLimiter(limits=agent.GeminiRateLimiter.parse_limits("gemini-2.5-pro:2/1000/10"))
+    assert limiter.limits["gemini-2.5-pro"] == (2, 1000, 10)
+    assert limiter.limits["gemini-2.5-flash"] == rate_limit.GEMINI_FLASH_FREE_LIMITS
+    assert limiter.max_wait == rate_limit.GEMINI_MAX_WAIT_DEFAULT_SECS
+
+
+def test_pausa_per_email_rispettata_anche_con_il_limitatore(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(agent, "RATE_LIMITER", agent.GeminiRateLimiter())
+    monkeypatch.setattr(agent, "PER_EMAIL_SLEEP_SECS", 10.0)
+    settings = agent.SETTINGS._replace(thread_coalesce=False, gmail_prescreen=False, gemini_batch_mode=False, batch_fetch_size=0)
+    monkeypatch.setattr(agent, "SETTINGS", settings)
+    monkeypatch.setattr(agent, "SCHEDULER", None)
+    monkeypatch.setattr(agent, "_fetch_messages_sequential", lambda gmail, ids: [agent.EmailRecord(i, "Oggetto", "Testo") for i in ids])
+    monkeypatch.setattr(agent, "process_fetched_email", lambda *args, **kwargs: None)
+    monkeypatch.setattr(agent.time, "sleep", sleeps.append)
+    agent._process_messages_with(None, None, [{"id": "a"}, {"id": "b"}])
+    assert sleeps == [10.0, 10.0]
+
+
+class _FailingClient:
+    """Client Gemini la cui richiesta fallisce con l'errore dato."""
+
+    def __init__(self, error):
+        self.error = error
+
+    def blocked(self, name):
+        return None
+
+    def is_available(self, name):
+        return True
+
+    def trip(self, name, reason, cooldown=None):
+        pass
+
+    def generate(self, name, prompt, generation_config=None, system_instruction=None):
+        raise self.error
+
+
+def test_errore_non_429_restituisce_il_budget(monkeypatch):
+    limiter = agent.GeminiRateLimiter(limits={"gemini-2.5-flash": (10, 1000, 5)}, max_wait=0)
+    monkeypatch.setattr(agent, "RATE_LIMITER", limiter)
+    monkeypatch.setattr(agent, "METRICS", agent.RunMetrics())
+    monkeypatch.setattr(agent, "GEMINI_CLIENT", _FailingClient(api_exceptions.ServiceUnavailable("non disponibile")))
+    assert agent.call_gemini_api("prompt", "gemini-2.5-flash") is None
+    st = _state(limiter)
+    assert st["day_count"] == 0
+    assert st["requests"] > 9.9
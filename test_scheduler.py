@@ -0,0 +1,56 @@
+import time
+
+import ControllaEmailCreaEvento as agent
+
+
+def _record(msg_id, subject, body="", labels=("UNREAD",), age_days=0.0):
+    meta = {"from": "a@example.com", "labels": list(labels), "date": str(int((time.time() - age_days * 86400) * 1000))}
+    return agent.EmailRecord(msg_id, subject, body, meta)
+
+
+def test_rank_usa_i_metadati_del_record(tmp_path):
+    scheduler = agent.RunScheduler(str(tmp_path / "scheduler.json"))
+    records = [
+        _record("vecchia", "Aggiornamento", age_days=60),
+        _record("riunione", "Riunione domani alle 15:00"),
+        _record("recente", "Aggiornamento"),
+    ]
+    assert [record.msg_id for _, record in scheduler.rank(records)] == ["riunione", "recente", "vecchia"]
+
+
+def test_rimandata_letta_nel_frattempo_scartata(tmp_path):
+    scheduler = agent.RunScheduler(str(tmp_path / "scheduler.json"))
+    scheduler.carried = ["letta"]
+    ranked = scheduler.rank([_record("letta", "Riunione domani", labels=("INBOX",)), _record("nuova", "Ciao")])
+    assert [record.msg_id for _, record in ranked] == ["nuova"]
+
+
+def _metadata(subject, thread):
+    return {"threadId": thread, "labelIds": ["UNREAD"], "snippet": "", "internalDate": str(int(time.time() * 1000)),
+            "payload": {"headers": [{"name": "Subject", "value": subject}, {"name": "From", "value": "a@example.com"}]}}
+
+
+def test_ordine_sui_metadati_tiene_unite_le_conversazioni(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, "SCHEDULER", agent.RunScheduler(str(tmp_path / "scheduler.json")))
+    metadata = {
+        "a1": _metadata("Aggiornamento", "ta"),
+        "b1": _metadata("Riunione domani alle 15:00", "tb"),
+        "a2": _metadata("Re: Aggiornamento", "ta"),
+        "c1": _metadata("Cena venerdì alle 20", "tc"),
+    }
+    thread_of = {msg_id: meta["threadId"] for msg_id, meta in metadata.items()}
+    ranked = [msg_id for _, msg_id in agent.rank_by_metadata(["a1", "a2", "b1", "c1"], metadata, thread_of)]
+    assert ranked[-2:] == ["a1", "a2"]
+    assert set(ranked[:2]) == {"b1", "c1"}
+
+
+def test_senza_scadenza_nessuno_scheduler(run_agent):
+    run = run_agent(count=6)
+    assert agent.SCHEDULER is None
+    assert "gmail_metadata" not in run.metrics.summary()["stages"]
+
+
+def test_scadenza_raggiunta_nessun_download_completo(run_agent):
+    run = run_agent(count=6, RUN_DEADLINE_AT=time.time() - 1, BATCH_FETCH_SIZE=0, THREAD_COALESCE="false")
+    assert len(run.gmail.fetched) <= 1
+    assert run.sdk.calls == 0
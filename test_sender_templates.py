@@ -0,0 +1,87 @@
+import pytest
+
+import ControllaEmailCreaEvento as agent
+
+SENDER = "Studio Dentistico <agenda@studio.example>"
+
+
+def _email(n, day, time_str, subject=None):
+    subject = subject or f"Promemoria appuntamento n. {n}"
+    body = f"Gentile paziente,\nle ricordiamo l'appuntamento.\nData: {day:02d}/03/2030\nOrario: {time_str}\nCordiali saluti"
+    return f"m{n}", subject, body
+
+
+def _gemini(day, time_str):
+    return {"creare_evento": "si", "titolo": "Appuntamento dentista", "data": f"{day:02d}-03-2030", "ora_inizio": time_str}
+
+
+@pytest.fixture
+def templates(tmp_path):
+    return agent.SenderTemplates(str(tmp_path / "sender_templates.json"), min_examples=3, verify_rate=0.0)
+
+
+def _record(msg_id, subject, body):
+    return agent.EmailRecord(msg_id, subject, body, {"from": SENDER})
+
+
+def _observe(templates, msg_id, subject, body, result):
+    templates.observe(_record(msg_id, subject, body), result)
+
+
+def _lookup(templates, msg_id, subject, body):
+    return templates.lookup(_record(msg_id, subject, body))
+
+
+def _learned(templates):
+    for n, (day, time_str) in enumerate([(3, "10:30"), (7, "15:00"), (12, "09:15")], 1):
+        msg_id, subject, body = _email(n, day, time_str)
+        _observe(templates, msg_id, subject, body, _gemini(day, time_str))
+    return templates
+
+
+def test_modello_appreso_e_applicato(templates):
+    _learned(templates)
+    template = templates.senders["agenda@studio.example"]["modello"]
+    assert template["oggetti"] == ["promemoria appuntamento n. #"]
+    result = _lookup(templates, *_email(4, 20, "11:45"))
+    assert result["data"] == "2030-03-20"
+    assert result["ora_inizio"] == "11:45"
+    assert result["titolo"] == "Appuntamento dentista"
+
+
+def test_oggetto_diverso_va_a_gemini(templates):
+    _learned(templates)
+    # Stesso mittente, data dopo l'ancora, ma non è un promemoria: niente modello
+    msg_id, _, body = _email(5, 28, "08:00", subject="Fattura n. 2030/145")
+    assert _lookup(templates, msg_id, "Fattura n. 2030/145", body) is None
+
+
+def test_ancora_assente_va_a_gemini(templates):
+    _learned(templates)
+    body = "Gentile paziente, lo studio resterà chiuso dal 10/08/2030 per ferie."
+    assert _lookup(templates, "m6", "Promemoria appuntamento n. 6", body) is None
+
+
+def test_disaccordo_in_verifica_scarta_il_modello(templates):
+    _learned(templates)
+    msg_id, subject, body = _email(7, 21, "10:00")
+    _observe(templates, msg_id, subject, body, _gemini(22, "10:00"))
+    assert "modello" not in templates.senders.get("agenda@studio.example", {})
+
+
+def test_nuovo_tipo_di_oggetto_confermato_da_gemini(templates):
+    _learned(templates)
+    msg_id, _, body = _email(8, 25, "16:30")
+    subject = "Re: Promemoria appuntamento 25/03/2030"
+    assert _lookup(templates, msg_id, "Conferma visita", body) is None
+    _observe(templates, msg_id, "Conferma visita", body, _gemini(25, "16:30"))
+    assert _lookup(templates, msg_id, "Conferma visita", body.replace("25/03", "26/03"))["data"] == "2030-03-26"
+    # "Re:" non cambia la forma dell'oggetto
+    assert agent.SenderTemplates.subject_shape(subject) == "promemoria appuntamento <data>"
+
+
+def test_salvataggio_e_ricarica(templates, tmp_path):
+    _learned(templates)
+    templates.save()
+    reloaded = agent.SenderTemplates(str(tmp_path / "sender_templates.json"), verify_rate=0.0)
+    assert _lookup(reloaded, *_email(9, 15, "12:00"))["data"] == "2030-03-15"
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from google.generativeai import protos
+from google.generativeai import types as genai_types
+from google.generativeai.types import generation_types
+
+import ControllaEmailCreaEvento as agent
+
+
+@pytest.fixture
+def structured(monkeypatch):
+    monkeypatch.setattr(agent, "SETTINGS", agent.SETTINGS._replace(structured_output=True, cascade_mode=False))
+    return monkeypatch
+
+
+@pytest.mark.parametrize("batch", [False, True])
+@pytest.mark.parametrize("cascade", [False, True])
+def test_generation_config_accetta_gli_schemi(structured, batch, cascade):
+    structured.setattr(agent, "SETTINGS", agent.SETTINGS._replace(cascade_mode=cascade))
+    schema = agent._response_schema(batch=batch)
+    config = genai_types.GenerationConfig(response_mime_type="application/json", response_schema=schema)
+    proto = protos.GenerationConfig(**generation_types.to_generation_config_dict(config))
+    root = proto.response_schema
+    event = (root.items if batch else root).properties["eventi"].items
+    # "nullable" e "description" arrivano all'API, non vengono scartati né rifiutati
+    assert event.properties["data"].nullable
+    assert event.properties["titolo"].description == "Titolo breve e descrittivo"
+    assert list(event.required) == ["titolo", "data"]
+    assert ("confidenza" in (root.items if batch else root).properties) == cascade
+
+
+def test_risposta_conforme(structured):
+    schema = agent._response_schema()
+    text = json.dumps({"creare_evento": "si", "eventi": [{"titolo": "Visita", "data": "10-03-2030", "ora_inizio": None}]})
+    assert agent._schema_errors(json.loads(text), schema) == []
+    assert agent._parse_structured(text, schema) is not None
+
+
+def test_risposta_non_conforme(structured):
+    schema = agent._response_schema()
+    errors = agent._schema_errors({"creare_evento": "si", "eventi": [{"data": None, "titolo": 3}]}, schema)
+    assert "$.eventi[0].titolo: atteso string" in errors
+    assert agent._parse_structured('{"creare_evento": "si"}', schema) is None
+
+
+def test_json_troncato_riparato():
+    assert agent._repair_json('```json\n{"creare_evento": "no", "eventi": [') == {"creare_evento": "no", "eventi": []}
+
+
+def test_primo_blocco_json_bilanciato():
+    # La regex golosa univa i due oggetti e la nota tra parentesi quadre
+    assert agent._try_parse_json('Ecco: {"creare_evento": "no"} oppure {"creare_evento": "si"}') == {"creare_evento": "no"}
+    assert agent._try_parse_json('```json\n[{"id": "E1"}]\n``` [vedi sopra]') == [{"id": "E1"}]
+    assert agent._try_parse_json('Risposta {"titolo": "Riunione {team} [A]"} fine}') == {"titolo": "Riunione {team} [A]"}
+    assert agent._try_parse_json("nessun JSON") is None
@@ -0,0 +1,49 @@
+import base64
+
+import ControllaEmailCreaEvento as agent
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def test_disclaimer_in_coda_rimosso():
+    text = (
+        "Ciao, la riunione è fissata per il 12 marzo alle 10:00 in sala B.\n\n"
+        "Questo messaggio e i suoi allegati sono riservati ai destinatari indicati.\n\n"
+        "Informativa ai sensi del Regolamento UE 2016/679 (GDPR)."
+    )
+    cleaned = agent._strip_quoted_and_boilerplate(text)
+    assert "12 marzo" in cleaned
+    assert "riservati" not in cleaned
+    assert "GDPR" not in cleaned
+
+
+def test_paragrafo_con_parole_da_disclaimer_nel_corpo_resta():
+    text = (
+        "Corso di formazione GDPR per tutto il personale.\n\n"
+        "Si terrà il 5 maggio alle 14:30 in aula magna.\n\n"
+        "Saluti,\nUfficio personale"
+    )
+    cleaned = agent._strip_quoted_and_boilerplate(text)
+    assert "Corso di formazione GDPR" in cleaned
+    assert "5 maggio" in cleaned
+
+
+def test_risposta_citata_rimossa():
+    text = (
+        "Confermo la visita di giovedì 3 ottobre alle 9:00, ci vediamo in studio.\n\n"
+        "Il giorno lun 30 set 2024 alle 10:00 Mario Rossi <mario@example.com> ha scritto:\n"
+        "> Possiamo spostare la visita?\n"
+    )
+    cleaned = agent._strip_quoted_and_boilerplate(text)
+    assert "3 ottobre" in cleaned
+    assert "spostare" not in cleaned
+
+
+def test_alternativa_testo_breve_usa_html():
+    plain = {"mimeType": "text/plain", "body": {"data": _b64("Apri nel browser")}}
+    html = {"mimeType": "text/html", "body": {"data": _b64("<p>Evento il 4 aprile</p>")}}
+    assert agent._best_alternative([plain, html]) is html
+    long_plain = {"mimeType": "text/plain", "body": {"data": _b64("x" * agent._MIN_PLAIN_ALTERNATIVE)}}
+    assert agent._best_alternative([long_plain, html]) is long_plain
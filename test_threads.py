@@ -0,0 +1,68 @@
+import ControllaEmailCreaEvento as agent
+
+
+def _invite(uid, title):
+    return {"uid": uid, "titolo": title, "data": "2030-03-10", "ora_inizio": "10:00"}
+
+
+def test_conversazione_unita_con_gli_inviti_di_tutti_i_messaggi():
+    records = [
+        agent.EmailRecord("m3", "Re: Riunione", "Va bene anche per me"),
+        agent.EmailRecord("m2", "Re: Riunione", "Confermo", calendar_events=[_invite("u1", "Riunione (aggiornata)")]),
+        agent.EmailRecord("m1", "Riunione", "Ci vediamo?", calendar_events=[_invite("u1", "Riunione"), _invite("u2", "Cena")]),
+    ]
+    thread_of = {"m1": "t", "m2": "t", "m3": "t"}
+    (merged,) = list(agent.coalesce_thread_records(records, thread_of))
+    assert merged.msg_id == "m3"
+    assert merged.siblings == ("m2", "m1")
+    assert "Confermo" in merged.body and "Ci vediamo?" in merged.body
+    # Stesso UID: vale l'invito del messaggio più recente
+    assert [e["titolo"] for e in merged.calendar_events] == ["Riunione (aggiornata)", "Cena"]
+
+
+def test_unione_a_flusso_senza_leggere_i_thread_successivi():
+    read = []
+
+    def records():
+        for msg_id in ("a2", "a1", "b1", "c1"):
+            read.append(msg_id)
+            yield agent.EmailRecord(msg_id, "Oggetto", msg_id)
+
+    stream = agent.coalesce_thread_records(records(), {"a1": "ta", "a2": "ta", "b1": "tb", "c1": "tc"})
+    assert next(stream).siblings == ("a1",)
+    # Solo il primo messaggio della conversazione successiva è stato letto
+    assert read == ["a2", "a1", "b1"]
+
+
+class _Request:
+    def __init__(self, calls, name, kwargs):
+        calls.append((name, kwargs))
+
+    def execute(self):
+        return {}
+
+
+class _FakeGmail:
+    def __init__(self):
+        self.calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def modify(self, **kwargs):
+        return _Request(self.calls, "modify", kwargs)
+
+    def batchModify(self, **kwargs):
+        return _Request(self.calls, "batchModify", kwargs)
+
+
+def test_conversazione_marcata_letta_con_una_sola_chiamata(monkeypatch):
+    monkeypatch.setattr(agent, "EVENT_INDEX", None)
+    monkeypatch.setattr(agent, "create_calendar_event", lambda *args, **kwargs: {"id": "ev1"})
+    gmail = _FakeGmail()
+    decision = {"titolo": "Riunione", "data": "2030-03-10", "ora_inizio": "10:00", "conversazione": ["m2", "m1"]}
+    agent.apply_event_decision(gmail, None, "m3", decision)
+    assert gmail.calls == [("batchModify", {"userId": "me", "body": {"ids": ["m3", "m2", "m1"], "removeLabelIds": ["UNREAD"]}})]